@@ -1,8 +1,14 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort, g
 from db import db_session, init_db
-from models import Integration, Deployment, Job, Violation
-from sqlalchemy import desc
+from models import Integration, Deployment, Job, Violation, ConcurrencyLimit, Artifact
+from sqlalchemy import desc, update, tuple_
+from sqlalchemy.orm import contains_eager
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from metrics import REQUEST_LATENCY, CLAIM_LATENCY, CLAIMS, QUEUE_DEPTH, QUEUE_OLDEST, QUEUE_DESIRED_WORKERS
+import json
+import base64
 import logging
+import time
 from datetime import datetime
 from jsonschema import ValidationError
 from utils.decorators import require_token
@@ -16,6 +22,28 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 init_db()
 
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    if "request_started" in g:
+        # Label by route template, not the raw path, to keep cardinality bounded
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(request.method, endpoint, response.status_code).observe(
+            time.perf_counter() - g.request_started
+        )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
 # -------------------------
 # Integration Endpoints
 # -------------------------
@@ -135,7 +163,9 @@ def create_deployment(tenant_id):
             schedule=data.get("schedule"),
             queue=data.get("queue"),
             timeout=data.get("timeout", 3600),
-            tenant_id=tenant_id
+            tenant_id=tenant_id,
+            priority=data.get("priority", 0),
+            profile=data.get("profile", False)
         )
         db_session.add(deployment)
         db_session.commit()
@@ -158,8 +188,14 @@ def update_deployment(tenant_id, deployment_id):
     if not deployment:
         return jsonify({"error": "Deployment not found"}), 404
 
+    try:
+        Deployment.validate_fields({k: v for k, v in data.items() if k in Deployment.UPDATABLE_FIELDS})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     if "config" in data:
         deployment.config = data["config"]
+        deployment.reset_breaker()  # e.g. fixed credentials, give it a fresh start
     if "enabled" in data:
         deployment.enabled = data["enabled"]
     if "schedule" in data:
@@ -168,6 +204,10 @@ def update_deployment(tenant_id, deployment_id):
         deployment.queue = data["queue"]
     if "timeout" in data:
         deployment.timeout = data["timeout"]
+    if "priority" in data:
+        deployment.priority = data["priority"]
+    if "profile" in data:
+        deployment.profile = data["profile"]
 
     try:
         db_session.commit()
@@ -177,6 +217,143 @@ def update_deployment(tenant_id, deployment_id):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/tenants/<string:tenant_id>/deployments/bulk", methods=["POST"])
+@require_token
+def bulk_create_deployments(tenant_id):
+    """
+    Create many deployments in one transaction. Each item takes the same fields
+    as create_deployment. Invalid items are reported by index in "errors" and
+    the valid ones are created, unless "atomic" is set, in which case nothing
+    is created if any item is invalid.
+    """
+    data = request.get_json()
+    items = data.get("deployments") if data else None
+    if not isinstance(items, list):
+        abort(400, "deployments must be a list")
+
+    integration_ids = {
+        i["integration_id"] for i in items if isinstance(i, dict) and isinstance(i.get("integration_id"), int)
+    }
+    integrations = {
+        i.id: i for i in db_session.query(Integration).filter(Integration.id.in_(integration_ids))
+    }
+
+    deployments, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or not all(k in item for k in ["integration_id", "config"]):
+                raise ValueError("Missing required fields")
+            if not isinstance(item["integration_id"], int) or isinstance(item["integration_id"], bool):
+                raise ValueError("integration_id must be int")
+            Deployment.validate_fields({k: v for k, v in item.items() if k in Deployment.FIELD_TYPES})
+            integration = integrations.get(item["integration_id"])
+            if not integration:
+                raise ValueError("Integration not found")
+            deployments.append((index, integration.create_deployment(
+                config=item["config"],
+                schedule=item.get("schedule"),
+                queue=item.get("queue", "default"),
+                timeout=item.get("timeout", 3600),
+                tenant_id=tenant_id,
+                priority=item.get("priority", 0),
+                profile=item.get("profile", False)
+            )))
+        except ValidationError as e:
+            errors.append({"index": index, "error": f"Invalid config: {e.message}"})
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+
+    if errors and data.get("atomic"):
+        return jsonify({"created": [], "errors": errors}), 400
+
+    try:
+        db_session.add_all([deployment for _, deployment in deployments])
+        db_session.commit()
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    created = [{"index": index, "deployment_id": d.id} for index, d in deployments]
+    return jsonify({"created": created, "errors": errors}), 201 if not errors else 200
+
+
+@app.route("/tenants/<string:tenant_id>/deployments/bulk", methods=["PUT"])
+@require_token
+def bulk_update_deployments(tenant_id):
+    """
+    Update many deployments in one transaction. Each item has the deployment
+    "id" plus the fields to change. Items with the same changes are applied
+    with one UPDATE ... WHERE id IN (...) rather than loading each deployment.
+    Invalid items are reported by index in "errors", and with "atomic" set
+    nothing is updated if any item is invalid.
+    """
+    data = request.get_json()
+    items = data.get("deployments") if data else None
+    if not isinstance(items, list):
+        abort(400, "deployments must be a list")
+
+    ids = {str(i.get("id")) for i in items if isinstance(i, dict)}
+    owned = dict(
+        db_session.query(Deployment.id, Deployment.integration_id)
+        .filter(Deployment.tenant_id == tenant_id, Deployment.id.in_([int(i) for i in ids if i.isdigit()]))
+        .all()
+    )
+    integrations = {
+        i.id: i for i in db_session.query(Integration).filter(Integration.id.in_(set(owned.values())))
+    }
+
+    groups, errors = {}, []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or "id" not in item:
+                raise ValueError("Missing deployment id")
+            deployment_id = int(item["id"]) if str(item["id"]).isdigit() else None
+            if deployment_id not in owned:
+                raise ValueError("Deployment not found")
+            changes = {k: v for k, v in item.items() if k != "id"}
+            unknown = set(changes) - set(Deployment.UPDATABLE_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown fields: {sorted(unknown)}")
+            if not changes:
+                raise ValueError("Nothing to update")
+            Deployment.validate_fields(changes)
+            if "config" in changes:
+                integrations[owned[deployment_id]].validate_config(changes["config"])
+            if "schedule" in changes:
+                Deployment.validate_schedule(changes["schedule"])
+
+            key = json.dumps(changes, sort_keys=True)
+            groups.setdefault(key, (changes, []))[1].append(deployment_id)
+        except ValidationError as e:
+            errors.append({"index": index, "id": item.get("id"), "error": f"Invalid config: {e.message}"})
+        except ValueError as e:
+            errors.append({"index": index, "id": item.get("id") if isinstance(item, dict) else None, "error": str(e)})
+
+    if errors and data.get("atomic"):
+        return jsonify({"updated": [], "errors": errors}), 400
+
+    updated = []
+    try:
+        for changes, deployment_ids in groups.values():
+            values = dict(changes)
+            if "config" in changes:
+                # As in update_deployment, new config closes the circuit breaker
+                values.update(consecutive_failures=0, breaker_until=None)
+            db_session.execute(
+                update(Deployment)
+                .where(Deployment.tenant_id == tenant_id, Deployment.id.in_(deployment_ids))
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            updated.extend(deployment_ids)
+        db_session.commit()
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"updated": sorted(set(updated)), "errors": errors}), 200
+
+
 @app.route("/tenants/<string:tenant_id>/deployments", methods=["GET"])
 @require_token
 def list_deployments(tenant_id):
@@ -195,6 +372,20 @@ def get_deployment(tenant_id, id):
     return jsonify(deployment.as_dict())
 
 
+@app.route("/tenants/<string:tenant_id>/deployments/<string:id>/breaker/reset", methods=["POST"])
+@require_token
+def reset_deployment_breaker(tenant_id, id):
+    """Close the circuit breaker of a failing or paused deployment, so it runs on schedule again."""
+    deployment = db_session.query(Deployment).filter_by(
+        id=id, tenant_id=tenant_id
+    ).first()
+    if not deployment:
+        return jsonify({"error": "Deployment not found"}), 404
+    deployment.reset_breaker()
+    db_session.commit()
+    return jsonify(deployment.as_dict())
+
+
 @app.route("/tenants/<string:tenant_id>/deployments/<string:id>", methods=["DELETE"])
 @require_token
 def delete_deployment(tenant_id, id):
@@ -215,8 +406,15 @@ def list_violations_for_deployment(tenant_id, id):
         id=id, tenant_id=tenant_id
     ).first()
     if not deployment:
-        return jsonify([])
-    return jsonify(deployment.list_violations())
+        return jsonify({"error": "Deployment not found"}), 404
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 100)
+    latest = request.args.get("latest", "false").lower() == "true"
+    summary = request.args.get("summary", "false").lower() == "true"
+    return jsonify(deployment.list_violations(
+        db_session, page=page, per_page=per_page, latest=latest, summary=summary
+    ))
 
 
 # -------------------------
@@ -283,6 +481,84 @@ def get_job(tenant_id, job_id):
     return jsonify(job.as_dict())
 
 
+@app.route("/tenants/<string:tenant_id>/jobs/<string:job_id>/cancel", methods=["POST"])
+@require_token
+def cancel_job(tenant_id, job_id):
+    job = (
+        db_session.query(Job)
+        .join(Job.deployment)
+        .filter(Job.id == job_id, Deployment.tenant_id == tenant_id)
+        .with_for_update(of=Job)
+        .first()
+    )
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if not job.cancel():
+        db_session.rollback()
+        return jsonify({"error": f"Job already finished with status '{job.status}'"}), 409
+    db_session.commit()
+    return jsonify(job.as_dict()), 200
+
+
+@app.route("/tenants/<string:tenant_id>/deployments/<string:id>/jobs/cancel", methods=["POST"])
+@require_token
+def cancel_deployment_jobs(tenant_id, id):
+    """Cancel all queued and running jobs of a deployment."""
+    deployment = db_session.query(Deployment).filter_by(id=id, tenant_id=tenant_id).first()
+    if not deployment:
+        return jsonify({"error": "Deployment not found"}), 404
+
+    try:
+        jobs = (
+            db_session.query(Job)
+            .filter(Job.deployment_id == deployment.id, Job.status.in_(["queued", "in-progress"]))
+            .with_for_update()
+            .all()
+        )
+        cancelled, cancelling = [], []
+        for job in jobs:
+            job.cancel()
+            (cancelled if job.status == "cancelled" else cancelling).append(job.id)
+        db_session.commit()
+        return jsonify({"cancelled": cancelled, "cancelling": cancelling}), 200
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/tenants/<string:tenant_id>/jobs/<string:job_id>/artifacts", methods=["GET"])
+@require_token
+def list_job_artifacts(tenant_id, job_id):
+    artifacts = (
+        db_session.query(Artifact)
+        .join(Artifact.job)
+        .join(Job.deployment)
+        .filter(Artifact.job_id == job_id, Deployment.tenant_id == tenant_id)
+        .order_by(Artifact.id)
+        .all()
+    )
+    return jsonify([a.as_dict() for a in artifacts])
+
+
+@app.route("/tenants/<string:tenant_id>/jobs/<string:job_id>/artifacts/<int:artifact_id>", methods=["GET"])
+@require_token
+def download_job_artifact(tenant_id, job_id, artifact_id):
+    artifact = (
+        db_session.query(Artifact)
+        .join(Artifact.job)
+        .join(Job.deployment)
+        .filter(Artifact.id == artifact_id, Artifact.job_id == job_id, Deployment.tenant_id == tenant_id)
+        .first()
+    )
+    if not artifact:
+        return jsonify({"error": "Artifact not found"}), 404
+    return Response(
+        artifact.data,
+        mimetype=artifact.content_type,
+        headers={"Content-Disposition": f'attachment; filename="{artifact.name}"'}
+    )
+
+
 # -------------------------
 # Violation Endpoints
 # -------------------------
@@ -300,6 +576,136 @@ def list_violations(tenant_id):
     return jsonify([i.as_dict() for i in violations])
 
 
+def encode_cursor(violation) -> str:
+    key = json.dumps([violation.timestamp.isoformat(), violation.id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Return (timestamp, id) from a cursor, or raise ValueError if it isn't one."""
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(key, list) and len(key) == 2 and isinstance(key[0], str) and isinstance(key[1], int)):
+        raise ValueError("malformed cursor")
+    return datetime.fromisoformat(key[0]), key[1]
+
+
+@app.route("/tenants/<string:tenant_id>/violations/search", methods=["GET"])
+@require_token
+def search_violations(tenant_id):
+    """
+    Filter a tenant's violations, newest first, with keyset pagination.
+
+    Query params (all optional, list params are comma separated):
+        severity, violation_type, environment, task_name, integration: lists
+        since, until: ISO timestamps, since inclusive, until exclusive
+        framework, control: control reference, e.g. framework=SOC2&control=CC6.1
+        limit: page size, default 50, between 1 and 500
+        cursor: next_cursor from the previous page
+    """
+    def values(name):
+        value = request.args.get(name)
+        return [v for v in value.split(",") if v] if value else None
+
+    limit = max(1, min(request.args.get("limit", 50, type=int), 500))
+    query = (
+        db_session.query(Violation)
+        .join(Violation.job)
+        .join(Job.deployment)
+        .join(Deployment.integration)
+        .filter(Deployment.tenant_id == tenant_id)
+        .options(contains_eager(Violation.job).contains_eager(Job.deployment).contains_eager(Deployment.integration))
+    )
+
+    for name, column in [
+        ("severity", Violation.severity),
+        ("violation_type", Violation.violation_type),
+        ("environment", Violation.environment),
+        ("task_name", Violation.task_name),
+        ("integration", Integration.name),
+    ]:
+        selected = values(name)
+        if selected:
+            query = query.filter(column.in_(selected))
+
+    try:
+        if request.args.get("since"):
+            query = query.filter(Violation.timestamp >= datetime.fromisoformat(request.args["since"]))
+        if request.args.get("until"):
+            query = query.filter(Violation.timestamp < datetime.fromisoformat(request.args["until"]))
+        if request.args.get("cursor"):
+            timestamp, violation_id = decode_cursor(request.args["cursor"])
+            query = query.filter(tuple_(Violation.timestamp, Violation.id) < (timestamp, violation_id))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid since, until or cursor: {e}"}), 400
+
+    control = {}
+    if request.args.get("framework"):
+        control["framework"] = request.args["framework"]
+    if request.args.get("control"):
+        control["id"] = request.args["control"]
+    if control:
+        # jsonb @> uses the GIN index on control_references
+        query = query.filter(Violation.control_references.contains([control]))
+
+    violations = query.order_by(Violation.timestamp.desc(), Violation.id.desc()).limit(limit + 1).all()
+    page, more = violations[:limit], len(violations) > limit
+    return jsonify({
+        "violations": [v.as_dict() for v in page],
+        "next_cursor": encode_cursor(page[-1]) if more else None,
+    })
+
+
+# -------------------------
+# Concurrency Limit Endpoints
+# -------------------------
+
+@app.route("/concurrency-limits", methods=["GET"])
+@require_token
+def list_concurrency_limits():
+    limits = db_session.query(ConcurrencyLimit).order_by(ConcurrencyLimit.id).all()
+    return jsonify([limit.as_dict() for limit in limits])
+
+
+@app.route("/concurrency-limits", methods=["PUT"])
+@require_token
+def set_concurrency_limit():
+    """Create or update the limit for an integration, a tenant, or both."""
+    data = request.get_json()
+    integration_id = data.get("integration_id")
+    tenant_id = data.get("tenant_id")
+    max_running = data.get("max_running")
+    if integration_id is None and tenant_id is None:
+        abort(400, "Set integration_id, tenant_id or both")
+    if type(max_running) is not int or max_running < 0:
+        abort(400, "max_running must be a non-negative integer")
+    if integration_id is not None and type(integration_id) is not int:
+        abort(400, "integration_id must be an integer")
+    if tenant_id is not None and not isinstance(tenant_id, str):
+        abort(400, "tenant_id must be a string")
+    if integration_id is not None and not db_session.get(Integration, integration_id):
+        abort(404, "Integration not found")
+
+    limit = ConcurrencyLimit.upsert(db_session, integration_id, tenant_id, max_running)
+
+    try:
+        db_session.commit()
+        return jsonify(limit.as_dict()), 200
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/concurrency-limits/<int:limit_id>", methods=["DELETE"])
+@require_token
+def delete_concurrency_limit(limit_id):
+    limit = db_session.get(ConcurrencyLimit, limit_id)
+    if not limit:
+        return jsonify({"error": "Concurrency limit not found"}), 404
+    db_session.delete(limit)
+    db_session.commit()
+    return jsonify({"message": "Concurrency limit deleted"}), 200
+
+
 # -------------------------
 # Internal / Worker Endpoints (no tenant scope)
 # -------------------------
@@ -312,6 +718,20 @@ def get_scheduled_deployments():
     return jsonify([d.as_dict() for d in deployments])
 
 
+@app.route("/api/queues/scaling", methods=["GET"])
+def get_queue_scaling():
+    """
+    Backlog and desired worker count per queue. Polled by the scheduler for
+    backpressure, and meant for an autoscaler to size the workers of each queue.
+    """
+    stats = Job.queue_stats(db_session)
+    for stat in stats:
+        QUEUE_DEPTH.labels(stat["queue"]).set(stat["queued"])
+        QUEUE_OLDEST.labels(stat["queue"]).set(stat["oldest_queued_seconds"])
+        QUEUE_DESIRED_WORKERS.labels(stat["queue"]).set(stat["desired_workers"])
+    return jsonify(stats)
+
+
 @app.route("/jobs", methods=["POST"])
 def create_job():
     data = request.json
@@ -320,10 +740,12 @@ def create_job():
     deployment = db_session.get(Deployment, data["deployment_id"])
     if not deployment:
         abort(404, "Deployment not found")
-    job = deployment.create_job()
+    # The scheduler starts the trace, otherwise a new one starts here
+    job = deployment.create_job(trace_id=request.headers.get("X-Trace-Id"))
     db_session.add(job)
     db_session.commit()
-    return jsonify({"id": job.id}), 201
+    logger.info(f"[trace {job.trace_id}] Queued job {job.id} for deployment {deployment.id}")
+    return jsonify({"id": job.id, "trace_id": job.trace_id}), 201
 
 
 @app.route("/jobs/<int:job_id>", methods=["GET"])
@@ -334,24 +756,48 @@ def get_job_internal(job_id):
     return jsonify({"error": "Job not found"}), 404
 
 
-@app.route("/jobs/next", methods=["GET"])
+@app.route("/jobs/next", methods=["GET", "POST"])
 def get_next_job():
-    queue = request.args.get("queue", "default")
+    """
+    Claim the next job on a queue. Workers POST {"queue", "worker_id",
+    "integrations"}, with integrations the list of names they can run right
+    now, since a release can list more of them than fit in a URL. GET with the
+    same query parameters, integrations comma separated, is still accepted.
+    Without integrations any job on the queue may be claimed.
+    """
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        integrations = data.get("integrations")
+        if integrations is not None and (
+            not isinstance(integrations, list) or not all(isinstance(name, str) for name in integrations)
+        ):
+            return jsonify({"error": "integrations must be a list of names"}), 400
+    else:
+        data = request.args
+        integrations = data.get("integrations")
+        if integrations is not None:
+            integrations = [name for name in integrations.split(",") if name]
+    queue = data.get("queue") or "default"
+    worker_id = data.get("worker_id")
     session = db_session()
     try:
-        job = (
-            session.query(Job)
-            .join(Job.deployment)
-            .filter(Job.status == "queued")
-            .filter(Deployment.queue == queue)
-            .with_for_update(skip_locked=True)
-            .first()
-        )
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        job = Job.next_queued(session, queue, integrations)
+        claim_seconds = time.perf_counter() - started
+        CLAIM_LATENCY.labels(queue).observe(claim_seconds)
+        CLAIMS.labels(queue, "claimed" if job else "empty").inc()
         if job:
-            job.status = "in-progress"
-            job.started_at = datetime.utcnow()
+            job.claim(worker_id)
+            job.add_spans({
+                "name": "claim",
+                "service": "api",
+                "start": started_at.isoformat(),
+                "duration_ms": round(claim_seconds * 1000, 1),
+            })
             session.commit()
-            return jsonify(job.as_dict()), 200
+            logger.info(f"[trace {job.trace_id}] Job {job.id} claimed by {worker_id}")
+            return jsonify(job.as_dict()), 200, {"X-Trace-Id": job.trace_id or ""}
         return jsonify({"message": "No jobs available"}), 204
     except Exception as e:
         session.rollback()
@@ -360,18 +806,107 @@ def get_next_job():
         session.close()
 
 
+def leased_job(job_id, data: dict):
+    """
+    Query for a running job, limited to the claim identified by lease_token (or,
+    from older workers, worker_id) when given.
+    """
+    query = db_session.query(Job).filter(Job.id == job_id, Job.status == "in-progress")
+    if data.get("lease_token"):
+        query = query.filter(Job.lease_token == data["lease_token"])
+    elif data.get("worker_id"):
+        query = query.filter(Job.worker_id == data["worker_id"])
+    return query
+
+
+@app.route("/jobs/<int:job_id>/heartbeat", methods=["POST"])
+def heartbeat_job(job_id):
+    data = request.get_json(silent=True) or {}
+    job = leased_job(job_id, data).first()
+    if not job:
+        return jsonify({"error": "Job is not leased to this worker"}), 409
+    job.renew_lease()
+    db_session.commit()
+    return jsonify({
+        "lease_expires_at": job.lease_expires_at.isoformat(),
+        "cancel": job.cancel_requested_at is not None
+    }), 200
+
+
 @app.route("/jobs/<int:job_id>/complete", methods=["POST"])
 def complete_job(job_id):
     data = request.json
-    db_session.query(Job).filter(Job.id == job_id).update({
-        Job.status: data.get("status", "done"),
-        Job.result: data.get("result", {}),
-        Job.finished_at: datetime.utcnow()
-    })
+    # A worker whose lease expired must not overwrite the job after it was
+    # requeued, and a result posted twice must not be recorded twice
+    job = leased_job(job_id, data).with_for_update().first()
+    if not job:
+        db_session.rollback()
+        return jsonify({"error": "Job is not leased to this worker"}), 409
+
+    status = data.get("status", "done")
+    job.metrics = data.get("metrics")
+    if data.get("spans"):
+        job.add_spans(*data["spans"])
+    retryable = status == "error" and data.get("transient") and not job.cancel_requested_at
+    if retryable and job.retry(data.get("result", {})):
+        db_session.commit()
+        logger.info(f"[trace {job.trace_id}] Job {job.id} failed with a transient error, retrying after {job.run_after}")
+        return jsonify({"message": "retrying", "run_after": job.run_after.isoformat()}), 200
+
+    job.finish(status, data.get("result", {}), session=db_session)
+    # Lock the deployment so concurrent runs don't lose a failure count
+    db_session.refresh(job.deployment, with_for_update=True)
+    job.deployment.record_outcome(job.status)
     db_session.commit()
     return jsonify({"message": "updated"}), 200
 
 
+@app.route("/jobs/<int:job_id>/artifacts", methods=["POST"])
+def upload_job_artifact(job_id):
+    """Store a file produced by a job run, e.g. the profile of a profiled job. Used by workers."""
+    job = db_session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    upload = request.files.get("file")
+    if not upload:
+        abort(400, "Missing file")
+
+    artifact = Artifact(
+        job_id=job.id,
+        name=upload.filename or "artifact",
+        content_type=upload.mimetype or "application/octet-stream",
+        data=upload.read()
+    )
+    db_session.add(artifact)
+    db_session.commit()
+    return jsonify(artifact.as_dict()), 201
+
+
+@app.route("/api/jobs/reap", methods=["POST"])
+def reap_expired_jobs():
+    """Requeue or fail in-progress jobs whose lease expired. Called by the scheduler."""
+    try:
+        jobs = (
+            db_session.query(Job)
+            .filter(Job.status == "in-progress")
+            .filter(Job.lease_expires_at < datetime.utcnow())
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        requeued, failed = [], []
+        for job in jobs:
+            job.expire_lease()
+            (requeued if job.status == "queued" else failed).append(job.id)
+            if job.status != "queued":
+                db_session.refresh(job.deployment, with_for_update=True)
+                job.deployment.record_outcome(job.status)
+        db_session.commit()
+        return jsonify({"requeued": requeued, "failed": failed}), 200
+    except Exception as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/jobs/<string:job_id>/violations", methods=["POST"])
 def create_violation(job_id):
     data = request.get_json()
@@ -396,8 +931,14 @@ def delete_jobs():
     if after:
         query = query.filter(Job.finished_at >= datetime.fromisoformat(after))
     try:
+        # Runs kept whose result is a patch against a run being deleted get their full result back
+        doomed = query.with_entities(Job.id)
+        for job in db_session.query(Job).filter(Job.result_base_id.in_(doomed), ~Job.id.in_(doomed)):
+            job.materialize_result()
+        db_session.flush()
+
         count = query.count()
-        query.delete()
+        query.delete(synchronize_session=False)
         db_session.commit()
         return jsonify({"deleted": count}), 200
     except Exception as e:
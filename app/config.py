@@ -7,3 +7,29 @@ class Config:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
     GITHUB_RAW_URL = os.getenv(
         "GITHUB_RAW_URL")  # e.g. https://raw.githubusercontent.com/org/repo/main/integrations.json
+    JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))  # renewed by worker heartbeats
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # claims before an expired job is failed
+    RESULT_DELTA = os.getenv("RESULT_DELTA", "false").lower() == "true"  # store results as JSON Patch
+    RESULT_SNAPSHOT_INTERVAL = int(os.getenv("RESULT_SNAPSHOT_INTERVAL", "20"))  # full result every N runs
+    CLAIM_TENANT_CANDIDATES = int(os.getenv("CLAIM_TENANT_CANDIDATES", "5"))  # tenants tried per claim
+
+    # Jobs that fail with a transient error are retried up to JOB_MAX_ATTEMPTS
+    RETRY_BACKOFF_SECONDS = int(os.getenv("RETRY_BACKOFF_SECONDS", "30"))  # doubled on every attempt
+    RETRY_MAX_BACKOFF_SECONDS = int(os.getenv("RETRY_MAX_BACKOFF_SECONDS", "900"))
+
+    # Circuit breaker: after BREAKER_THRESHOLD failed runs in a row a deployment
+    # isn't scheduled for BREAKER_BACKOFF_SECONDS, doubled on every further
+    # failure, and after BREAKER_PAUSE_AFTER failures it's paused until reset
+    BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))  # 0 to disable
+    BREAKER_BACKOFF_SECONDS = int(os.getenv("BREAKER_BACKOFF_SECONDS", "300"))
+    BREAKER_MAX_BACKOFF_SECONDS = int(os.getenv("BREAKER_MAX_BACKOFF_SECONDS", "86400"))
+    BREAKER_PAUSE_AFTER = int(os.getenv("BREAKER_PAUSE_AFTER", "20"))  # 0 to never pause
+
+    # Desired worker count reported by /api/queues/scaling
+    SCALING_WINDOW_SECONDS = int(os.getenv("SCALING_WINDOW_SECONDS", "900"))  # arrival rate and execution time window
+    SCALING_TARGET_WAIT_SECONDS = int(os.getenv("SCALING_TARGET_WAIT_SECONDS", "60"))  # time to drain the backlog in
+    SCALING_TARGET_UTILIZATION = float(os.getenv("SCALING_TARGET_UTILIZATION", "0.8"))  # busy share of slots
+    SCALING_DEFAULT_EXECUTION_SECONDS = float(os.getenv("SCALING_DEFAULT_EXECUTION_SECONDS", "30"))  # before any job finished
+    SCALING_MIN_WORKERS = int(os.getenv("SCALING_MIN_WORKERS", "1"))
+    SCALING_MAX_WORKERS = int(os.getenv("SCALING_MAX_WORKERS", "50"))
+    WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))  # job slots per worker, CONCURRENCY on the worker
@@ -1,11 +1,104 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from models import Base
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 engine = create_engine(os.getenv("DATABASE_URL"))
 db_session = scoped_session(sessionmaker(bind=engine))
 
+# Held while migrating, so API processes starting together don't race
+SCHEMA_LOCK_KEY = 7215001
+
+# Changes to tables that already exist, in the order they were made. create_all
+# only creates missing tables, so a database created by an older version gets
+# new columns and indexes from here. Each migration runs once and is recorded in
+# schema_migrations; add new ones at the end and never edit an applied one.
+MIGRATIONS = [
+    ("job_leases", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS worker_id VARCHAR",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS lease_token VARCHAR",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0",
+    ]),
+    ("tenant_fair_claims", [
+        "ALTER TABLE deployments ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_status_created_at ON jobs (status, created_at)",
+    ]),
+    ("job_metrics_and_profiling", [
+        "ALTER TABLE deployments ADD COLUMN IF NOT EXISTS profile BOOLEAN DEFAULT false",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS metrics JSON",
+    ]),
+    ("job_tracing", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS trace_id VARCHAR",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS spans JSON",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_trace_id ON jobs (trace_id)",
+    ]),
+    ("result_patches", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS result_base_id INTEGER REFERENCES jobs (id)",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS result_depth INTEGER DEFAULT 0",
+    ]),
+    ("job_cancellation", [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS cancel_requested_at TIMESTAMP WITHOUT TIME ZONE",
+    ]),
+    ("violation_search", [
+        "ALTER TABLE violations ALTER COLUMN control_references TYPE jsonb USING control_references::jsonb",
+        "ALTER TABLE violations ALTER COLUMN output TYPE jsonb USING output::jsonb",
+        "ALTER TABLE violations ALTER COLUMN meta TYPE jsonb USING meta::jsonb",
+        "CREATE INDEX IF NOT EXISTS ix_deployments_tenant_id ON deployments (tenant_id)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_job_id ON violations (job_id)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_timestamp_id ON violations (timestamp, id)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_severity_timestamp ON violations (severity, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_task_name ON violations (task_name)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_violation_type ON violations (violation_type)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_environment ON violations (environment)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_control_references ON violations USING gin (control_references jsonb_path_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_violations_meta ON violations USING gin (meta)",
+    ]),
+    ("violation_history", [
+        "CREATE INDEX IF NOT EXISTS ix_jobs_deployment_id_recent_at ON jobs (deployment_id, coalesce(finished_at, created_at))",
+    ]),
+    ("retries_and_breaker", [
+        "ALTER TABLE deployments ADD COLUMN IF NOT EXISTS consecutive_failures INTEGER DEFAULT 0",
+        "ALTER TABLE deployments ADD COLUMN IF NOT EXISTS breaker_until TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_after TIMESTAMP WITHOUT TIME ZONE",
+    ]),
+    ("claim_ranking_indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_jobs_queued_deployment_id_created_at ON jobs (deployment_id, created_at) WHERE status = 'queued'",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_in_progress_deployment_id ON jobs (deployment_id) WHERE status = 'in-progress'",
+    ]),
+    ("concurrency_limit_key", [
+        "DELETE FROM concurrency_limits a USING concurrency_limits b WHERE a.id < b.id AND coalesce(a.integration_id, 0) = coalesce(b.integration_id, 0) AND coalesce(a.tenant_id, '') = coalesce(b.tenant_id, '')",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_concurrency_limits_key ON concurrency_limits (coalesce(integration_id, 0), coalesce(tenant_id, ''))",
+    ]),
+]
+
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        fresh = not inspect(conn).has_table("jobs")
+        Base.metadata.create_all(bind=conn)
+        migrate(conn, fresh)
+
+
+def migrate(conn, fresh: bool = False):
+    """
+    Apply the migrations this database hasn't had yet. On a fresh database
+    create_all already built the current schema, so they are only recorded.
+    """
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "name VARCHAR PRIMARY KEY, applied_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now())"
+    ))
+    applied = set(conn.execute(text("SELECT name FROM schema_migrations")).scalars())
+    for name, statements in MIGRATIONS:
+        if name in applied:
+            continue
+        if not fresh:
+            for statement in statements:
+                conn.execute(text(statement))
+            logger.info(f"Applied migration {name}")
+        conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
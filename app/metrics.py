@@ -0,0 +1,36 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Exposed by the API on /metrics
+
+REQUEST_LATENCY = Histogram(
+    "api_request_duration_seconds",
+    "API request latency",
+    ["method", "endpoint", "status"],
+)
+
+CLAIM_LATENCY = Histogram(
+    "api_job_claim_duration_seconds",
+    "Time to find and lock the next job in /jobs/next",
+    ["queue"],
+)
+
+CLAIMS = Counter(
+    "api_job_claims_total",
+    "Claim attempts by outcome (claimed or empty)",
+    ["queue", "outcome"],
+)
+
+CLAIM_CONTENTION = Counter(
+    "api_job_claim_contention_total",
+    "Claim retries because a tenant's jobs were all locked by concurrent claims, "
+    "or a concurrency limit filled up during the claim",
+    ["queue", "reason"],
+)
+
+QUEUE_DEPTH = Gauge("api_queue_depth", "Queued jobs per queue", ["queue"])
+QUEUE_OLDEST = Gauge("api_queue_oldest_seconds", "Age of the oldest queued job per queue", ["queue"])
+QUEUE_DESIRED_WORKERS = Gauge(
+    "api_queue_desired_workers",
+    "Workers needed per queue, as last computed by /api/queues/scaling",
+    ["queue"],
+)
@@ -7,13 +7,25 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     JSON,
+    LargeBinary,
+    Index,
+    func,
+    tuple_,
+    text,
 )
-from sqlalchemy.orm import relationship, declarative_base
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import relationship, declarative_base, selectinload
+from datetime import datetime, timedelta
+import uuid
 from jsonschema import validate
 from croniter import croniter, CroniterBadCronError
 from config import Config
+from metrics import CLAIM_CONTENTION
+from utils import jsonpatch
 import requests
+import json
+import math
+import random
 
 
 
@@ -48,15 +60,12 @@ class Integration(Base):
         schedule: str = None,
         queue: str = "default",
         timeout: int = 3600,
-        tenant_id: str = None
+        tenant_id: str = None,
+        priority: int = 0,
+        profile: bool = False
     ):
         self.validate_config(config)
-
-        if schedule:
-            try:
-                croniter(schedule)
-            except CroniterBadCronError:
-                raise ValueError("Invalid cron expression for schedule")
+        Deployment.validate_schedule(schedule)
 
         return Deployment(
             integration_id=self.id,
@@ -64,6 +73,8 @@ class Integration(Base):
             schedule=schedule,
             timeout=timeout,
             queue=queue,
+            priority=priority,
+            profile=profile,
             status="scheduled",
             tenant_id=tenant_id
         )
@@ -95,10 +106,16 @@ class Deployment(Base):
     version = Column(Integer, default=1)
     status = Column(String, default="scheduled")
     queue = Column(String, default="default")
+    priority = Column(Integer, default=0)  # higher runs first within a tenant
+    profile = Column(Boolean, default=False)  # run jobs under cProfile and keep the stats as an artifact
 
     last_scheduled_at = Column(DateTime, nullable=True)
     project_ids = Column(String, default="")
 
+    # Circuit breaker, see breaker_state
+    consecutive_failures = Column(Integer, default=0)
+    breaker_until = Column(DateTime, nullable=True)  # not scheduled before this
+
     jobs = relationship(
         "Job",
         backref="deployment",
@@ -108,21 +125,88 @@ class Deployment(Base):
     integration_id = Column(
         Integer, ForeignKey("integrations.id", ondelete="CASCADE"), nullable=False
     )
-    tenant_id = Column(String, nullable=False)
+    tenant_id = Column(String, nullable=False, index=True)
+
+    # Fields a tenant may change with update_deployment or a bulk update, and their JSON types
+    UPDATABLE_FIELDS = ["config", "enabled", "schedule", "queue", "timeout", "priority", "profile"]
+    FIELD_TYPES = {
+        "config": (dict,),
+        "enabled": (bool,),
+        "schedule": (str, type(None)),
+        "queue": (str,),
+        "timeout": (int,),
+        "priority": (int,),
+        "profile": (bool,),
+    }
+
+    @classmethod
+    def validate_fields(cls, fields: dict):
+        """Raise ValueError if a field has the wrong JSON type, before it reaches the database."""
+        for name, value in fields.items():
+            types = cls.FIELD_TYPES.get(name)
+            # bool is an int in Python, but true isn't a timeout
+            if types and (not isinstance(value, types) or (isinstance(value, bool) and bool not in types)):
+                expected = " or ".join("null" if t is type(None) else t.__name__ for t in types)
+                raise ValueError(f"{name} must be {expected}")
+
+    @staticmethod
+    def validate_schedule(schedule: str):
+        if schedule:
+            try:
+                croniter(schedule)
+            except CroniterBadCronError:
+                raise ValueError("Invalid cron expression for schedule")
 
     def as_dict(self):
         data = {c.name: getattr(self, c.name) for c in self.__table__.columns}
         if self.last_scheduled_at:
             data["last_scheduled_at"] = self.last_scheduled_at.isoformat()
+        if self.breaker_until:
+            data["breaker_until"] = self.breaker_until.isoformat()
+        data["breaker_state"] = self.breaker_state
         data["integration_name"] = self.integration.name if self.integration else None
         data["is_service"] = self.integration.is_service
         return data
 
-    def create_job(self):
+    @property
+    def breaker_state(self):
+        """
+        closed: runs on schedule. open: failing, not scheduled until breaker_until.
+        half-open: breaker_until passed, the next run decides. paused: not
+        scheduled until the breaker is reset or the config changes.
+        """
+        failures = self.consecutive_failures or 0
+        if not Config.BREAKER_THRESHOLD or failures < Config.BREAKER_THRESHOLD:
+            return "closed"
+        if Config.BREAKER_PAUSE_AFTER and failures >= Config.BREAKER_PAUSE_AFTER:
+            return "paused"
+        if self.breaker_until and self.breaker_until > datetime.utcnow():
+            return "open"
+        return "half-open"
+
+    def record_outcome(self, status: str):
+        """Count a finished run towards the circuit breaker. Cancelled runs don't count."""
+        if status == "done":
+            self.reset_breaker()
+        elif status == "error":
+            self.consecutive_failures = (self.consecutive_failures or 0) + 1
+            if Config.BREAKER_THRESHOLD and self.consecutive_failures >= Config.BREAKER_THRESHOLD:
+                backoff = min(
+                    Config.BREAKER_BACKOFF_SECONDS * 2 ** (self.consecutive_failures - Config.BREAKER_THRESHOLD),
+                    Config.BREAKER_MAX_BACKOFF_SECONDS,
+                )
+                self.breaker_until = datetime.utcnow() + timedelta(seconds=backoff)
+
+    def reset_breaker(self):
+        self.consecutive_failures = 0
+        self.breaker_until = None
+
+    def create_job(self, trace_id: str = None):
         self.last_scheduled_at = datetime.utcnow()
         return Job(
             deployment_id=self.id,
             status="queued",
+            trace_id=trace_id or uuid.uuid4().hex,
         )
 
     def get_project_ids(self):
@@ -145,41 +229,246 @@ class Deployment(Base):
     def set_project_id_list(self, project_ids):
         self.set_project_ids(list(set(project_ids)))  # dedupe on the way in
 
-    def list_violations(self):
-        jobs = sorted(
-            self.jobs,
-            key=lambda j: j.finished_at or j.created_at or datetime.min,
-            reverse=True
-        )
-
-        return [
-            {
+    def list_violations(self, session, page=1, per_page=20, latest=False, summary=False):
+        """
+        Violations grouped by job, most recent run first, one page of jobs at a
+        time. With latest, only the last completed run. With summary, violation
+        counts by severity per run instead of the violations themselves.
+        """
+        if latest:
+            query = session.query(Job).filter(Job.id.in_(Job.latest_completed(session, [self.id])))
+        else:
+            query = session.query(Job).filter(Job.deployment_id == self.id)
+
+        total = query.count()
+        query = query.order_by(Job.recent_at().desc(), Job.id.desc())
+        if not summary:
+            query = query.options(selectinload(Job.violations))
+        jobs = query.limit(per_page).offset((page - 1) * per_page).all()
+
+        counts = {}
+        if summary and jobs:
+            rows = (
+                session.query(Violation.job_id, Violation.severity, func.count(Violation.id))
+                .filter(Violation.job_id.in_([job.id for job in jobs]))
+                .group_by(Violation.job_id, Violation.severity)
+                .all()
+            )
+            for job_id, severity, count in rows:
+                counts.setdefault(job_id, {})[severity] = count
+
+        runs = []
+        for job in jobs:
+            run = {
                 "job_id": job.id,
                 "status": job.status,
                 "created_at": job.created_at.isoformat() if job.created_at else None,
                 "finished_at": job.finished_at.isoformat() if job.finished_at else None,
-                "violations": [v.as_dict() for v in job.violations]
             }
-            for job in jobs
+            if summary:
+                run["severity_counts"] = counts.get(job.id, {})
+                run["total"] = sum(run["severity_counts"].values())
+            else:
+                run["violations"] = [v.as_dict() for v in job.violations]
+            runs.append(run)
+
+        return {
+            "jobs": runs,
+            "pagination": {
+                "page": page,
+                "per_page": per_page,
+                "total": total,
+                "pages": (total + per_page - 1) // per_page
+            }
+        }
+
+
+class ConcurrencyLimit(Base):
+    """
+    Cap on jobs in progress at once for an integration, a tenant, or an
+    integration within a tenant. Leave integration_id or tenant_id empty to
+    apply the limit across all of them.
+    """
+    __tablename__ = "concurrency_limits"
+
+    id = Column(Integer, primary_key=True)
+    integration_id = Column(
+        Integer, ForeignKey("integrations.id", ondelete="CASCADE"), nullable=True
+    )
+    tenant_id = Column(String, nullable=True)
+    max_running = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # One limit per key. NULLs are coalesced, since a unique constraint
+        # lets rows with a NULL integration_id or tenant_id repeat
+        Index(
+            "uq_concurrency_limits_key",
+            func.coalesce(integration_id, 0),
+            func.coalesce(tenant_id, ""),
+            unique=True,
+        ),
+    )
+
+    @property
+    def key(self):
+        return (self.integration_id, self.tenant_id)
+
+    @classmethod
+    def upsert(cls, session, integration_id, tenant_id, max_running: int):
+        """Create the limit for a key, or update its max_running if it exists, in one statement."""
+        index = next(i for i in cls.__table__.indexes if i.name == "uq_concurrency_limits_key")
+        statement = (
+            insert(cls)
+            .values(integration_id=integration_id, tenant_id=tenant_id, max_running=max_running)
+            .on_conflict_do_update(index_elements=list(index.expressions), set_={"max_running": max_running})
+            .returning(cls.id)
+        )
+        limit_id = session.execute(statement).scalar_one()
+        return session.get(cls, limit_id, populate_existing=True)
+
+    def as_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+    @staticmethod
+    def running_counts(session, *criteria) -> dict:
+        """
+        Jobs in progress per limit key: (integration_id, None),
+        (None, tenant_id) and (integration_id, tenant_id).
+        """
+        rows = (
+            session.query(Deployment.integration_id, Deployment.tenant_id, func.count(Job.id))
+            .join(Job.deployment)
+            .filter(Job.status == "in-progress", *criteria)
+            .group_by(Deployment.integration_id, Deployment.tenant_id)
+            .all()
+        )
+        counts = {}
+        for integration_id, tenant_id, count in rows:
+            for key in [(integration_id, None), (None, tenant_id), (integration_id, tenant_id)]:
+                counts[key] = counts.get(key, 0) + count
+        return counts
+
+    @classmethod
+    def saturated(cls, session, limits: dict) -> set:
+        """Keys of the limits that are currently full."""
+        if not limits:
+            return set()
+        counts = cls.running_counts(session)
+        return {key for key, limit in limits.items() if counts.get(key, 0) >= limit.max_running}
+
+    @classmethod
+    def full_limit_for(cls, session, limits: dict, deployment):
+        """
+        Lock the limits that apply to a deployment and recount under the lock.
+        Returns the key of a limit that is full, or None if a job may be claimed.
+        The row locks are held until commit, so concurrent claims against the
+        same limit are serialized and can't both take the last slot.
+        """
+        keys = [
+            (deployment.integration_id, None),
+            (None, deployment.tenant_id),
+            (deployment.integration_id, deployment.tenant_id),
         ]
+        ids = [limits[key].id for key in keys if key in limits]
+        if not ids:
+            return None
+
+        locked = (
+            session.query(cls)
+            .filter(cls.id.in_(ids))
+            .order_by(cls.id)  # consistent lock order, no deadlocks between claims
+            .with_for_update()
+            .all()
+        )
+        counts = cls.running_counts(
+            session,
+            (Deployment.integration_id == deployment.integration_id)
+            | (Deployment.tenant_id == deployment.tenant_id)
+        )
+        for limit in locked:
+            if counts.get(limit.key, 0) >= limit.max_running:
+                return limit.key
+        return None
 
 
 class Job(Base):
     __tablename__ = "jobs"
 
     id = Column(Integer, primary_key=True)
-    status = Column(String, default="queued")  # queued, in-progress, done, error
+    status = Column(String, default="queued")  # queued, in-progress, done, error, cancelled
     result = Column(JSON, default=None)
     created_at = Column(DateTime, default=datetime.utcnow)
     started_at = Column(DateTime, nullable=True)
     finished_at = Column(DateTime, nullable=True)
 
+    # Lease held by the worker running the job, renewed by heartbeats
+    worker_id = Column(String, nullable=True)
+    lease_token = Column(String, nullable=True)  # new on every claim, so a stale slot can't touch a re-claimed job
+    lease_expires_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    cancel_requested_at = Column(DateTime, nullable=True)  # worker is told on its next heartbeat
+    run_after = Column(DateTime, nullable=True)  # a retried job isn't claimed before this
+
+    # Resource usage reported by the worker: wall/cpu seconds, peak RSS,
+    # import/run/post phase seconds and task count
+    metrics = Column(JSON, nullable=True)
+
+    # With RESULT_DELTA, result may hold a JSON Patch against the full result of
+    # the deployment's previous run (result_base_id) instead of the full result.
+    # result_depth counts the patches back to a full snapshot, 0 for a full result.
+    result_base_id = Column(Integer, ForeignKey("jobs.id"), nullable=True)
+    result_depth = Column(Integer, default=0)
+    result_base = relationship("Job", remote_side=[id])
+
+    # Trace id shared by the scheduler, API and worker log lines for this job,
+    # and the spans recorded along the way ({name, service, start, duration_ms})
+    trace_id = Column(String, index=True, nullable=True)
+    spans = Column(JSON, default=list)
+
     deployment_id = Column(
         Integer,
         ForeignKey("deployments.id", ondelete="CASCADE"),
-        nullable=False
+        nullable=False,
+        index=True
     )
 
+    __table_args__ = (
+        Index("ix_jobs_status_created_at", "status", "created_at"),
+        # Claims read the oldest queued job of each deployment and the running
+        # jobs per tenant, these keep both proportional to deployments and
+        # running jobs rather than to the backlog
+        Index(
+            "ix_jobs_queued_deployment_id_created_at",
+            "deployment_id",
+            "created_at",
+            postgresql_where=text("status = 'queued'"),
+        ),
+        Index("ix_jobs_in_progress_deployment_id", "deployment_id", postgresql_where=text("status = 'in-progress'")),
+        # Deployment run history, most recent first
+        Index("ix_jobs_deployment_id_recent_at", deployment_id, func.coalesce(finished_at, created_at)),
+    )
+
+    @staticmethod
+    def recent_at():
+        """When a job last changed: finished_at, or created_at while unfinished."""
+        return func.coalesce(Job.finished_at, Job.created_at)
+
+    @classmethod
+    def latest_completed(cls, session, deployment_ids):
+        """Subquery of the ids of the last completed job of each deployment."""
+        ranked = (
+            session.query(
+                cls.id.label("id"),
+                func.row_number().over(
+                    partition_by=cls.deployment_id,
+                    order_by=(cls.finished_at.desc(), cls.id.desc()),
+                ).label("rank"),
+            )
+            .filter(cls.deployment_id.in_(deployment_ids), cls.status == "done")
+            .subquery()
+        )
+        return session.query(ranked.c.id).filter(ranked.c.rank == 1)
+
     @property
     def queue(self):
         return self.deployment.queue if self.deployment else "default"
@@ -202,11 +491,326 @@ class Job(Base):
             return int((self.finished_at - self.created_at).total_seconds())
         return None
 
+    @classmethod
+    def queue_stats(cls, session, now: datetime = None):
+        """
+        Backlog, load and desired worker count for each queue.
+
+        Busy slots at steady state follow Little's law: arrival rate times mean
+        execution time, over SCALING_WINDOW_SECONDS. On top of that, the slots
+        needed to work off the current backlog before its oldest job has waited
+        SCALING_TARGET_WAIT_SECONDS (or within a tenth of that if it already has).
+        """
+        now = now or datetime.utcnow()
+        since = now - timedelta(seconds=Config.SCALING_WINDOW_SECONDS)
+        stats = {}
+
+        def entry(name):
+            return stats.setdefault(name, {
+                "queue": name,
+                "queued": 0,
+                "in_progress": 0,
+                "oldest_queued_seconds": 0,
+                "arrival_rate": 0.0,
+                "mean_execution_seconds": None,
+            })
+
+        for (name,) in session.query(Deployment.queue).filter(Deployment.enabled == True).distinct():
+            entry(name)
+
+        rows = (
+            session.query(
+                Deployment.queue, cls.status, func.count(cls.id), func.min(func.coalesce(cls.run_after, cls.created_at))
+            )
+            .join(cls.deployment)
+            .filter(cls.status.in_(["queued", "in-progress"]))
+            .group_by(Deployment.queue, cls.status)
+        )
+        for name, status, count, oldest in rows:
+            if status == "queued":
+                entry(name)["queued"] = count
+                entry(name)["oldest_queued_seconds"] = max(int((now - oldest).total_seconds()), 0)
+            else:
+                entry(name)["in_progress"] = count
+
+        rows = (
+            session.query(Deployment.queue, func.count(cls.id))
+            .join(cls.deployment)
+            .filter(cls.created_at >= since)
+            .group_by(Deployment.queue)
+        )
+        for name, count in rows:
+            entry(name)["arrival_rate"] = round(count / Config.SCALING_WINDOW_SECONDS, 4)
+
+        rows = (
+            session.query(Deployment.queue, func.avg(func.extract("epoch", cls.finished_at - cls.started_at)))
+            .join(cls.deployment)
+            .filter(cls.finished_at >= since, cls.started_at != None)
+            .group_by(Deployment.queue)
+        )
+        for name, seconds in rows:
+            entry(name)["mean_execution_seconds"] = round(float(seconds), 2)
+
+        for stat in stats.values():
+            execution = stat["mean_execution_seconds"] or Config.SCALING_DEFAULT_EXECUTION_SECONDS
+            drain_within = max(
+                Config.SCALING_TARGET_WAIT_SECONDS - stat["oldest_queued_seconds"],
+                Config.SCALING_TARGET_WAIT_SECONDS / 10,
+            )
+            slots = (
+                stat["arrival_rate"] * execution / Config.SCALING_TARGET_UTILIZATION
+                + stat["queued"] * execution / drain_within
+            )
+            workers = math.ceil(slots / Config.WORKER_CONCURRENCY)
+            stat["desired_workers"] = min(max(workers, Config.SCALING_MIN_WORKERS), Config.SCALING_MAX_WORKERS)
+        return sorted(stats.values(), key=lambda s: s["queue"])
+
+    @classmethod
+    def next_queued(cls, session, queue: str, integrations: list = None):
+        """
+        Lock and return the next job to run from a queue, or None.
+
+        Tenants take turns: the tenant with the fewest jobs in progress on the
+        queue goes first, ties broken by whose oldest queued job has waited
+        longest. Within the tenant, higher priority deployments go first, then
+        oldest job. Rows locked by concurrent claims are skipped, and if all of
+        a tenant's jobs are locked the next tenant is tried, until a job is
+        found or no tenant with queued jobs is left.
+
+        Jobs whose integration or tenant is at a ConcurrencyLimit stay queued
+        and are passed over, so they don't hold up other work.
+        """
+        limits = {limit.key: limit for limit in session.query(ConcurrencyLimit).all()}
+        saturated = ConcurrencyLimit.saturated(session, limits)
+        while True:
+            job = cls._next_unsaturated(session, queue, integrations, saturated)
+            if job is None:
+                return None
+            full = ConcurrencyLimit.full_limit_for(session, limits, job.deployment)
+            if full is None:
+                return job
+            # Filled up by a concurrent claim since the counts were taken
+            CLAIM_CONTENTION.labels(queue, "limit").inc()
+            saturated.add(full)
+
+    @classmethod
+    def _next_unsaturated(cls, session, queue: str, integrations: list, saturated: set):
+        ready = (cls.status == "queued") & ((cls.run_after == None) | (cls.run_after <= datetime.utcnow()))
+        deployments = cls._claimable_deployments(session.query(Deployment), queue, integrations, saturated)
+
+        # Oldest ready job of each deployment, an index lookup per deployment
+        oldest = (
+            session.query(cls.created_at)
+            .filter(cls.deployment_id == Deployment.id, ready)
+            .order_by(cls.created_at)
+            .limit(1)
+            .correlate(Deployment)
+            .scalar_subquery()
+        )
+        candidates = deployments.with_entities(Deployment.tenant_id, oldest.label("oldest")).subquery()
+        running = (
+            session.query(Deployment.tenant_id, func.count(cls.id).label("running"))
+            .join(cls.deployment)
+            .filter(cls.status == "in-progress")
+            .filter(Deployment.queue == queue)
+            .group_by(Deployment.tenant_id)
+            .subquery()
+        )
+        ranked = (
+            session.query(candidates.c.tenant_id)
+            .outerjoin(running, running.c.tenant_id == candidates.c.tenant_id)
+            .filter(candidates.c.oldest != None)
+            .group_by(candidates.c.tenant_id, running.c.running)
+            .order_by(func.coalesce(running.c.running, 0), func.min(candidates.c.oldest))
+        )
+        queued = cls._claimable_deployments(
+            session.query(cls).join(cls.deployment).filter(ready), queue, integrations, saturated
+        )
+
+        # Tenants are tried CLAIM_TENANT_CANDIDATES at a time, until one has a
+        # job that isn't locked by a concurrent claim or none are left
+        tried = []
+        while True:
+            page = ranked.filter(~candidates.c.tenant_id.in_(tried)) if tried else ranked
+            tenants = [tenant_id for (tenant_id,) in page.limit(Config.CLAIM_TENANT_CANDIDATES)]
+            if not tenants:
+                return None
+            for tenant_id in tenants:
+                job = (
+                    queued.filter(Deployment.tenant_id == tenant_id)
+                    .order_by(Deployment.priority.desc(), cls.created_at, cls.id)
+                    .with_for_update(of=cls, skip_locked=True)
+                    .first()
+                )
+                if job:
+                    return job
+                CLAIM_CONTENTION.labels(queue, "locked").inc()
+            tried.extend(tenants)
+
+    @staticmethod
+    def _claimable_deployments(query, queue: str, integrations: list, saturated: set):
+        """Limit a query over deployments to the queue, the integrations and what isn't at a limit."""
+        query = query.filter(Deployment.queue == queue)
+        if integrations is not None:
+            query = query.join(Deployment.integration).filter(Integration.name.in_(integrations))
+
+        full_integrations = [i for i, t in saturated if t is None]
+        full_tenants = [t for i, t in saturated if i is None]
+        full_pairs = [(i, t) for i, t in saturated if i is not None and t is not None]
+        if full_integrations:
+            query = query.filter(~Deployment.integration_id.in_(full_integrations))
+        if full_tenants:
+            query = query.filter(~Deployment.tenant_id.in_(full_tenants))
+        if full_pairs:
+            query = query.filter(~tuple_(Deployment.integration_id, Deployment.tenant_id).in_(full_pairs))
+        return query
+
+    def set_result(self, result, session=None):
+        """
+        Store a result. With RESULT_DELTA and a session, a successful result is
+        stored as a JSON Patch against the previous successful run of the same
+        deployment, unless a full snapshot is due (every RESULT_SNAPSHOT_INTERVAL
+        runs) or the patch wouldn't be smaller than the result.
+        """
+        self.result = result
+        self.result_base_id = None
+        self.result_depth = 0
+        self._full_result = result
+        if not (Config.RESULT_DELTA and session is not None and self.status == "done"):
+            return
+
+        previous = (
+            session.query(Job)
+            .filter(
+                Job.deployment_id == self.deployment_id,
+                Job.id != self.id,
+                Job.status == "done",
+                Job.finished_at != None,
+            )
+            .order_by(Job.finished_at.desc(), Job.id.desc())
+            .first()
+        )
+        if not previous or (previous.result_depth or 0) + 1 >= Config.RESULT_SNAPSHOT_INTERVAL:
+            return
+
+        patch = jsonpatch.diff(previous.full_result(), result)
+        if len(json.dumps(patch)) >= len(json.dumps(result)):
+            return
+        self.result = patch
+        self.result_base_id = previous.id
+        self.result_depth = (previous.result_depth or 0) + 1
+
+    def full_result(self):
+        """The job's full result, rebuilt from the last snapshot if it's stored as a patch."""
+        chain = []
+        job = self
+        while job.result_base_id and "_full_result" not in job.__dict__:
+            chain.append(job)
+            job = job.result_base
+        result = job.__dict__.get("_full_result", job.result)
+        for job in reversed(chain):
+            result = jsonpatch.apply(result, job.result)
+            job._full_result = result  # later runs of the deployment in this session reuse it
+        return result
+
+    def materialize_result(self):
+        """Store the full result again, so the job no longer depends on its base run."""
+        if self.result_base_id:
+            self.set_result(self.full_result())
+
+    def add_spans(self, *spans):
+        # Reassign so the JSON column is flagged as changed
+        self.spans = list(self.spans or []) + list(spans)
+
+    def claim(self, worker_id: str = None):
+        now = datetime.utcnow()
+        if self.created_at:
+            self.add_spans({
+                "name": "queue",
+                "service": "api",
+                "start": self.created_at.isoformat(),
+                "duration_ms": round((now - self.created_at).total_seconds() * 1000, 1),
+            })
+        self.status = "in-progress"
+        self.started_at = now
+        self.worker_id = worker_id
+        self.lease_token = uuid.uuid4().hex
+        self.attempts = (self.attempts or 0) + 1
+        self.lease_expires_at = now + timedelta(seconds=Config.JOB_LEASE_SECONDS)
+
+    def renew_lease(self):
+        self.lease_expires_at = datetime.utcnow() + timedelta(seconds=Config.JOB_LEASE_SECONDS)
+
+    def release_lease(self):
+        self.worker_id = None
+        self.lease_token = None
+        self.lease_expires_at = None
+
+    def finish(self, status: str, result, session=None):
+        """
+        Record the outcome of a run. A job whose cancel was requested is
+        recorded as cancelled even if the worker finished it first.
+        """
+        self.status = "cancelled" if self.cancel_requested_at else status
+        self.finished_at = datetime.utcnow()
+        self.release_lease()
+        self.set_result(result, session=session)
+
+    def cancel(self) -> bool:
+        """
+        Cancel the job. A queued job is taken off the queue right away. A running
+        job is flagged, and its worker kills it on the next heartbeat and reports
+        it cancelled. Returns False if the job had already finished.
+        """
+        if self.status == "queued":
+            self.status = "cancelled"
+            self.finished_at = datetime.utcnow()
+            self.set_result({"error": "Cancelled"})
+            return True
+        if self.status == "in-progress":
+            self.cancel_requested_at = self.cancel_requested_at or datetime.utcnow()
+            return True
+        return False
+
+    def retry(self, result) -> bool:
+        """
+        Queue the job again after a transient failure, with exponential backoff
+        and jitter. Returns False if it's out of attempts.
+        """
+        attempts = self.attempts or 0
+        if attempts >= Config.JOB_MAX_ATTEMPTS:
+            return False
+        backoff = min(Config.RETRY_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0), Config.RETRY_MAX_BACKOFF_SECONDS)
+        self.status = "queued"
+        self.release_lease()
+        self.started_at = None
+        self.run_after = datetime.utcnow() + timedelta(seconds=backoff * random.uniform(0.5, 1))
+        self.set_result(result)  # the last error, until the retry finishes
+        return True
+
+    def expire_lease(self):
+        """Requeue a job whose worker stopped heartbeating, or fail it once it's out of attempts."""
+        self.release_lease()
+        if self.cancel_requested_at:
+            self.status = "cancelled"
+            self.set_result({"error": "Cancelled"})
+            self.finished_at = datetime.utcnow()
+        elif (self.attempts or 0) < Config.JOB_MAX_ATTEMPTS:
+            self.status = "queued"
+            self.started_at = None
+        else:
+            self.status = "error"
+            self.set_result({"error": f"Lease expired after {self.attempts} attempt(s)"})
+            self.finished_at = datetime.utcnow()
+
     def as_dict(self):
         data = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        data["result"] = self.full_result()
         data["integration_name"] = self.deployment.integration.name
         data["config"] = self.deployment.config
         data["queue"] = self.queue
+        data["timeout"] = self.deployment.timeout
+        data["profile"] = self.deployment.profile
         data["duration_in_queue"] = self.queue_seconds
         data["duration_in_execution"] = self.execution_seconds
         data["duration_total"] = self.duration_seconds
@@ -247,25 +851,66 @@ class Job(Base):
         )
         return violation
 
+class Artifact(Base):
+    """A file produced by a job run, such as the cProfile stats of a profiled job."""
+    __tablename__ = "artifacts"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("jobs.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String, nullable=False)
+    content_type = Column(String, default="application/octet-stream")
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    job = relationship("Job", backref="artifacts")
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "job_id": self.job_id,
+            "name": self.name,
+            "content_type": self.content_type,
+            "size": len(self.data) if self.data is not None else 0,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+
 class Violation(Base):
     __tablename__ = "violations"
 
     id = Column(Integer, primary_key=True)
-    job_id = Column(Integer, ForeignKey("jobs.id", ondelete="CASCADE"), nullable=False)
+    job_id = Column(Integer, ForeignKey("jobs.id", ondelete="CASCADE"), nullable=False, index=True)
 
     task_name = Column(String, nullable=False)
-    control_references = Column(JSON, nullable=False)  # List of controls (id, framework, etc.)
-    output = Column(JSON, nullable=False)              # Task result that caused violation
+    control_references = Column(JSONB, nullable=False)  # List of controls (id, framework, etc.)
+    output = Column(JSONB, nullable=False)              # Task result that caused violation
 
     severity = Column(String, default="medium")        # Optional: low, medium, high, critical
     description = Column(Text, nullable=True)          # Optional: human-readable explanation
     violation_type = Column(String, nullable=True)     # Optional: e.g., misconfiguration
     environment = Column(String, nullable=True)        # Optional: env like 'prod'
-    meta = Column(JSON, default={})                # Optional: extra context
+    meta = Column(JSONB, default={})                # Optional: extra context
     timestamp = Column(DateTime, default=datetime.utcnow)
 
     job = relationship("Job", backref="violations")
 
+    __table_args__ = (
+        # Keyset pagination walks (timestamp, id) newest first
+        Index("ix_violations_timestamp_id", "timestamp", "id"),
+        Index("ix_violations_severity_timestamp", "severity", "timestamp"),
+        Index("ix_violations_task_name", "task_name"),
+        Index("ix_violations_violation_type", "violation_type"),
+        Index("ix_violations_environment", "environment"),
+        # Containment (@>) lookups such as [{"framework": "SOC2", "id": "CC6.1"}]
+        Index(
+            "ix_violations_control_references",
+            "control_references",
+            postgresql_using="gin",
+            postgresql_ops={"control_references": "jsonb_path_ops"},
+        ),
+        Index("ix_violations_meta", "meta", postgresql_using="gin"),
+    )
+
     def as_dict(self):
         return {
             "id": self.id,
@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def api():
+    """
+    The API module against the Postgres database in TEST_DATABASE_URL. Claims,
+    JSONB and the schema upgrade are Postgres-only, so without it the tests
+    that need a database are skipped. The database is wiped before each test.
+    """
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    os.environ["DATABASE_URL"] = url
+    import api
+
+    return api
+
+
+@pytest.fixture
+def db(api):
+    from sqlalchemy import text
+    from db import db_session, engine
+    from models import Base
+
+    tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+    with engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+    yield db_session
+    db_session.remove()
+
+
+@pytest.fixture
+def client(api, db):
+    client = api.app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {Config.INTEGRATIONS_TOKEN}"
+    return client
+
+
+@pytest.fixture
+def integration_id(db):
+    from models import Integration
+
+    integration = Integration(
+        name="hello_world",
+        title="Hello World",
+        schema={"type": "object", "properties": {"region": {"type": "string"}}},
+    )
+    db.add(integration)
+    db.commit()
+    return integration.id
+
+
+# The helpers return ids rather than objects: the API removes the shared
+# session after every request, which detaches the objects a test holds
+@pytest.fixture
+def make_deployment(db, integration_id):
+    from models import Integration
+
+    def make(tenant_id="t1", **fields):
+        integration = db.get(Integration, integration_id)
+        deployment = integration.create_deployment(config={"region": "us-east-1"}, tenant_id=tenant_id)
+        for name, value in fields.items():
+            setattr(deployment, name, value)
+        db.add(deployment)
+        db.commit()
+        return deployment.id
+
+    return make
+
+
+@pytest.fixture
+def make_job(db):
+    from models import Deployment
+
+    def make(deployment_id, **fields):
+        job = db.get(Deployment, deployment_id).create_job()
+        for name, value in fields.items():
+            setattr(job, name, value)
+        db.add(job)
+        db.commit()
+        return job.id
+
+    return make
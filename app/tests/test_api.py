@@ -0,0 +1,505 @@
+import base64
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from config import Config
+from models import Deployment, Job
+
+# Everything here runs against Postgres, see the api fixture in conftest.py
+
+
+def claim(client, worker_id="w1", **data):
+    resp = client.post("/jobs/next", json={"worker_id": worker_id, **data})
+    return resp.get_json() if resp.status_code == 200 else None
+
+
+def complete(client, job, **data):
+    data.setdefault("status", "done")
+    data.setdefault("lease_token", job["lease_token"])
+    return client.post(f"/jobs/{job['id']}/complete", json=data)
+
+
+def test_complete_requires_current_lease(client, db, make_deployment, make_job):
+    make_job(make_deployment())
+    job = claim(client)
+
+    assert complete(client, job, lease_token="stale").status_code == 409
+    assert complete(client, job, result={"ok": True}).status_code == 200
+    assert complete(client, job).status_code == 409
+
+    stored = db.get(Job, job["id"])
+    assert stored.status == "done"
+    assert stored.result == {"ok": True}
+    assert (stored.worker_id, stored.lease_token, stored.lease_expires_at) == (None, None, None)
+
+
+def test_heartbeat_renews_lease(client, db, make_deployment, make_job):
+    make_job(make_deployment())
+    job = claim(client)
+    stored = db.get(Job, job["id"])
+    stored.lease_expires_at = datetime.utcnow() + timedelta(seconds=5)
+    db.commit()
+
+    resp = client.post(f"/jobs/{job['id']}/heartbeat", json={"lease_token": job["lease_token"]})
+    assert resp.status_code == 200
+    renewed = datetime.fromisoformat(resp.get_json()["lease_expires_at"])
+    assert renewed > datetime.utcnow() + timedelta(seconds=Config.JOB_LEASE_SECONDS - 5)
+    assert client.post(f"/jobs/{job['id']}/heartbeat", json={"lease_token": "stale"}).status_code == 409
+
+
+def test_reaper_requeues_expired_lease(client, db, make_deployment, make_job):
+    make_job(make_deployment())
+    job = claim(client)
+    stored = db.get(Job, job["id"])
+    stored.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+
+    assert client.post("/api/jobs/reap").get_json() == {"requeued": [job["id"]], "failed": []}
+    # The worker that lost the lease can't record a result anymore
+    assert complete(client, job).status_code == 409
+
+    reclaimed = claim(client, worker_id="w2")
+    assert reclaimed["id"] == job["id"]
+    assert reclaimed["lease_token"] != job["lease_token"]
+    assert reclaimed["attempts"] == 2
+
+
+def test_reaper_fails_job_out_of_attempts(client, db, make_deployment, make_job, monkeypatch):
+    monkeypatch.setattr(Config, "JOB_MAX_ATTEMPTS", 1)
+    make_job(make_deployment())
+    job = claim(client)
+    db.get(Job, job["id"]).lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+
+    assert client.post("/api/jobs/reap").get_json() == {"requeued": [], "failed": [job["id"]]}
+    assert db.get(Job, job["id"]).status == "error"
+    assert db.get(Job, job["id"]).deployment.consecutive_failures == 1
+
+
+def test_claim_filters_by_integration(client, make_deployment, make_job):
+    make_job(make_deployment())
+    assert claim(client, integrations=[]) is None
+    assert claim(client, integrations=["other"]) is None
+    assert claim(client, integrations=["other", "hello_world"]) is not None
+
+
+def test_claim_by_get_takes_comma_separated_integrations(client, make_deployment, make_job):
+    make_job(make_deployment())
+    resp = client.get("/jobs/next", query_string={"worker_id": "w1", "integrations": "other"})
+    assert resp.status_code == 204
+    resp = client.get("/jobs/next", query_string={"worker_id": "w1", "integrations": "other,hello_world"})
+    assert resp.status_code == 200
+
+
+def test_claim_rejects_bad_integrations(client):
+    resp = client.post("/jobs/next", json={"worker_id": "w1", "integrations": "hello_world"})
+    assert resp.status_code == 400
+
+
+def test_claim_prefers_tenant_with_fewest_running(client, make_deployment, make_job):
+    busy = make_deployment("t1")
+    idle = make_deployment("t2")
+    make_job(busy, status="in-progress")
+    make_job(busy, created_at=datetime.utcnow() - timedelta(minutes=5))
+    make_job(idle)
+
+    assert claim(client)["deployment_id"] == idle
+
+
+def test_claim_prefers_tenant_waiting_longest(client, make_deployment, make_job):
+    first = make_deployment("t1")
+    second = make_deployment("t2")
+    make_job(second, created_at=datetime.utcnow() - timedelta(minutes=1))
+    make_job(first, created_at=datetime.utcnow() - timedelta(minutes=5))
+
+    assert claim(client)["deployment_id"] == first
+    assert claim(client)["deployment_id"] == second
+
+
+def test_claim_prefers_higher_priority_within_tenant(client, make_deployment, make_job):
+    low = make_deployment("t1", priority=0)
+    high = make_deployment("t1", priority=5)
+    make_job(low, created_at=datetime.utcnow() - timedelta(minutes=5))
+    make_job(high)
+
+    assert claim(client)["deployment_id"] == high
+    assert claim(client)["deployment_id"] == low
+
+
+def test_claim_looks_past_tenants_locked_by_other_claims(client, make_deployment, make_job, monkeypatch):
+    from sqlalchemy import text
+    from db import engine
+
+    monkeypatch.setattr(Config, "CLAIM_TENANT_CANDIDATES", 1)
+    locked = make_job(make_deployment("t1"), created_at=datetime.utcnow() - timedelta(minutes=5))
+    free = make_job(make_deployment("t2"))
+
+    # A concurrent claim holds t1's only job, t2 is outside the first window
+    with engine.connect() as conn, conn.begin():
+        conn.execute(text("SELECT id FROM jobs WHERE id = :id FOR UPDATE"), {"id": locked})
+        assert claim(client)["id"] == free
+
+
+def test_concurrency_limit_holds_jobs(client, make_deployment, make_job):
+    resp = client.put("/concurrency-limits", json={"tenant_id": "t1", "max_running": 1})
+    assert resp.status_code == 200
+    limited = make_deployment("t1")
+    other = make_deployment("t2")
+    make_job(limited, created_at=datetime.utcnow() - timedelta(minutes=5))
+    make_job(limited, created_at=datetime.utcnow() - timedelta(minutes=4))
+    make_job(other)
+
+    assert claim(client)["deployment_id"] == limited
+    assert claim(client)["deployment_id"] == other
+    assert claim(client) is None
+
+
+def test_integration_concurrency_limit(client, integration_id, make_deployment, make_job):
+    client.put("/concurrency-limits", json={"integration_id": integration_id, "max_running": 0})
+    make_job(make_deployment("t1"))
+    assert claim(client) is None
+
+    limit = client.get("/concurrency-limits").get_json()[0]
+    assert client.delete(f"/concurrency-limits/{limit['id']}").status_code == 200
+    assert claim(client) is not None
+
+
+def test_concurrency_limit_put_updates_existing(client, integration_id):
+    for key in [{"tenant_id": "t1"}, {"integration_id": integration_id}, {"integration_id": integration_id, "tenant_id": "t1"}]:
+        first = client.put("/concurrency-limits", json={**key, "max_running": 1}).get_json()
+        second = client.put("/concurrency-limits", json={**key, "max_running": 3}).get_json()
+        assert second["id"] == first["id"]
+        assert second["max_running"] == 3
+    assert len(client.get("/concurrency-limits").get_json()) == 3
+
+
+@pytest.mark.parametrize("max_running", [True, -1, 1.5, "2", None])
+def test_concurrency_limit_rejects_bad_max_running(client, max_running):
+    resp = client.put("/concurrency-limits", json={"tenant_id": "t1", "max_running": max_running})
+    assert resp.status_code == 400
+
+
+def test_job_artifacts(client, make_deployment, make_job):
+    job_id = make_job(make_deployment())
+    resp = client.post(f"/jobs/{job_id}/artifacts", data={"file": (io.BytesIO(b"stats"), "profile.prof")})
+    assert resp.status_code == 201
+    artifact = resp.get_json()
+    assert (artifact["name"], artifact["size"]) == ("profile.prof", 5)
+
+    assert client.get(f"/tenants/t1/jobs/{job_id}/artifacts").get_json() == [artifact]
+    assert client.get(f"/tenants/t2/jobs/{job_id}/artifacts").get_json() == []
+    resp = client.get(f"/tenants/t1/jobs/{job_id}/artifacts/{artifact['id']}")
+    assert resp.data == b"stats"
+
+
+def test_complete_stores_metrics(client, db, make_deployment, make_job):
+    make_job(make_deployment())
+    job = claim(client)
+    complete(client, job, metrics={"run_seconds": 1.5, "tasks": 3})
+    assert db.get(Job, job["id"]).metrics == {"run_seconds": 1.5, "tasks": 3}
+
+
+def test_trace_id_follows_job(client, make_deployment):
+    deployment = make_deployment()
+    resp = client.post("/jobs", json={"deployment_id": deployment}, headers={"X-Trace-Id": "trace-1"})
+    assert resp.get_json()["trace_id"] == "trace-1"
+
+    resp = client.get("/jobs/next", query_string={"worker_id": "w1"})
+    assert resp.headers["X-Trace-Id"] == "trace-1"
+    job = resp.get_json()
+    complete(client, job, spans=[{"name": "run", "service": "worker", "start": "2024-01-01T00:00:00", "duration_ms": 5}])
+
+    spans = client.get(f"/jobs/{job['id']}").get_json()["spans"]
+    assert [span["name"] for span in spans] == ["queue", "claim", "run"]
+
+
+def test_metrics_endpoint(client):
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert b"api_job_claim_duration_seconds" in resp.data
+
+
+def test_results_stored_as_patches(client, db, make_deployment, make_job, monkeypatch):
+    monkeypatch.setattr(Config, "RESULT_DELTA", True)
+    deployment = make_deployment()
+    results = []
+    for n in range(3):
+        result = {"tasks": [{"id": i, "ok": i != n} for i in range(20)]}
+        make_job(deployment)
+        job = claim(client)
+        complete(client, job, result=result)
+        results.append((job["id"], result))
+
+    first, second, third = [db.get(Job, job_id) for job_id, _ in results]
+    assert first.result_base_id is None
+    assert (second.result_base_id, second.result_depth) == (first.id, 1)
+    assert (third.result_base_id, third.result_depth) == (second.id, 2)
+    for job_id, result in results:
+        assert client.get(f"/jobs/{job_id}").get_json()["result"] == result
+
+    # Deleting the base run gives the next run its full result back
+    client.delete("/jobs", query_string={"before": first.finished_at.isoformat()})
+    db.expire_all()
+    assert db.get(Job, second.id).result_base_id is None
+    assert client.get(f"/jobs/{third.id}").get_json()["result"] == results[2][1]
+
+
+def test_results_snapshot_every_interval(client, db, make_deployment, make_job, monkeypatch):
+    monkeypatch.setattr(Config, "RESULT_DELTA", True)
+    monkeypatch.setattr(Config, "RESULT_SNAPSHOT_INTERVAL", 2)
+    deployment = make_deployment()
+    ids = []
+    for n in range(3):
+        make_job(deployment)
+        job = claim(client)
+        complete(client, job, result={"tasks": [{"id": i, "ok": i != n} for i in range(20)]})
+        ids.append(job["id"])
+
+    assert [db.get(Job, job_id).result_depth for job_id in ids] == [0, 1, 0]
+
+
+def test_heartbeat_reports_cancel(client, db, make_deployment, make_job):
+    make_job(make_deployment())
+    job = claim(client)
+    data = {"lease_token": job["lease_token"]}
+
+    assert client.post(f"/jobs/{job['id']}/heartbeat", json=data).get_json()["cancel"] is False
+    assert client.post(f"/tenants/t1/jobs/{job['id']}/cancel").status_code == 200
+    assert client.post(f"/jobs/{job['id']}/heartbeat", json=data).get_json()["cancel"] is True
+
+    complete(client, job, status="error", result={"error": "Cancelled"})
+    assert db.get(Job, job["id"]).status == "cancelled"
+    assert client.post(f"/tenants/t1/jobs/{job['id']}/cancel").status_code == 409
+
+
+def test_cancel_deployment_jobs(client, make_deployment, make_job):
+    deployment = make_deployment()
+    make_job(deployment, created_at=datetime.utcnow() - timedelta(minutes=1))
+    queued = make_job(deployment)
+    running = claim(client)["id"]
+
+    assert client.post(f"/tenants/t2/deployments/{deployment}/jobs/cancel").status_code == 404
+    resp = client.post(f"/tenants/t1/deployments/{deployment}/jobs/cancel")
+    assert resp.get_json() == {"cancelled": [queued], "cancelling": [running]}
+
+
+def test_update_deployment_rejects_wrong_type(client, make_deployment):
+    deployment = make_deployment()
+    resp = client.put(f"/tenants/t1/deployments/{deployment}", json={"timeout": "soon"})
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "timeout must be int"
+
+
+def test_bulk_create_reports_bad_items(client, integration_id):
+    resp = client.post("/tenants/t1/deployments/bulk", json={"deployments": [
+        {"integration_id": [integration_id], "config": {}},
+        {"integration_id": integration_id, "config": {"region": "us-east-1"}, "timeout": True},
+        {"integration_id": integration_id, "config": {"region": 1}},
+        {"integration_id": integration_id, "config": {"region": "us-east-1"}},
+        "not an object",
+        {"integration_id": integration_id, "config": {"region": "us-east-1"}, "timeout": None},
+        {"integration_id": integration_id, "config": {"region": "us-east-1"}, "schedule": None},
+    ]})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert [item["index"] for item in data["created"]] == [3, 6]
+    assert [error["index"] for error in data["errors"]] == [0, 1, 2, 4, 5]
+    assert data["errors"][-1]["error"] == "timeout must be int"
+
+
+def test_bulk_create_atomic(client, db, integration_id):
+    resp = client.post("/tenants/t1/deployments/bulk", json={"atomic": True, "deployments": [
+        {"integration_id": integration_id, "config": {"region": "us-east-1"}},
+        {"integration_id": integration_id},
+    ]})
+    assert resp.status_code == 400
+    assert db.query(Deployment).count() == 0
+
+
+def test_bulk_update_reports_bad_items(client, make_deployment):
+    deployment = make_deployment()
+    other_tenant = make_deployment("t2")
+    resp = client.put("/tenants/t1/deployments/bulk", json={"deployments": [
+        {"id": deployment, "priority": 3},
+        {"id": other_tenant, "priority": 3},
+        {"id": deployment, "priority": "high"},
+        {"id": deployment, "owner": "me"},
+        {"id": [deployment], "priority": 1},
+    ]})
+    data = resp.get_json()
+    assert data["updated"] == [deployment]
+    assert [error["index"] for error in data["errors"]] == [1, 2, 3, 4]
+
+
+def add_violations(client, job_id, count):
+    start = datetime(2024, 1, 1)
+    for n in range(count):
+        client.post(f"/jobs/{job_id}/violations", json={
+            "task_name": "mfa",
+            "control_references": [{"framework": "SOC2", "id": f"CC6.{n % 2}"}],
+            "output": {},
+            "severity": "high" if n % 2 else "low",
+            "timestamp": (start + timedelta(minutes=n)).isoformat(),
+        })
+
+
+def test_search_violations_pages_with_cursor(client, make_deployment, make_job):
+    job_id = make_job(make_deployment())
+    add_violations(client, job_id, 5)
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        data = client.get("/tenants/t1/violations/search", query_string=params).get_json()
+        seen.extend(v["id"] for v in data["violations"])
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+    assert seen == [5, 4, 3, 2, 1]
+
+
+def test_search_violations_filters(client, make_deployment, make_job):
+    job_id = make_job(make_deployment())
+    add_violations(client, job_id, 4)
+
+    data = client.get("/tenants/t1/violations/search?severity=high&framework=SOC2&control=CC6.1").get_json()
+    assert [v["id"] for v in data["violations"]] == [4, 2]
+    data = client.get("/tenants/t1/violations/search?since=2024-01-01T00:01:00&until=2024-01-01T00:03:00").get_json()
+    assert [v["id"] for v in data["violations"]] == [3, 2]
+    data = client.get("/tenants/t2/violations/search").get_json()
+    assert data["violations"] == []
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_search_violations_clamps_limit(client, make_deployment, make_job, limit):
+    job_id = make_job(make_deployment())
+    add_violations(client, job_id, 2)
+
+    resp = client.get("/tenants/t1/violations/search", query_string={"limit": limit})
+    assert resp.status_code == 200
+    assert [v["id"] for v in resp.get_json()["violations"]] == [2]
+    assert resp.get_json()["next_cursor"]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(json.dumps({"a": 1}).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps(["2024-01-01T00:00:00", "1"]).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps(["yesterday", 1]).encode()).decode(),
+])
+def test_search_violations_rejects_malformed_cursor(client, cursor):
+    resp = client.get("/tenants/t1/violations/search", query_string={"cursor": cursor})
+    assert resp.status_code == 400
+
+
+def test_deployment_violations_clamps_paging(client, make_deployment, make_job):
+    deployment = make_deployment()
+    make_job(deployment)
+    resp = client.get(f"/tenants/t1/deployments/{deployment}/violations?page=0&per_page=0")
+    assert resp.status_code == 200
+    assert resp.get_json()["pagination"] == {"page": 1, "per_page": 1, "total": 1, "pages": 1}
+
+
+def test_deployment_violations_latest_and_summary(client, make_deployment, make_job):
+    deployment = make_deployment()
+    older = make_job(deployment, status="done", finished_at=datetime.utcnow() - timedelta(hours=1))
+    latest = make_job(deployment, status="done", finished_at=datetime.utcnow())
+    make_job(deployment)
+    add_violations(client, older, 1)
+    add_violations(client, latest, 3)
+
+    data = client.get(f"/tenants/t1/deployments/{deployment}/violations").get_json()
+    assert data["pagination"]["total"] == 3
+    assert [run["job_id"] for run in data["jobs"]][1:] == [latest, older]
+
+    data = client.get(f"/tenants/t1/deployments/{deployment}/violations?latest=true&summary=true").get_json()
+    assert data["jobs"] == [{
+        "job_id": latest,
+        "status": "done",
+        "created_at": data["jobs"][0]["created_at"],
+        "finished_at": data["jobs"][0]["finished_at"],
+        "severity_counts": {"low": 2, "high": 1},
+        "total": 3,
+    }]
+
+
+def test_queue_scaling(client, make_deployment, make_job):
+    deployment = make_deployment(queue="aws")
+    make_job(deployment)
+    make_job(deployment)
+    make_deployment(queue="idle")
+
+    stats = {stat["queue"]: stat for stat in client.get("/api/queues/scaling").get_json()}
+    assert stats["aws"]["queued"] == 2
+    assert stats["aws"]["desired_workers"] >= Config.SCALING_MIN_WORKERS
+    assert stats["idle"]["queued"] == 0
+    assert stats["idle"]["desired_workers"] == Config.SCALING_MIN_WORKERS
+
+
+def test_claim_skips_jobs_waiting_to_retry(client, make_deployment, make_job):
+    deployment = make_deployment()
+    make_job(deployment, run_after=datetime.utcnow() + timedelta(minutes=5))
+    assert claim(client) is None
+
+    ready = make_job(deployment, run_after=datetime.utcnow() - timedelta(seconds=1))
+    assert claim(client)["id"] == ready
+
+
+def test_transient_error_is_retried(client, db, make_deployment, make_job):
+    deployment = make_deployment()
+    make_job(deployment)
+    job = claim(client)
+
+    resp = complete(client, job, status="error", transient=True, result={"error": "timeout"})
+    assert resp.get_json()["message"] == "retrying"
+
+    stored = db.get(Job, job["id"])
+    assert stored.status == "queued"
+    assert stored.run_after > datetime.utcnow()
+    assert db.get(Deployment, deployment).consecutive_failures == 0
+    assert claim(client) is None
+
+
+def test_transient_error_fails_after_max_attempts(client, db, make_deployment, make_job, monkeypatch):
+    monkeypatch.setattr(Config, "JOB_MAX_ATTEMPTS", 1)
+    make_job(make_deployment())
+    job = claim(client)
+
+    resp = complete(client, job, status="error", transient=True, result={"error": "timeout"})
+    assert resp.get_json()["message"] == "updated"
+    assert db.get(Job, job["id"]).status == "error"
+
+
+def test_failures_open_breaker(client, make_deployment, make_job, monkeypatch):
+    monkeypatch.setattr(Config, "BREAKER_THRESHOLD", 2)
+    deployment = make_deployment()
+    for _ in range(2):
+        make_job(deployment)
+        complete(client, claim(client), status="error", result={"error": "denied"})
+
+    data = client.get(f"/tenants/t1/deployments/{deployment}").get_json()
+    assert data["consecutive_failures"] == 2
+    assert data["breaker_state"] == "open"
+
+    data = client.post(f"/tenants/t1/deployments/{deployment}/breaker/reset").get_json()
+    assert data["breaker_state"] == "closed"
+
+
+def test_config_change_resets_breaker(client, db, make_deployment):
+    single = make_deployment(consecutive_failures=5, breaker_until=datetime.utcnow() + timedelta(hours=1))
+    bulk = make_deployment(consecutive_failures=5, breaker_until=datetime.utcnow() + timedelta(hours=1))
+
+    resp = client.put(f"/tenants/t1/deployments/{single}", json={"config": {"region": "eu-west-1"}})
+    assert resp.get_json()["breaker_state"] == "closed"
+
+    resp = client.put("/tenants/t1/deployments/bulk", json={
+        "deployments": [{"id": bulk, "config": {"region": "eu-west-1"}}]
+    })
+    assert resp.get_json() == {"updated": [bulk], "errors": []}
+    db.expire_all()
+    assert db.get(Deployment, bulk).consecutive_failures == 0
+    assert db.get(Deployment, bulk).breaker_until is None
@@ -0,0 +1,71 @@
+import copy
+import random
+
+import pytest
+
+from utils import jsonpatch
+
+
+@pytest.mark.parametrize("src, dst", [
+    ({"a": 1}, {"a": 2}),
+    ({"a": 1, "b": 2}, {"b": 2, "c": 3}),
+    ({"tasks": [1, 2, 3]}, {"tasks": [1, 2]}),
+    ({"tasks": [1]}, {"tasks": [1, 2, 3]}),
+    ({"tasks": [{"id": 1, "ok": True}]}, {"tasks": [{"id": 1, "ok": False}]}),
+    ({"a": {"b": 1}}, {"a": [1]}),
+    ({"a/b": 1, "c~d": 2}, {"a/b": 3, "c~d": 4}),
+    ([1, 2], {"a": 1}),
+    ("old", "new"),
+    (None, {"a": 1}),
+    ({}, {}),
+])
+def test_diff_apply_round_trip(src, dst):
+    patch = jsonpatch.diff(src, dst)
+    assert jsonpatch.apply(src, patch) == dst
+
+
+def test_diff_of_equal_documents_is_empty():
+    doc = {"tasks": [{"id": 1, "controls": ["CC6.1"]}], "count": 1}
+    assert jsonpatch.diff(doc, copy.deepcopy(doc)) == []
+
+
+def test_diff_is_small_for_small_changes():
+    src = {"tasks": [{"id": i, "ok": True} for i in range(100)]}
+    dst = copy.deepcopy(src)
+    dst["tasks"][42]["ok"] = False
+    assert jsonpatch.diff(src, dst) == [{"op": "replace", "path": "/tasks/42/ok", "value": False}]
+
+
+def test_apply_does_not_modify_input():
+    src = {"tasks": [1, 2]}
+    patch = [{"op": "add", "path": "/tasks/-", "value": 3}]
+    assert jsonpatch.apply(src, patch) == {"tasks": [1, 2, 3]}
+    assert src == {"tasks": [1, 2]}
+
+
+def test_apply_rejects_bad_path():
+    with pytest.raises(ValueError):
+        jsonpatch.apply({"a": 1}, [{"op": "replace", "path": "/missing/b", "value": 1}])
+    with pytest.raises(ValueError):
+        jsonpatch.apply({"a": 1}, [{"op": "add", "path": "/a/b", "value": 1}])
+
+
+def test_apply_rejects_unsupported_op():
+    with pytest.raises(ValueError):
+        jsonpatch.apply({"a": 1}, [{"op": "move", "from": "/a", "path": "/b"}])
+
+
+def random_doc(rng, depth=0):
+    kind = rng.choice(["dict", "list", "scalar"] if depth < 3 else ["scalar"])
+    if kind == "dict":
+        return {rng.choice(["a", "b", "c/d", "e~f", "g"]): random_doc(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+    if kind == "list":
+        return [random_doc(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return rng.choice([None, True, 0, 1, 2.5, "x", "y"])
+
+
+def test_diff_apply_random_documents():
+    rng = random.Random(7)
+    for _ in range(500):
+        src, dst = random_doc(rng), random_doc(rng)
+        assert jsonpatch.apply(src, jsonpatch.diff(src, dst)) == dst
@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from config import Config
+from models import Deployment, Job
+from utils import jsonpatch
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(Config, "BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(Config, "BREAKER_BACKOFF_SECONDS", 60)
+    monkeypatch.setattr(Config, "BREAKER_MAX_BACKOFF_SECONDS", 200)
+    monkeypatch.setattr(Config, "BREAKER_PAUSE_AFTER", 6)
+
+
+def chain(*results):
+    """Jobs of one deployment, each storing its result as a patch against the previous one."""
+    jobs = [Job(id=1, result=results[0], result_depth=0)]
+    for n, result in enumerate(results[1:], start=2):
+        base = jobs[-1]
+        jobs.append(Job(
+            id=n,
+            result=jsonpatch.diff(results[n - 2], result),
+            result_base_id=base.id,
+            result_base=base,
+            result_depth=base.result_depth + 1,
+        ))
+    return jobs
+
+
+def test_full_result_applies_patch_chain():
+    results = [{"tasks": [1]}, {"tasks": [1, 2]}, {"tasks": [2]}, {"tasks": [2], "ok": True}]
+    jobs = chain(*results)
+    assert [job.full_result() for job in jobs] == results
+
+
+def test_full_result_reuses_rebuilt_base():
+    jobs = chain({"a": 1}, {"a": 2}, {"a": 3})
+    assert jobs[1].full_result() == {"a": 2}
+    jobs[0].result = None  # no longer needed once the job after it was rebuilt
+    assert jobs[2].full_result() == {"a": 3}
+
+
+def test_materialize_result_stores_full_result():
+    jobs = chain({"a": 1}, {"a": 2})
+    jobs[1].materialize_result()
+    assert jobs[1].result == {"a": 2}
+    assert jobs[1].result_base_id is None
+    assert jobs[1].result_depth == 0
+
+
+def test_set_result_without_session_stores_full_result(monkeypatch):
+    monkeypatch.setattr(Config, "RESULT_DELTA", True)
+    job = Job(id=2, status="done")
+    job.set_result({"a": 1})
+    assert job.result == {"a": 1}
+    assert job.result_base_id is None
+
+
+def test_claim_issues_new_lease_token():
+    job = Job(status="queued", created_at=datetime.utcnow())
+    job.claim("w1")
+    first = job.lease_token
+    assert job.status == "in-progress"
+    assert job.worker_id == "w1"
+    assert job.attempts == 1
+    assert job.lease_expires_at > datetime.utcnow()
+    assert job.spans[0]["name"] == "queue"
+
+    job.expire_lease()
+    job.claim("w1")
+    assert job.lease_token != first
+    assert job.attempts == 2
+
+
+def test_finish_releases_lease():
+    job = Job(status="queued")
+    job.claim("w1")
+    job.finish("done", {"a": 1})
+    assert job.status == "done"
+    assert job.finished_at is not None
+    assert (job.worker_id, job.lease_token, job.lease_expires_at) == (None, None, None)
+
+
+def test_finish_records_requested_cancel():
+    job = Job(status="queued")
+    job.claim("w1")
+    assert job.cancel()
+    job.finish("done", {"a": 1})
+    assert job.status == "cancelled"
+
+
+def test_cancel():
+    queued = Job(status="queued")
+    assert queued.cancel()
+    assert queued.status == "cancelled"
+    assert not Job(status="done").cancel()
+
+
+def test_expire_lease_requeues_until_out_of_attempts(monkeypatch):
+    monkeypatch.setattr(Config, "JOB_MAX_ATTEMPTS", 2)
+    job = Job(status="queued")
+    job.claim("w1")
+    job.expire_lease()
+    assert job.status == "queued"
+    assert job.worker_id is None
+
+    job.claim("w2")
+    job.expire_lease()
+    assert job.status == "error"
+    assert "Lease expired" in job.result["error"]
+
+
+def test_expire_lease_of_cancelled_job():
+    job = Job(status="queued")
+    job.claim("w1")
+    job.cancel()
+    job.expire_lease()
+    assert job.status == "cancelled"
+
+
+def test_retry_backs_off_exponentially(monkeypatch):
+    monkeypatch.setattr(Config, "JOB_MAX_ATTEMPTS", 5)
+    monkeypatch.setattr(Config, "RETRY_BACKOFF_SECONDS", 100)
+    monkeypatch.setattr(Config, "RETRY_MAX_BACKOFF_SECONDS", 300)
+    job = Job(status="queued")
+
+    for attempt, backoff in [(1, 100), (2, 200), (3, 300), (4, 300)]:
+        job.claim("w1")
+        assert job.attempts == attempt
+        before = datetime.utcnow()
+        assert job.retry({"error": "timeout"})
+        assert job.status == "queued"
+        assert job.lease_token is None
+        assert before + timedelta(seconds=backoff * 0.5 - 1) <= job.run_after
+        assert job.run_after <= datetime.utcnow() + timedelta(seconds=backoff)
+
+
+def test_retry_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(Config, "JOB_MAX_ATTEMPTS", 1)
+    job = Job(status="queued")
+    job.claim("w1")
+    assert not job.retry({"error": "timeout"})
+    assert job.status == "in-progress"
+
+
+def test_breaker_opens_after_threshold(breaker):
+    deployment = Deployment()
+    for _ in range(2):
+        deployment.record_outcome("error")
+    assert deployment.breaker_state == "closed"
+    assert deployment.breaker_until is None
+
+    deployment.record_outcome("error")
+    assert deployment.breaker_state == "open"
+    assert deployment.breaker_until > datetime.utcnow() + timedelta(seconds=55)
+
+
+def test_breaker_backoff_doubles_and_is_capped(breaker):
+    deployment = Deployment(consecutive_failures=3)
+    deployment.record_outcome("error")
+    assert deployment.breaker_until > datetime.utcnow() + timedelta(seconds=115)
+    deployment.record_outcome("error")
+    assert deployment.breaker_until <= datetime.utcnow() + timedelta(seconds=200)
+
+
+def test_breaker_half_open_after_backoff(breaker):
+    deployment = Deployment(consecutive_failures=3, breaker_until=datetime.utcnow() - timedelta(seconds=1))
+    assert deployment.breaker_state == "half-open"
+
+
+def test_breaker_pauses_and_resets(breaker):
+    deployment = Deployment(consecutive_failures=5)
+    deployment.record_outcome("error")
+    assert deployment.breaker_state == "paused"
+
+    deployment.record_outcome("cancelled")
+    assert deployment.consecutive_failures == 6
+    deployment.record_outcome("done")
+    assert deployment.breaker_state == "closed"
+    assert deployment.breaker_until is None
+
+
+def test_breaker_disabled(breaker, monkeypatch):
+    monkeypatch.setattr(Config, "BREAKER_THRESHOLD", 0)
+    deployment = Deployment(consecutive_failures=100)
+    deployment.record_outcome("error")
+    assert deployment.breaker_state == "closed"
+    assert deployment.breaker_until is None
+
+
+@pytest.mark.parametrize("fields", [
+    {"timeout": 60, "priority": -1, "enabled": False, "schedule": None, "config": {}, "queue": "aws"},
+    {"unknown": object()},
+])
+def test_validate_fields_accepts(fields):
+    Deployment.validate_fields(fields)
+
+
+@pytest.mark.parametrize("fields, message", [
+    ({"timeout": True}, "timeout must be int"),
+    ({"timeout": "60"}, "timeout must be int"),
+    ({"timeout": None}, "timeout must be int"),
+    ({"queue": None}, "queue must be str"),
+    ({"enabled": 1}, "enabled must be bool"),
+    ({"schedule": 5}, "schedule must be str or null"),
+    ({"config": ["a"]}, "config must be dict"),
+])
+def test_validate_fields_rejects(fields, message):
+    with pytest.raises(ValueError, match=message):
+        Deployment.validate_fields(fields)
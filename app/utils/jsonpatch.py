@@ -0,0 +1,89 @@
+import copy
+
+# Minimal JSON Patch (RFC 6902) support for storing job results as deltas.
+# diff() only emits "add", "remove" and "replace" operations.
+
+
+def _escape(key) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def diff(src, dst, path: str = "") -> list:
+    """Return the operations that turn src into dst."""
+    if type(src) is not type(dst):
+        return [{"op": "replace", "path": path, "value": copy.deepcopy(dst)}]
+
+    if isinstance(src, dict):
+        ops = []
+        for key in src:
+            if key not in dst:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in dst.items():
+            if key not in src:
+                ops.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": copy.deepcopy(value)})
+            else:
+                ops.extend(diff(src[key], value, f"{path}/{_escape(key)}"))
+        return ops
+
+    if isinstance(src, list):
+        ops = []
+        common = min(len(src), len(dst))
+        for i in range(common):
+            ops.extend(diff(src[i], dst[i], f"{path}/{i}"))
+        # Remove from the end so earlier indexes stay valid
+        for i in range(len(src) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+        for i in range(common, len(dst)):
+            ops.append({"op": "add", "path": f"{path}/{i}", "value": copy.deepcopy(dst[i])})
+        return ops
+
+    if src != dst:
+        return [{"op": "replace", "path": path, "value": copy.deepcopy(dst)}]
+    return []
+
+
+def apply(doc, patch: list):
+    """Return a copy of doc with the patch applied. Raises ValueError on a bad path or op."""
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        path = op["path"]
+        if path == "":
+            if op["op"] == "remove":
+                doc = None
+            else:
+                doc = copy.deepcopy(op["value"])
+            continue
+
+        tokens = [_unescape(t) for t in path.split("/")[1:]]
+        parent = doc
+        try:
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ValueError(f"Invalid JSON Patch path: {path}")
+
+        last = tokens[-1]
+        if isinstance(parent, list):
+            index = len(parent) if last == "-" else int(last)
+            if op["op"] == "add":
+                parent.insert(index, copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                del parent[index]
+            elif op["op"] == "replace":
+                parent[index] = copy.deepcopy(op["value"])
+            else:
+                raise ValueError(f"Unsupported JSON Patch op: {op['op']}")
+        elif isinstance(parent, dict):
+            if op["op"] in ("add", "replace"):
+                parent[last] = copy.deepcopy(op["value"])
+            elif op["op"] == "remove":
+                del parent[last]
+            else:
+                raise ValueError(f"Unsupported JSON Patch op: {op['op']}")
+        else:
+            raise ValueError(f"Invalid JSON Patch path: {path}")
+    return doc
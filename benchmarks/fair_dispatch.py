@@ -0,0 +1,135 @@
+"""
+Simulate job dispatch on one queue with a noisy tenant and compare queue
+latency per tenant under FIFO and under the tenant-fair policy used by
+Job.next_queued (fewest jobs in progress first, then oldest head-of-line job,
+then priority and age within the tenant).
+
+Usage:
+    python benchmarks/fair_dispatch.py --workers 20 --minutes 30
+"""
+import argparse
+import heapq
+import random
+import statistics
+from collections import defaultdict, deque
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def generate_jobs(args, rng):
+    """Every minute the scheduler enqueues all due deployments at once."""
+    jobs = []
+    for minute in range(args.minutes):
+        now = minute * 60.0
+        for _ in range(args.noisy_jobs):
+            jobs.append((now, "noisy", 0, rng.expovariate(1 / args.service_seconds)))
+        for tenant in range(args.small_tenants):
+            for _ in range(args.small_jobs):
+                jobs.append((now, f"small-{tenant}", 0, rng.expovariate(1 / args.service_seconds)))
+    return jobs
+
+
+class FifoQueue:
+    def __init__(self):
+        self.jobs = deque()
+
+    def push(self, job):
+        self.jobs.append(job)
+
+    def pop(self, running):
+        return self.jobs.popleft() if self.jobs else None
+
+
+class FairQueue:
+    def __init__(self):
+        self.by_tenant = defaultdict(list)  # tenant -> heap of (-priority, created, seq, job)
+        self.seq = 0
+
+    def push(self, job):
+        created, tenant, priority, _ = job
+        self.seq += 1
+        heapq.heappush(self.by_tenant[tenant], (-priority, created, self.seq, job))
+
+    def pop(self, running):
+        tenants = [t for t, heap in self.by_tenant.items() if heap]
+        if not tenants:
+            return None
+        head = {t: min(item[1] for item in self.by_tenant[t]) for t in tenants}
+        tenant = min(tenants, key=lambda t: (running[t], head[t]))
+        return heapq.heappop(self.by_tenant[tenant])[3]
+
+
+def simulate(jobs, workers, queue):
+    """Run the jobs on `workers` slots and return {tenant: [queue seconds]}."""
+    arrivals = sorted(jobs, key=lambda j: j[0])
+    finishing = []  # heap of (finish time, tenant)
+    running = defaultdict(int)
+    waits = defaultdict(list)
+    idle = workers
+    i = 0
+
+    while i < len(arrivals) or finishing:
+        next_arrival = arrivals[i][0] if i < len(arrivals) else float("inf")
+        next_finish = finishing[0][0] if finishing else float("inf")
+        now = min(next_arrival, next_finish)
+
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            queue.push(arrivals[i])
+            i += 1
+        while finishing and finishing[0][0] <= now:
+            _, tenant = heapq.heappop(finishing)
+            running[tenant] -= 1
+            idle += 1
+
+        while idle:
+            job = queue.pop(running)
+            if job is None:
+                break
+            created, tenant, _, service = job
+            waits[tenant].append(now - created)
+            running[tenant] += 1
+            idle -= 1
+            heapq.heappush(finishing, (now + service, tenant))
+
+    return waits
+
+
+def report(name, waits):
+    small = [w for tenant, values in waits.items() if tenant != "noisy" for w in values]
+    noisy = waits.get("noisy", [])
+    print(f"{name}:")
+    for label, values in [("small tenants", small), ("noisy tenant", noisy)]:
+        print(
+            f"  {label:<14} jobs={len(values):<7} "
+            f"p50={percentile(values, 50):8.1f}s p99={percentile(values, 99):8.1f}s "
+            f"max={max(values, default=0):8.1f}s mean={statistics.mean(values) if values else 0:8.1f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--minutes", type=int, default=30)
+    parser.add_argument("--noisy-jobs", type=int, default=1000, help="jobs the noisy tenant enqueues per minute")
+    parser.add_argument("--small-tenants", type=int, default=20)
+    parser.add_argument("--small-jobs", type=int, default=2, help="jobs each small tenant enqueues per minute")
+    parser.add_argument("--service-seconds", type=float, default=5.0, help="mean job run time")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    jobs = generate_jobs(args, random.Random(args.seed))
+    print(
+        f"{len(jobs)} jobs, {args.workers} workers, "
+        f"offered load {sum(j[3] for j in jobs) / (args.workers * args.minutes * 60):.0%}\n"
+    )
+    report("fifo", simulate(jobs, args.workers, FifoQueue()))
+    report("tenant-fair", simulate(jobs, args.workers, FairQueue()))
+
+
+if __name__ == "__main__":
+    main()
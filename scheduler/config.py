@@ -6,3 +6,13 @@ class Config:
     POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))  # seconds
     DEBUG = os.getenv("DEBUG", "false").lower() == "true"
     TIMEOUT = int(os.getenv("DEFAULT_TIMEOUT", "3600"))  # fallback default
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Prometheus /metrics, 0 to disable
+
+    # Backpressure. Past the soft limit of queued jobs only deployments with at
+    # least BACKLOG_MIN_PRIORITY are queued, past the hard limit none are.
+    # Deferred deployments stay due and are queued once the backlog drains.
+    BACKLOG_SOFT_LIMIT = int(os.getenv("BACKLOG_SOFT_LIMIT", "1000"))  # 0 to disable
+    BACKLOG_HARD_LIMIT = int(os.getenv("BACKLOG_HARD_LIMIT", "5000"))  # 0 to disable
+    BACKLOG_MIN_PRIORITY = int(os.getenv("BACKLOG_MIN_PRIORITY", "1"))
+    # Per queue soft:hard limits, e.g. "default=1000:5000,aws=100:500"
+    QUEUE_BACKLOG_LIMITS = os.getenv("QUEUE_BACKLOG_LIMITS", "")
@@ -3,7 +3,10 @@ import requests
 from datetime import datetime, timedelta
 from time import sleep
 from croniter import croniter
+from prometheus_client import Counter, Histogram, start_http_server
 import logging
+import time
+import uuid
 import sys
 
 logger = logging.getLogger("scheduler")
@@ -15,9 +18,45 @@ if not logger.hasHandlers():
     logger.addHandler(handler)
     logger.propagate = False
 
+TICK_DURATION = Histogram(
+    "scheduler_tick_duration_seconds",
+    "Time to reap expired jobs and schedule due deployments in one tick",
+)
+JOBS_CREATED = Counter("scheduler_jobs_created_total", "Jobs created for due deployments")
+ERRORS = Counter("scheduler_errors_total", "Failed scheduler steps", ["step"])
+DEFERRED = Counter(
+    "scheduler_jobs_deferred_total",
+    "Due deployments not queued because of the queue backlog (soft or hard limit)",
+    ["queue", "limit"],
+)
+
+
+def parse_backlog_limits(value: str) -> dict:
+    """Parse "queue=soft:hard,..." into {queue: (soft, hard)}."""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        try:
+            queue, bounds = item.split("=")
+            soft, hard = bounds.split(":")
+            limits[queue.strip()] = (int(soft), int(hard))
+        except ValueError:
+            raise RuntimeError(f"Invalid QUEUE_BACKLOG_LIMITS entry: {item}")
+    return limits
+
+
+BACKLOG_LIMITS = parse_backlog_limits(Config.QUEUE_BACKLOG_LIMITS)
+
 
 def should_schedule(dep, now):
-    last = dep.get(" ")
+    # A deployment that keeps failing is held back by its circuit breaker
+    if dep.get("breaker_state") == "paused":
+        return False
+    if dep.get("breaker_until") and now < datetime.fromisoformat(dep["breaker_until"]):
+        return False
+
+    last = dep.get("last_scheduled_at")
     if not last:
         return True
 
@@ -30,27 +69,98 @@ def should_schedule(dep, now):
         return False
 
 
+def reap_expired_jobs():
+    """Ask the API to requeue or fail jobs whose worker stopped heartbeating."""
+    resp = requests.post(f"{Config.INTEGRATIONS_BASE_URL}/api/jobs/reap")
+    resp.raise_for_status()
+    reaped = resp.json()
+    if reaped["requeued"] or reaped["failed"]:
+        logger.warning(
+            f"Reaped expired jobs. Requeued: {reaped['requeued']}. Failed: {reaped['failed']}"
+        )
+
+
+def queue_backlog():
+    """Queued jobs per queue, or None if the API can't say (then nothing is held back)."""
+    try:
+        resp = requests.get(f"{Config.INTEGRATIONS_BASE_URL}/api/queues/scaling")
+        resp.raise_for_status()
+        return {q["queue"]: q["queued"] for q in resp.json()}
+    except Exception as e:
+        ERRORS.labels("backlog").inc()
+        logger.error(f"[Backlog error] {e}")
+        return None
+
+
+def backpressure(dep, backlog):
+    """Return the backlog limit ("soft" or "hard") that holds back this deployment, or None."""
+    if backlog is None:
+        return None
+    queue = dep.get("queue") or "default"
+    soft, hard = BACKLOG_LIMITS.get(queue, (Config.BACKLOG_SOFT_LIMIT, Config.BACKLOG_HARD_LIMIT))
+    depth = backlog.get(queue, 0)
+    if hard and depth >= hard:
+        return "hard"
+    if soft and depth >= soft and (dep.get("priority") or 0) < Config.BACKLOG_MIN_PRIORITY:
+        return "soft"
+    return None
+
+
+def create_job(dep):
+    """Queue a job for a deployment. The trace id started here follows the job through the API and worker."""
+    trace_id = uuid.uuid4().hex
+    resp = requests.post(
+        f"{Config.INTEGRATIONS_BASE_URL}/jobs",
+        json={"deployment_id": dep["id"]},
+        headers={"X-Trace-Id": trace_id}
+    )
+    resp.raise_for_status()
+    JOBS_CREATED.inc()
+    logger.info(f"[trace {trace_id}] Scheduled job {resp.json()['id']} for deployment {dep['id']}")
+
+
+def run_tick():
+    """Reap expired jobs, then queue a job for every deployment that is due."""
+    started = time.perf_counter()
+    try:
+        reap_expired_jobs()
+    except Exception as e:
+        ERRORS.labels("reap").inc()
+        logger.error(f"[Reaper error] {e}")
+
+    try:
+        now = datetime.utcnow()
+        r = requests.get(f"{Config.INTEGRATIONS_BASE_URL}/api/deployments/scheduled")
+        r.raise_for_status()
+        deployments = r.json()
+        logger.info(f"Received {len(deployments)} deployments from API server")
+        due = [dep for dep in deployments if should_schedule(dep, now)]
+        backlog = queue_backlog() if due else None
+        # Higher priority first, so they get in before a limit is reached this tick
+        for dep in sorted(due, key=lambda d: d.get("priority") or 0, reverse=True):
+            queue = dep.get("queue") or "default"
+            limit = backpressure(dep, backlog)
+            if limit:
+                DEFERRED.labels(queue, limit).inc()
+                logger.warning(f"Deferred deployment {dep['id']}: queue {queue} is past its {limit} backlog limit")
+                continue
+            create_job(dep)
+            if backlog is not None:
+                backlog[queue] = backlog.get(queue, 0) + 1
+
+    except Exception as e:
+        ERRORS.labels("schedule").inc()
+        logger.error(f"[Scheduler error] {e}")
+    TICK_DURATION.observe(time.perf_counter() - started)
+
+
 def scheduler_loop():
     while True:
-        try:
-            now = datetime.utcnow()
-            r = requests.get(f"{Config.INTEGRATIONS_BASE_URL}/api/deployments/scheduled")
-            r.raise_for_status()
-            deployments = r.json()
-            logger.info(f"Received {len(deployments)} deployments from API server")
-            for dep in deployments:
-                if should_schedule(dep, now):
-                    job_payload = {"deployment_id": dep["id"]}
-                    resp = requests.post(
-                        f"{Config.INTEGRATIONS_BASE_URL}/jobs", json=job_payload
-                    )
-                    resp.raise_for_status()
-
-        except Exception as e:
-            logger.error(f"[Scheduler error] {e}")
-
+        run_tick()
         sleep(Config.POLL_INTERVAL)
 
 
 if __name__ == "__main__":
+    if Config.METRICS_PORT:
+        start_http_server(Config.METRICS_PORT)
     scheduler_loop()
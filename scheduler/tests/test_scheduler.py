@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from config import Config
+
+NOW = datetime(2024, 1, 1, 12, 0, 30)
+
+
+def deployment(**fields):
+    return {"id": 1, "schedule": "* * * * *", "queue": "default", "priority": 0, **fields}
+
+
+def test_should_schedule_first_run():
+    assert main.should_schedule(deployment(), NOW)
+
+
+def test_should_schedule_follows_cron():
+    assert main.should_schedule(deployment(last_scheduled_at="2024-01-01T11:59:10"), NOW)
+    assert not main.should_schedule(deployment(last_scheduled_at="2024-01-01T12:00:10"), NOW)
+
+
+def test_should_schedule_skips_bad_cron():
+    assert not main.should_schedule(deployment(schedule="not cron", last_scheduled_at="2024-01-01T11:00:00"), NOW)
+
+
+def test_should_schedule_respects_breaker():
+    assert not main.should_schedule(deployment(breaker_state="paused"), NOW)
+    later = (NOW + timedelta(minutes=5)).isoformat()
+    assert not main.should_schedule(deployment(breaker_state="open", breaker_until=later), NOW)
+    earlier = (NOW - timedelta(minutes=5)).isoformat()
+    assert main.should_schedule(deployment(breaker_state="half-open", breaker_until=earlier), NOW)
+
+
+def test_parse_backlog_limits():
+    assert main.parse_backlog_limits("default=10:20, aws=1:2") == {"default": (10, 20), "aws": (1, 2)}
+    assert main.parse_backlog_limits("") == {}
+    with pytest.raises(RuntimeError):
+        main.parse_backlog_limits("default=10")
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(Config, "BACKLOG_SOFT_LIMIT", 10)
+    monkeypatch.setattr(Config, "BACKLOG_HARD_LIMIT", 20)
+    monkeypatch.setattr(Config, "BACKLOG_MIN_PRIORITY", 1)
+    monkeypatch.setattr(main, "BACKLOG_LIMITS", {"aws": (1, 2)})
+
+
+def test_backpressure(limits):
+    assert main.backpressure(deployment(), {"default": 9}) is None
+    assert main.backpressure(deployment(), {"default": 10}) == "soft"
+    assert main.backpressure(deployment(priority=1), {"default": 10}) is None
+    assert main.backpressure(deployment(priority=1), {"default": 20}) == "hard"
+    assert main.backpressure(deployment(), None) is None
+
+
+def test_backpressure_per_queue_limits(limits):
+    assert main.backpressure(deployment(queue="aws"), {"aws": 1}) == "soft"
+    assert main.backpressure(deployment(queue="aws", priority=5), {"aws": 2}) == "hard"
+    assert main.backpressure(deployment(queue="other"), {"aws": 100}) is None
+
+
+def test_backpressure_disabled(limits, monkeypatch):
+    monkeypatch.setattr(Config, "BACKLOG_SOFT_LIMIT", 0)
+    monkeypatch.setattr(Config, "BACKLOG_HARD_LIMIT", 0)
+    assert main.backpressure(deployment(), {"default": 10000}) is None
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Stand in for the API server: due deployments and queue backlog in, created jobs out."""
+    state = {"deployments": [], "backlog": [], "created": []}
+
+    def get(url, **kwargs):
+        if url.endswith("/api/deployments/scheduled"):
+            return FakeResponse(state["deployments"])
+        return FakeResponse(state["backlog"])
+
+    def post(url, json=None, **kwargs):
+        if url.endswith("/api/jobs/reap"):
+            return FakeResponse({"requeued": [], "failed": []})
+        state["created"].append(json["deployment_id"])
+        return FakeResponse({"id": len(state["created"])})
+
+    monkeypatch.setattr(main.requests, "get", get)
+    monkeypatch.setattr(main.requests, "post", post)
+    return state
+
+
+def test_run_tick_queues_higher_priority_first_until_limit(api, limits):
+    api["deployments"] = [deployment(id=n, priority=n) for n in range(1, 5)] + [
+        deployment(id=9, breaker_state="paused"),
+    ]
+    api["backlog"] = [{"queue": "default", "queued": 18}]
+
+    main.run_tick()
+
+    # Every job queued this tick counts towards the hard limit of 20
+    assert api["created"] == [4, 3]
+
+
+def test_run_tick_without_backlog_queues_everything(api, limits, monkeypatch):
+    api["deployments"] = [deployment(id=n) for n in range(1, 4)]
+
+    def unavailable(url, **kwargs):
+        if url.endswith("/api/queues/scaling"):
+            raise ConnectionError("API down")
+        return FakeResponse(api["deployments"])
+
+    monkeypatch.setattr(main.requests, "get", unavailable)
+    main.run_tick()
+
+    assert sorted(api["created"]) == [1, 2, 3]
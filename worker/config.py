@@ -1,4 +1,5 @@
 import os
+import socket
 
 
 class Config:
@@ -7,21 +8,53 @@ class Config:
     INTEGRATIONS_TOKEN = os.getenv("INTEGRATIONS_TOKEN", "changeme")
 
     # Worker
-    POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))  # seconds
+    POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))  # seconds, max idle backoff
+    POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "1"))  # seconds, first idle backoff
+    HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "30"))  # seconds
+    HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     DEBUG = os.getenv("DEBUG", "true").lower() == "true"
     TASK_TIMEOUT = int(os.getenv("TASK_TIMEOUT", "180"))
+    WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Prometheus /metrics, 0 to disable
+    HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))  # seconds, keep below the API lease
+    CANCEL_CHECK_INTERVAL = int(os.getenv("CANCEL_CHECK_INTERVAL", "5"))  # seconds between heartbeats while running
     QUEUE = os.getenv("QUEUE", "default")
+    # Comma separated queues with optional weights, e.g. "default:3,aws:1"
+    QUEUES = os.getenv("QUEUES", QUEUE)
+    CONCURRENCY = int(os.getenv("CONCURRENCY", "1"))  # job slots per worker process
 
     # GitHub
     GITHUB_REPO_URL = os.getenv("GITHUB_REPO_URL")  # e.g. https://github.com/org/integrations
     GITHUB_RAW_URL = os.getenv("GITHUB_RAW_URL")    # e.g. https://raw.githubusercontent.com/org/repo/main/integrations.json
+    GITHUB_BRANCH = os.getenv("GITHUB_BRANCH", "main")
+    GIT_SHALLOW = os.getenv("GIT_SHALLOW", "true").lower() == "true"  # fetch only the latest commit
+    GIT_SPARSE = os.getenv("GIT_SPARSE", "false").lower() == "true"  # check out only synced integrations
+    # Comma separated integrations this worker syncs and runs. Empty means all enabled ones.
+    SYNC_INTEGRATIONS = [i.strip() for i in os.getenv("SYNC_INTEGRATIONS", "").split(",") if i.strip()]
 
 
+    # Process pool
+    POOL_PREWARM = os.getenv("POOL_PREWARM", "false").lower() == "true"  # start children right after sync
+    POOL_MIN_IDLE = int(os.getenv("POOL_MIN_IDLE", "1"))  # warm children per integration when prewarming
+    POOL_MAX_IDLE = int(os.getenv("POOL_MAX_IDLE", os.getenv("CONCURRENCY", "1")))  # per integration revision
+    # Across all integrations, the longest idle children are stopped first
+    POOL_MAX_IDLE_TOTAL = int(os.getenv("POOL_MAX_IDLE_TOTAL", str(2 * max(CONCURRENCY, 1))))
+    POOL_MAX_JOBS_PER_CHILD = int(os.getenv("POOL_MAX_JOBS_PER_CHILD", "100"))  # recycle to contain leaks
+    POOL_START_TIMEOUT = int(os.getenv("POOL_START_TIMEOUT", "300"))  # seconds to import entry.py
+
     # Sync
     SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", "300"))  # seconds, default 5 mins
+    SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "4"))  # venvs built in parallel
+    LAZY_PROVISION = os.getenv("LAZY_PROVISION", "false").lower() == "true"  # build venvs on first job
+    VENV_DISK_BUDGET_MB = int(os.getenv("VENV_DISK_BUDGET_MB", "0"))  # 0 = no LRU eviction
+    USE_WHEELHOUSE = os.getenv("USE_WHEELHOUSE", "true").lower() == "true"
 
     # Paths
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))  # /worker
     INTEGRATIONS_DIR = os.path.join(BASE_DIR, "integrations")  # /worker/integrations
-    VENVS_DIR = os.path.join(BASE_DIR, "venvs")
\ No newline at end of file
+    VENVS_DIR = os.path.join(BASE_DIR, "venvs")
+    WHEELHOUSE_DIR = os.getenv("WHEELHOUSE_DIR", os.path.join(BASE_DIR, "wheelhouse"))
+    SYNC_STATE_PATH = os.getenv("SYNC_STATE_PATH", os.path.join(VENVS_DIR, "sync_state.json"))
+    RELEASES_DIR = os.getenv("RELEASES_DIR", os.path.join(BASE_DIR, "releases"))
+    VENV_ARCHIVE_DIR = os.getenv("VENV_ARCHIVE_DIR")  # shared directory/volume for exported venvs
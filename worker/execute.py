@@ -1,23 +1,138 @@
+import os
 import sys
 import json
+import time
+import cProfile
+import resource
+import traceback
 
-# argv[1] = config path
-# argv[2] = result path
-# argv[3] = repo root (for utils and config)
+# Long-lived child process started by pool.py with the integration's venv python.
+#
+# argv[1] = integration directory (so entry.py is importable)
+# argv[2] = repo root (for utils and config)
+# argv[3] = integration name
+# argv[4] = API server url
+#
+# The entry module is imported once at startup. After that the child reads one
+# JSON request per line from stdin and writes one JSON response per line to the
+# protocol pipe (the original stdout). Anything the integration prints goes to
+# stderr so it can't corrupt the protocol.
+#
+# Every response carries the job's resource usage in "metrics". A request with
+# "profile" set to a file path runs the job under cProfile and dumps the stats there.
+# A failed job's response says whether the error is "transient", so it may be retried.
+
+integration_path, repo_root, integration_name, api_server = sys.argv[1:5]
+
+protocol = os.fdopen(os.dup(1), "w")
+os.dup2(2, 1)
+
+
+def send(message: dict):
+    protocol.write(json.dumps(message, default=str) + "\n")
+    protocol.flush()
 
-with open(sys.argv[1], "r") as f:
-    config = json.load(f)
 
 # Add repo root so utils and config are importable
-sys.path.insert(0, sys.argv[3])
+sys.path.insert(0, repo_root)
 
 # Add integration directory so entry.py is importable
-sys.path.insert(0, sys.argv[4])
+sys.path.insert(0, integration_path)
+
+
+def cpu_seconds() -> float:
+    """User + system CPU of this process and any subprocesses it waited for."""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def reset_peak_rss():
+    # Linux only: resets VmHWM so the peak covers the current job, not the child's lifetime
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Exceptions, by class name anywhere in their MRO, that usually clear up on
+# their own: network failures and timeouts, from the stdlib or requests
+TRANSIENT_ERRORS = {"ConnectionError", "TimeoutError", "Timeout"}
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    An integration can decide by setting a "transient" attribute on the exception.
+    Otherwise network errors, timeouts and HTTP 429/5xx responses are transient.
+    """
+    if getattr(error, "transient", None) is not None:
+        return bool(error.transient)
+    if any(cls.__name__ in TRANSIENT_ERRORS for cls in type(error).__mro__):
+        return True
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) in TRANSIENT_STATUS_CODES
+
+
+def count_tasks(result):
+    """Number of tasks in a Runner result, if it has a recognizable shape."""
+    if isinstance(result, dict) and isinstance(result.get("tasks"), (list, dict)):
+        return len(result["tasks"])
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return None
+
+
+import_started = time.perf_counter()
+try:
+    from entry import Runner
+
+    # Set name from folder so entry.py doesn't need to define it
+    Runner.name = integration_name
+    Runner.api_server = api_server
+except Exception:
+    send({"ready": False, "error": traceback.format_exc()})
+    sys.exit(1)
+
+send({"ready": True, "pid": os.getpid(), "import_seconds": time.perf_counter() - import_started})
 
-from entry import Runner
+for line in sys.stdin:
+    if not line.strip():
+        continue
+    request = json.loads(line)
+    profiler = cProfile.Profile() if request.get("profile") else None
+    result = None
 
-runner = Runner(config)
-result = runner.run()
+    reset_peak_rss()
+    cpu_started = cpu_seconds()
+    run_started = time.perf_counter()
+    try:
+        runner = Runner(request["config"])
+        result = profiler.runcall(runner.run) if profiler else runner.run()
+        response = {"ok": True, "result": result}
+    except Exception as e:
+        response = {"ok": False, "error": traceback.format_exc(), "transient": is_transient(e)}
 
-with open(sys.argv[2], "w") as f:
-    json.dump(result, f)
\ No newline at end of file
+    response["metrics"] = {
+        "run_seconds": round(time.perf_counter() - run_started, 3),
+        "cpu_seconds": round(cpu_seconds() - cpu_started, 3),
+        "peak_rss_kb": peak_rss_kb(),
+        "tasks": count_tasks(result),
+    }
+    if profiler:
+        try:
+            profiler.dump_stats(request["profile"])
+        except OSError:
+            pass
+    send(response)
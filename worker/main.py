@@ -1,87 +1,358 @@
+import os
 import logging
 import time
+import tempfile
+from datetime import datetime, timedelta
 import traceback
 import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from prometheus_client import start_http_server
 from config import Config
 from sync import syncer
 from runner import run_integration
+from pool import pools, JobCancelled, TransientError
+from releases import releases
+from metrics import SLOTS, SLOTS_BUSY, FETCHES, JOB_DURATION, JOB_PHASE
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
+    format="%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s"
 )
 logger = logging.getLogger(__name__)
 
 
+def parse_queues(value: str) -> dict:
+    """
+    Parse a queue subscription string like "default:3,aws:1" into {queue: weight}.
+    Queues without an explicit weight default to 1.
+    """
+    queues = {}
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, weight = item.partition(":")
+        queues[name.strip()] = max(float(weight or 1), 0.01)
+    return queues or {"default": 1.0}
+
+
+def create_session(concurrency: int) -> requests.Session:
+    """
+    Keep-alive session shared by all job slots and their heartbeat threads, with
+    retry and backoff on connection errors only. Claims and results are not
+    idempotent, so a request that may have reached the API (read timeout, 5xx)
+    is never sent again.
+    """
+    retry = Retry(
+        total=Config.HTTP_RETRIES,
+        connect=Config.HTTP_RETRIES,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=0.5,
+        allowed_methods=["GET", "POST"],
+    )
+    # One connection per slot plus one per slot's heartbeat thread
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency * 2, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def job_spans(started_at: datetime, metrics: dict) -> list:
+    """
+    Trace spans for the worker side of a job, laid out back to back from when
+    the job was claimed. Phases the job didn't go through are left out.
+    """
+    spans = [{
+        "name": "job",
+        "service": "worker",
+        "start": started_at.isoformat(),
+        "duration_ms": round(metrics.get("wall_seconds", 0) * 1000, 1),
+    }]
+    offset = 0.0
+    for name, key in [
+        ("sync_wait", "provision_seconds"),
+        ("import", "import_seconds"),
+        ("run", "run_seconds"),
+        ("post", "post_seconds"),
+    ]:
+        if metrics.get(key) is None:
+            continue
+        spans.append({
+            "name": name,
+            "service": "worker",
+            "start": (started_at + timedelta(seconds=offset)).isoformat(),
+            "duration_ms": round(metrics[key] * 1000, 1),
+        })
+        JOB_PHASE.labels(name).observe(metrics[key])
+        offset += metrics[key]
+    return spans
+
+
 class JobWorker:
     def __init__(self):
         self.integrations_base_url = Config.INTEGRATIONS_BASE_URL
-        self.queue = Config.QUEUE
+        self.queues = parse_queues(Config.QUEUES)
+        self.concurrency = max(Config.CONCURRENCY, 1)
         self.poll_interval = Config.POLL_INTERVAL
+        self.min_poll_interval = min(Config.POLL_MIN_INTERVAL, self.poll_interval)
+        self.session = create_session(self.concurrency)
+        self.worker_id = Config.WORKER_ID
 
     def run_forever(self):
+        if Config.METRICS_PORT:
+            start_http_server(Config.METRICS_PORT)
+        SLOTS.set(self.concurrency)
+
         # Sync on startup before polling
         logger.info("Running initial sync...")
         syncer.sync()
         syncer.start_background_sync()
 
+        if Config.POOL_PREWARM and releases.current():
+            logger.info("Prewarming integration process pools...")
+            pools.prewarm(releases.current())
+
+        logger.info(f"Starting {self.concurrency} job slot(s). Queues: {self.queues}")
+        slots = [
+            threading.Thread(target=self.run_slot, name=f"slot-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for slot in slots:
+            slot.start()
+
+        while any(slot.is_alive() for slot in slots):
+            time.sleep(Config.SYNC_INTERVAL)
+            logger.info(f"Module cache: {pools.stats.as_dict()}")
+
+    def run_slot(self):
+        """
+        Poll for jobs and run them one at a time. Each slot runs in its own thread.
+        After a job the slot polls again right away. While the queues are empty it
+        backs off exponentially up to poll_interval, and resets as soon as it gets work.
+        """
+        idle_interval = self.min_poll_interval
         while True:
             job = self.fetch_job()
             if not job:
-                logger.info("No job found. Sleeping...")
-                self.sleep_with_jitter()
+                logger.debug(f"No job found. Sleeping {idle_interval:.0f}s...")
+                self.sleep_with_jitter(idle_interval)
+                idle_interval = min(idle_interval * 2, self.poll_interval)
                 continue
 
-            logger.info(f"Running job: {job['id']}. Deployment: {job['deployment_id']}")
+            idle_interval = self.min_poll_interval
+
+            trace_id = job.get("trace_id")
+            logger.info(f"[trace {trace_id}] Running job: {job['id']}. Deployment: {job['deployment_id']}")
+            SLOTS_BUSY.inc()
+            started_at = datetime.utcnow()
+            started = time.perf_counter()
+            cancelled = threading.Event()
+            lease_token = job.get("lease_token")
+            stop_heartbeat = self.start_heartbeat(job["id"], trace_id, cancelled, lease_token)
+            metrics = {}
+            transient = False
             try:
-                result, status = self.process_job(job)
-            except Exception:
+                result, status = self.process_job(job, metrics, cancelled)
+            except JobCancelled:
+                logger.warning(f"[trace {trace_id}] Job {job['id']} was cancelled")
+                result = {"error": "Cancelled"}
+                status = "cancelled"
+            except Exception as e:
                 tb = traceback.format_exc()
-                logger.error(f"Error running job {job['id']}:\n{tb}")
+                transient = isinstance(e, TransientError)
+                kind = "Transient error" if transient else "Error"
+                logger.error(f"[trace {trace_id}] {kind} running job {job['id']}:\n{tb}")
                 result = {"error": tb}
                 status = "error"
+            finally:
+                stop_heartbeat.set()
 
-            self.post_result(job["id"], status, result)
-            self.sleep_with_jitter()
+            self.post_result(
+                job["id"], status, result, metrics, job_spans(started_at, metrics), trace_id, transient, lease_token
+            )
+            JOB_DURATION.labels(job["integration_name"], status).observe(time.perf_counter() - started)
+            SLOTS_BUSY.dec()
+
+    def queue_order(self) -> list:
+        """
+        Return the subscribed queues in a weighted random order, so heavier
+        queues are polled first more often but lighter queues are never starved.
+        """
+        return sorted(
+            self.queues,
+            key=lambda q: random.random() ** (1.0 / self.queues[q]),
+            reverse=True
+        )
 
     def fetch_job(self):
-        try:
-            resp = requests.get(
-                f"{self.integrations_base_url}/jobs/next",
-                params={"queue": self.queue}
-            )
-            return resp.json() if resp.status_code == 200 else None
-        except Exception as e:
-            logger.error(f"Error fetching job: {e}")
+        """
+        Claim the next job on a subscribed queue, limited to the integrations in
+        this worker's current release so it never leases a job it can't run.
+        """
+        ready = self.ready_integrations()
+        if not ready:
+            logger.debug("No integrations ready yet, not claiming jobs")
             return None
 
-    def process_job(self, job):
+        for queue in self.queue_order():
+            try:
+                # In the body, a release can list more integrations than fit in a URL
+                resp = self.session.post(
+                    f"{self.integrations_base_url}/jobs/next",
+                    json={"queue": queue, "worker_id": self.worker_id, "integrations": ready},
+                    timeout=Config.HTTP_TIMEOUT
+                )
+                if resp.status_code == 200:
+                    FETCHES.labels(queue, "claimed").inc()
+                    return resp.json()
+                FETCHES.labels(queue, "empty").inc()
+            except Exception as e:
+                FETCHES.labels(queue, "error").inc()
+                logger.error(f"Error fetching job from queue '{queue}': {e}")
+        return None
+
+    def ready_integrations(self) -> list:
+        """
+        Integrations in the current release. With LAZY_PROVISION that includes
+        those whose venv is built by the first job, since the job can still run here.
+        """
+        release = releases.current()
+        if not release:
+            return []
+        return sorted(release["integrations"])
+
+    def process_job(self, job, metrics: dict = None, cancel: threading.Event = None):
         config = job["config"]
         config["job_id"] = job["id"]
 
-        result = run_integration(
-            integration_name=job["integration_name"],
-            config=config,
-            timeout=job.get("timeout", 3600)
-        )
+        profile = None
+        if job.get("profile"):
+            fd, profile = tempfile.mkstemp(prefix=f"job-{job['id']}-", suffix=".prof")
+            os.close(fd)
+
+        started = time.perf_counter()
+        try:
+            result = run_integration(
+                integration_name=job["integration_name"],
+                config=config,
+                timeout=job.get("timeout", 3600),
+                metrics=metrics,
+                profile=profile,
+                cancel=cancel
+            )
+        finally:
+            if metrics is not None:
+                metrics["wall_seconds"] = round(time.perf_counter() - started, 3)
+            if profile:
+                self.upload_artifact(job["id"], profile, f"{job['integration_name']}.prof", job.get("trace_id"))
+                os.remove(profile)
         return result, "done"
 
-    def post_result(self, job_id, status, result):
+    def post_result(
+        self,
+        job_id,
+        status,
+        result,
+        metrics: dict = None,
+        spans: list = None,
+        trace_id: str = None,
+        transient: bool = False,
+        lease_token: str = None
+    ):
+        """Report the job's outcome. A transient error may be retried by the API."""
+        started = time.perf_counter()
         try:
-            requests.post(
+            resp = self.session.post(
                 f"{self.integrations_base_url}/jobs/{job_id}/complete",
-                json={"status": status, "result": result},
+                json={
+                    "status": status,
+                    "result": result,
+                    "metrics": metrics,
+                    "spans": spans,
+                    "transient": transient,
+                    "worker_id": self.worker_id,
+                    "lease_token": lease_token
+                },
+                headers={"X-Trace-Id": trace_id or ""},
+                timeout=Config.HTTP_TIMEOUT
             )
-            logger.info(f"Posted result for job {job_id}")
+            if resp.status_code == 409:
+                logger.warning(f"[trace {trace_id}] Lease for job {job_id} was lost, result discarded by the API")
+                return
+            resp.raise_for_status()
+            logger.info(f"[trace {trace_id}] Posted result for job {job_id}")
         except Exception as e:
             tb = traceback.format_exc()
-            logger.error(f"Failed to post result for job {job_id}:\n{tb}")
+            logger.error(f"[trace {trace_id}] Failed to post result for job {job_id}:\n{tb}")
+        finally:
+            JOB_PHASE.labels("result_post").observe(time.perf_counter() - started)
+
+    def upload_artifact(self, job_id, path: str, name: str, trace_id: str = None):
+        """Attach a file to the job, e.g. the profile of a profiled run. Empty files are skipped."""
+        if not os.path.getsize(path):
+            return
+        try:
+            with open(path, "rb") as f:
+                resp = self.session.post(
+                    f"{self.integrations_base_url}/jobs/{job_id}/artifacts",
+                    files={"file": (name, f, "application/octet-stream")},
+                    headers={"X-Trace-Id": trace_id or ""},
+                    timeout=Config.HTTP_TIMEOUT
+                )
+            resp.raise_for_status()
+            logger.info(f"Uploaded artifact {name} for job {job_id}")
+        except Exception as e:
+            logger.error(f"Failed to upload artifact {name} for job {job_id}: {e}")
+
+    def start_heartbeat(
+        self,
+        job_id,
+        trace_id: str = None,
+        cancelled: threading.Event = None,
+        lease_token: str = None
+    ) -> threading.Event:
+        """
+        Renew the job's lease until the returned event is set. Heartbeats go out
+        every CANCEL_CHECK_INTERVAL (at most HEARTBEAT_INTERVAL), and when the
+        API answers that the job was cancelled the cancelled event is set. The
+        lease is still renewed after that, until the slot has released the job.
+        """
+        stop = threading.Event()
+        interval = min(Config.HEARTBEAT_INTERVAL, Config.CANCEL_CHECK_INTERVAL)
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    resp = self.session.post(
+                        f"{self.integrations_base_url}/jobs/{job_id}/heartbeat",
+                        json={"worker_id": self.worker_id, "lease_token": lease_token},
+                        headers={"X-Trace-Id": trace_id or ""},
+                        timeout=Config.HTTP_TIMEOUT
+                    )
+                    if resp.status_code == 409:
+                        logger.warning(f"Lease for job {job_id} was lost")
+                        return
+                    # Keep renewing the lease until the slot is done with the job, which
+                    # can take a while after a cancel, e.g. while a venv is being built
+                    if resp.ok and resp.json().get("cancel") and cancelled is not None and not cancelled.is_set():
+                        logger.info(f"Job {job_id} was cancelled, stopping it")
+                        cancelled.set()
+                except Exception as e:
+                    logger.warning(f"Heartbeat for job {job_id} failed: {e}")
+
+        threading.Thread(target=loop, name=f"heartbeat-{job_id}", daemon=True).start()
+        return stop
 
-    def sleep_with_jitter(self):
-        jitter = random.uniform(0, self.poll_interval * 0.5)
-        time.sleep(self.poll_interval + jitter)
+    def sleep_with_jitter(self, interval: float):
+        jitter = random.uniform(0, interval * 0.5)
+        time.sleep(interval + jitter)
 
 
 if __name__ == "__main__":
-    JobWorker().run_forever()
\ No newline at end of file
+    JobWorker().run_forever()
@@ -0,0 +1,32 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Exposed by each worker on METRICS_PORT
+
+SLOTS = Gauge("worker_slots", "Job slots in this worker")
+SLOTS_BUSY = Gauge("worker_slots_busy", "Job slots currently running a job")
+
+FETCHES = Counter(
+    "worker_job_fetches_total",
+    "Polls of /jobs/next by outcome (claimed, empty or error)",
+    ["queue", "outcome"],
+)
+
+JOB_DURATION = Histogram(
+    "worker_job_duration_seconds",
+    "Wall time of a job in the worker, from claim to result posted",
+    ["integration", "status"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+JOB_PHASE = Histogram(
+    "worker_job_phase_seconds",
+    "Time spent per job phase: sync_wait, import, run, post and result_post",
+    ["phase"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+
+POOL_CACHE = Counter(
+    "worker_pool_cache_total",
+    "Warm process pool lookups: hits, misses and invalidations",
+    ["event"],
+)
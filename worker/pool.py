@@ -0,0 +1,452 @@
+import os
+import json
+import time
+import select
+import signal
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from config import Config
+from releases import releases
+from metrics import POOL_CACHE
+
+logger = logging.getLogger(__name__)
+
+EXECUTE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "execute.py")
+
+
+class ChildExited(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class TransientError(RuntimeError):
+    """A job failure that may not happen again, so the API may retry the job."""
+    pass
+
+
+class ChildProcess:
+    """
+    A pre-forked child running execute.py with an integration's venv python.
+    The entry module is imported once when the child starts, so every job
+    after the first skips the import cost.
+    """
+
+    def __init__(self, name: str, python: str, integration_path: str, repo_root: str):
+        self.name = name
+        self.jobs_run = 0
+        self.import_seconds = None
+        self._buffer = b""
+        self.proc = subprocess.Popen(
+            [
+                python,
+                EXECUTE_SCRIPT,
+                integration_path,
+                repo_root,
+                name,
+                Config.INTEGRATIONS_BASE_URL,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            start_new_session=True,  # own process group, so kill() takes its children too
+        )
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def wait_ready(self, timeout: int):
+        try:
+            message = self._read(timeout)
+        except (TimeoutError, ChildExited):
+            self.kill()
+            raise TransientError(f"Integration '{self.name}' did not start within {timeout}s")
+        if not message.get("ready"):
+            self.kill()
+            raise RuntimeError(f"Integration '{self.name}' failed to load:\n{message.get('error')}")
+        self.import_seconds = message.get("import_seconds")
+
+    def run(
+        self,
+        config: dict,
+        timeout: int,
+        metrics: dict = None,
+        profile: str = None,
+        cancel: threading.Event = None
+    ) -> dict:
+        """
+        Send one job to the child and wait for its result. Raises TimeoutError,
+        ChildExited, or JobCancelled once the cancel event is set.
+
+        The job's resource usage is added to metrics, if given. The import phase
+        is only counted on the child's first job, later jobs reuse the loaded module.
+        """
+        cold = self.jobs_run == 0
+        self.jobs_run += 1
+        try:
+            self.proc.stdin.write((json.dumps({"config": config, "profile": profile}) + "\n").encode())
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise ChildExited
+
+        sent = time.perf_counter()
+        message = self._read(timeout, cancel)
+        if metrics is not None:
+            metrics.update(message.get("metrics", {}))
+            metrics["import_seconds"] = round(self.import_seconds or 0, 3) if cold else 0.0
+            # Result serialization and transfer back to the worker
+            metrics["post_seconds"] = round(
+                max(time.perf_counter() - sent - metrics.get("run_seconds", 0), 0), 3
+            )
+        if not message.get("ok"):
+            error = TransientError if message.get("transient") else RuntimeError
+            raise error(f"Integration '{self.name}' failed:\n{message.get('error')}")
+        return message.get("result")
+
+    def _read(self, timeout: int, cancel: threading.Event = None) -> dict:
+        """
+        Read one newline terminated JSON message from the child, waiting at most
+        timeout seconds. With a cancel event, it is checked every half second.
+        """
+        deadline = time.monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+        chunks = [self._buffer]
+        newline = self._buffer.find(b"\n")
+
+        while newline == -1:
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            wait = remaining if cancel is None else min(remaining, 0.5)
+            ready, _, _ = select.select([fd], [], [], wait)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ChildExited
+            newline = chunk.find(b"\n")
+            chunks.append(chunk)
+
+        data = b"".join(chunks)
+        line, _, self._buffer = data.partition(b"\n")
+        return json.loads(line)
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+
+class CacheStats:
+    """Hit/miss counters for warm children, i.e. for already loaded integration modules."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        POOL_CACHE.labels(counter).inc()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+class IdleBudget:
+    """
+    Caps the warm idle children of all pools together. Each pool keeps at most
+    POOL_MAX_IDLE of its own, but with many integrations and revisions those add
+    up, so once the total goes over the limit the child that has been idle the
+    longest is killed, whichever pool it is in.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # child -> pool, least recently released first
+
+    def add(self, pool, child: ChildProcess):
+        with self._lock:
+            self._idle[child] = pool
+            evicted = []
+            while len(self._idle) > self.limit:
+                evicted.append(self._idle.popitem(last=False))
+        for old, owner in evicted:
+            owner.evict(old)
+
+    def remove(self, child: ChildProcess):
+        with self._lock:
+            self._idle.pop(child, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._idle)
+
+
+class IntegrationPool:
+    """
+    Warm child processes for one integration venv at one synced revision. The
+    pool pins its release directories until it is retired.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        integration_path: str,
+        venv_path: str,
+        repo_root: str,
+        revision: str = None,
+        stats: CacheStats = None,
+        budget: IdleBudget = None
+    ):
+        self.name = name
+        self.integration_path = integration_path
+        self.venv_path = venv_path
+        self.python = os.path.join(venv_path, "bin", "python")
+        self.repo_root = repo_root
+        self.revision = revision
+        self.stats = stats or CacheStats()
+        self.budget = budget
+        self.retired = False
+        self._idle = []  # most recently released last
+        self._lock = threading.Lock()
+        self._paths = (integration_path, venv_path, repo_root)
+        releases.acquire(*self._paths)
+
+    def _spawn(self) -> ChildProcess:
+        child = ChildProcess(self.name, self.python, self.integration_path, self.repo_root)
+        child.wait_ready(Config.POOL_START_TIMEOUT)
+        logger.info(f"[{self.name}] Started pool process {child.pid}")
+        return child
+
+    def _spawn_idle(self):
+        try:
+            self._put_idle(self._spawn())
+        except Exception as e:
+            logger.error(f"[{self.name}] Failed to start pool process: {e}")
+
+    def prewarm(self):
+        """Start enough children in the background to reach POOL_MIN_IDLE."""
+        for _ in range(Config.POOL_MIN_IDLE - len(self._idle)):
+            threading.Thread(target=self._spawn_idle, daemon=True).start()
+
+    def _put_idle(self, child: ChildProcess):
+        with self._lock:
+            keep = not self.retired and len(self._idle) < Config.POOL_MAX_IDLE
+            if keep:
+                self._idle.append(child)
+        if not keep:
+            child.kill()
+        elif self.budget is not None:
+            self.budget.add(self, child)
+
+    def _take_idle(self):
+        with self._lock:
+            child = self._idle.pop() if self._idle else None
+        if child is not None and self.budget is not None:
+            self.budget.remove(child)
+        return child
+
+    def evict(self, child: ChildProcess):
+        """Kill an idle child to make room in the idle budget, unless it was just acquired."""
+        with self._lock:
+            if child not in self._idle:
+                return
+            self._idle.remove(child)
+        logger.info(f"[{self.name}] Stopping idle pool process {child.pid}, over the idle budget")
+        child.kill()
+
+    def acquire(self) -> ChildProcess:
+        while True:
+            child = self._take_idle()
+            if child is None:
+                self.stats.incr("misses")
+                return self._spawn()
+            if child.alive():
+                self.stats.incr("hits")
+                return child
+            # Died while idle: reap it, kill anything left in its process group
+            # and close its pipes before starting a replacement
+            logger.warning(f"[{self.name}] Idle pool process {child.pid} exited (code {child.proc.returncode})")
+            child.kill()
+
+    def release(self, child: ChildProcess):
+        if child.alive() and child.jobs_run < Config.POOL_MAX_JOBS_PER_CHILD:
+            self._put_idle(child)
+        else:
+            child.kill()
+
+    def discard(self, child: ChildProcess):
+        """Kill a child that can't be reused and start a replacement in the background."""
+        child.kill()
+        if not self.retired:
+            threading.Thread(target=self._spawn_idle, daemon=True).start()
+
+    def run(
+        self,
+        config: dict,
+        timeout: int,
+        metrics: dict = None,
+        profile: str = None,
+        cancel: threading.Event = None
+    ) -> dict:
+        child = self.acquire()
+        if cancel is not None and cancel.is_set():
+            # Cancelled while a child was starting, it's still fine to reuse
+            self.release(child)
+            raise JobCancelled
+        try:
+            result = child.run(config, timeout, metrics=metrics, profile=profile, cancel=cancel)
+        except JobCancelled:
+            logger.warning(f"[{self.name}] Killing pool process {child.pid}, job was cancelled")
+            self.discard(child)
+            raise
+        except TimeoutError:
+            logger.warning(f"[{self.name}] Killing pool process {child.pid} after {timeout}s timeout")
+            self.discard(child)
+            raise TransientError(f"Integration '{self.name}' timed out after {timeout}s")
+        except ChildExited:
+            self.discard(child)
+            raise TransientError(
+                f"Integration '{self.name}' process exited unexpectedly (code {child.proc.returncode})"
+            )
+        except Exception:
+            self.release(child)
+            raise
+        self.release(child)
+        return result
+
+    def shutdown(self):
+        """
+        Retire the pool. Idle children are killed now, busy ones when they are
+        released. Busy children's directories stay pinned by their running jobs.
+        """
+        with self._lock:
+            first = not self.retired
+            self.retired = True
+        if first:
+            releases.release(*self._paths)
+        while True:
+            child = self._take_idle()
+            if child is None:
+                return
+            child.kill()
+
+
+class PoolManager:
+    """
+    Pools keyed by integration name and synced revision. A sync only retires the
+    pools of integrations whose revision changed, so unchanged integrations keep
+    their loaded modules across syncs.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._revisions = {}  # integration -> revision in the latest sync
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+        self.budget = IdleBudget(Config.POOL_MAX_IDLE_TOTAL)
+
+    def get(
+        self,
+        name: str,
+        integration_path: str,
+        venv_path: str,
+        repo_root: str,
+        revision: str = None
+    ) -> IntegrationPool:
+        """
+        Return the pool for an integration at a revision. A job that checked out
+        a release before a sync superseded it gets a pool that is already
+        retired, so its child is stopped when the job ends rather than kept warm.
+        """
+        with self._lock:
+            pool = self._pools.get((name, revision))
+            if pool is not None:
+                return pool
+            pool = IntegrationPool(
+                name,
+                integration_path,
+                venv_path,
+                repo_root,
+                revision=revision,
+                stats=self.stats,
+                budget=self.budget
+            )
+            if self._revisions.get(name, revision) != revision:
+                pool.shutdown()
+                return pool
+            for key in [key for key in self._pools if key[0] == name]:
+                self._retire(key)
+            self._pools[(name, revision)] = pool
+            return pool
+
+    def prewarm(self, manifest: dict):
+        for name, entry in manifest["integrations"].items():
+            if not os.path.isfile(os.path.join(entry["venv"], ".complete")):
+                continue  # not provisioned yet
+            self.get(
+                name,
+                entry["path"],
+                entry["venv"],
+                manifest["shared"],
+                revision=entry["revision"],
+            ).prewarm()
+
+    def count_venv(self, venv_path: str) -> int:
+        """Number of pools running from a venv, each of which pins it once."""
+        with self._lock:
+            return sum(1 for pool in self._pools.values() if pool.venv_path == venv_path)
+
+    def retire_venv(self, venv_path: str):
+        """Retire pools running from a venv that is about to be evicted."""
+        with self._lock:
+            for key, pool in list(self._pools.items()):
+                if pool.venv_path == venv_path:
+                    pool.shutdown()
+                    del self._pools[key]
+
+    def retire_stale(self, revisions: dict):
+        """Retire pools whose integration changed or was removed in the latest sync."""
+        with self._lock:
+            self._revisions = dict(revisions)
+            for name, revision in list(self._pools):
+                if revisions.get(name) != revision:
+                    self._retire((name, revision))
+
+    def _retire(self, key: tuple):
+        name, revision = key
+        logger.info(f"[{name}] Retiring pool at revision {revision}")
+        self._pools.pop(key).shutdown()
+        self.stats.incr("invalidations")
+
+    def shutdown(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.shutdown()
+            self._pools.clear()
+
+
+# Singleton
+pools = PoolManager()
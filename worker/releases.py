@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class ReleaseStore:
+    """
+    Immutable, versioned copies of integration code and venvs.
+
+    A sync builds new directories next to the live ones, then publishes a release
+    manifest and flips the `current` symlink to it in one rename. Jobs pin the
+    directories of the release they started with, so they never see a half
+    updated tree. Directories that are neither in the current release nor pinned
+    are garbage-collected.
+
+    Layout under RELEASES_DIR:
+        integrations/<name>-<tree>/   code of one integration at one git tree
+        shared/<key>/                 repo root files and shared folders (utils)
+        revisions/<revision>-<ns>/    manifest.json for one published release
+        current -> revisions/<revision>-<ns>
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refs = collections.Counter()
+        self._cached = (None, None)  # (release dir, manifest)
+
+        for folder in ["integrations", "shared", "revisions"]:
+            os.makedirs(os.path.join(Config.RELEASES_DIR, folder), exist_ok=True)
+
+    @staticmethod
+    def integration_dir(name: str, tree: str) -> str:
+        return os.path.join(Config.RELEASES_DIR, "integrations", f"{name}-{tree[:12]}")
+
+    @staticmethod
+    def shared_dir(key: str) -> str:
+        return os.path.join(Config.RELEASES_DIR, "shared", key)
+
+    def current(self) -> dict:
+        """Return the manifest the `current` symlink points at, or None before the first publish."""
+        link = os.path.join(Config.RELEASES_DIR, "current")
+        try:
+            release_dir = os.path.realpath(link, strict=True)
+        except OSError:
+            return None
+
+        cached_dir, manifest = self._cached
+        if cached_dir != release_dir:
+            with open(os.path.join(release_dir, "manifest.json"), "r") as f:
+                manifest = json.load(f)
+            self._cached = (release_dir, manifest)
+        return manifest
+
+    def publish(self, revision: str, shared: str, integrations: dict):
+        """
+        Write the manifest for a revision and atomically point `current` at it.
+
+        Args:
+            revision: The git revision that was synced
+            shared: Directory holding the repo root files and shared folders
+            integrations: {name: {"path": code dir, "venv": venv dir, "revision": revision}}
+        """
+        # A fresh directory per publish, so `current` never points at a directory being rewritten
+        release_name = f"{revision}-{time.time_ns()}"
+        release_dir = os.path.join(Config.RELEASES_DIR, "revisions", release_name)
+        staging_dir = f"{release_dir}.tmp"
+        os.makedirs(staging_dir)
+        with open(os.path.join(staging_dir, "manifest.json"), "w") as f:
+            json.dump(
+                {"revision": revision, "shared": shared, "integrations": integrations},
+                f,
+                indent=2,
+                sort_keys=True
+            )
+        os.rename(staging_dir, release_dir)
+
+        link = os.path.join(Config.RELEASES_DIR, "current")
+        tmp_link = f"{link}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join("revisions", release_name), tmp_link)
+        os.replace(tmp_link, link)
+        logger.info(f"Published release {revision} with {len(integrations)} integration(s)")
+
+    def acquire(self, *paths):
+        """Keep the given directories from being garbage-collected until released."""
+        with self._lock:
+            self._refs.update(paths)
+
+    def release(self, *paths):
+        with self._lock:
+            self._refs.subtract(paths)
+            for path in paths:
+                if self._refs[path] <= 0:
+                    del self._refs[path]
+
+    def pins(self, path: str) -> int:
+        """Number of jobs and pools holding a directory."""
+        with self._lock:
+            return self._refs[path]
+
+    @contextmanager
+    def checkout(self, name: str):
+        """
+        Pin the current release's directories for one integration while a job uses
+        them. Yields (manifest, entry), either of which is None if not available.
+        """
+        with self._lock:
+            manifest = self.current()
+            entry = manifest["integrations"].get(name) if manifest else None
+            paths = [manifest["shared"], entry["path"], entry["venv"]] if entry else []
+            self._refs.update(paths)
+        try:
+            yield manifest, entry
+        finally:
+            self.release(*paths)
+
+    def remove(self, path: str) -> bool:
+        """Delete a directory unless a job or pool has it pinned. Returns whether it was removed."""
+        with self._lock:
+            if path in self._refs or not os.path.isdir(path):
+                return False
+            os.rename(path, f"{path}.deleting")
+        shutil.rmtree(f"{path}.deleting", ignore_errors=True)
+        return True
+
+    def collect_garbage(self):
+        """
+        Remove code, venv and manifest directories not used by the current release
+        or pinned. Staging directories are left to whoever is writing them.
+        """
+        candidates = []
+        for parent in [
+            os.path.join(Config.RELEASES_DIR, "integrations"),
+            os.path.join(Config.RELEASES_DIR, "shared"),
+            os.path.join(Config.RELEASES_DIR, "revisions"),
+            Config.VENVS_DIR,
+        ]:
+            # <dir>.tmp is a build or restore in progress, it's renamed into place when done
+            candidates.extend(
+                os.path.join(parent, entry.name)
+                for entry in os.scandir(parent)
+                if entry.is_dir() and not entry.name.endswith(".tmp")
+            )
+
+        # Decide and rename under the lock so a job can't pin a directory that is
+        # about to go. The slow delete happens afterwards.
+        with self._lock:
+            manifest = self.current()
+            if not manifest:
+                return
+            link = os.path.join(Config.RELEASES_DIR, "current")
+            keep = {manifest["shared"], os.path.join(Config.RELEASES_DIR, os.readlink(link))}
+            for entry in manifest["integrations"].values():
+                keep.update([entry["path"], entry["venv"]])
+            keep.update(self._refs)
+
+            doomed = []
+            for path in candidates:
+                if path in keep:
+                    continue
+                if not path.endswith(".deleting"):
+                    os.rename(path, f"{path}.deleting")
+                    path = f"{path}.deleting"
+                doomed.append(path)
+
+        for path in doomed:
+            shutil.rmtree(path, ignore_errors=True)
+        if doomed:
+            logger.info(f"Garbage-collected {len(doomed)} idle release director(ies)")
+
+
+# Singleton
+releases = ReleaseStore()
@@ -1,78 +1,82 @@
 import os
-import glob
+import time
 import logging
-import importlib.util
-import sys
-import concurrent.futures
-from config import Config
+import threading
+from pool import pools, JobCancelled, TransientError
+from releases import releases
+from sync import syncer
 
 logger = logging.getLogger(__name__)
 
 
-def run_integration(integration_name: str, config: dict, timeout: int = 3600) -> dict:
+def run_integration(
+    integration_name: str,
+    config: dict,
+    timeout: int = 3600,
+    metrics: dict = None,
+    profile: str = None,
+    cancel: threading.Event = None
+) -> dict:
     """
-    Execute an integration by loading its venv site-packages into sys.path
-    and importing the entry module directly.
+    Execute an integration in a warm child process started with the
+    integration's venv python. The job pins the current release, so a sync
+    that publishes a new revision meanwhile doesn't change the code or venv
+    under it. The child has already imported the entry module at that
+    revision, so only the run itself is paid per job. A venv that isn't
+    provisioned yet (LAZY_PROVISION, or evicted) is built first.
 
     Args:
         integration_name: The name of the integration (must match folder in integrations/)
         config: The job config dict to pass to the Runner
         timeout: Max seconds to wait for the integration to complete
+        metrics: Optional dict that receives the job's resource usage, also when it fails
+        profile: Optional file path to write cProfile stats of the run to
+        cancel: Optional event that kills the run when set
 
     Returns:
         dict: The result from the runner
 
     Raises:
-        RuntimeError: If the integration or venv is not found or times out
+        TransientError: If the integration is not in the current release yet, times
+            out, crashes, or raised an error it marked transient. A child that
+            times out is SIGKILLed and replaced.
+        RuntimeError: If the integration failed.
+        JobCancelled: If the cancel event was set. The child is SIGKILLed and replaced.
     """
-    integration_path = os.path.join(Config.INTEGRATIONS_DIR, integration_name)
-    venv_path = os.path.join(Config.VENVS_DIR, integration_name)
-
-    if not os.path.isdir(integration_path):
-        raise RuntimeError(f"Integration '{integration_name}' not found at {integration_path}")
-
-    if not os.path.isdir(venv_path):
-        raise RuntimeError(f"Venv for '{integration_name}' not found at {venv_path}. Has sync run?")
-
-    # Find the venv's site-packages
-    site_packages = glob.glob(os.path.join(venv_path, "lib", "python*", "site-packages"))
-    if not site_packages:
-        raise RuntimeError(f"No site-packages found in venv for '{integration_name}'")
-
-    injected_paths = [site_packages[0], integration_path]
-
-    # Inject venv and integration paths at the front of sys.path
-    for path in reversed(injected_paths):
-        sys.path.insert(0, path)
-
-    logger.info(f"[{integration_name}] Loading integration from {integration_path}")
-
-    try:
-        spec = importlib.util.spec_from_file_location(
-            f"{integration_name}.entry",
-            os.path.join(integration_path, "entry.py")
+    with releases.checkout(integration_name) as (release, entry):
+        if not release:
+            raise TransientError("No integrations release has been published. Has sync run?")
+        if not entry:
+            raise TransientError(
+                f"Integration '{integration_name}' not found in release {release['revision']}. Has sync run?"
+            )
+
+        marker = os.path.join(entry["venv"], ".complete")
+        if os.path.isfile(marker):
+            os.utime(marker)  # last used, for LRU eviction
+        else:
+            # Building a venv can't be interrupted, so check before and after
+            check_cancel(cancel)
+            started = time.perf_counter()
+            syncer.provision(integration_name, entry, release["shared"])
+            if metrics is not None:
+                metrics["provision_seconds"] = round(time.perf_counter() - started, 3)
+            check_cancel(cancel)
+
+        if not os.path.isfile(os.path.join(entry["venv"], "bin", "python")):
+            raise RuntimeError(f"No python interpreter found in venv for '{integration_name}'")
+
+        logger.info(f"[{integration_name}] Dispatching job to pool (revision {entry['revision']})")
+        pool = pools.get(
+            integration_name,
+            entry["path"],
+            entry["venv"],
+            release["shared"],
+            revision=entry["revision"]
         )
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-
-        # Set name from folder so entry.py doesn't need to define it
-        module.Runner.name = integration_name
-        module.Runner.api_server = Config.INTEGRATIONS_BASE_URL
-
-        runner = module.Runner(config)
+        return pool.run(config, timeout, metrics=metrics, profile=profile, cancel=cancel)
 
-        # Run with timeout enforcement
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(runner.run)
-            try:
-                return future.result(timeout=timeout)
-            except concurrent.futures.TimeoutError:
-                raise RuntimeError(
-                    f"Integration '{integration_name}' timed out after {timeout}s"
-                )
 
-    finally:
-        # Clean up injected paths from sys.path
-        for path in injected_paths:
-            if path in sys.path:
-                sys.path.remove(path)
\ No newline at end of file
+def check_cancel(cancel: threading.Event = None):
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled
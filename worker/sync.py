@@ -1,71 +1,291 @@
 import os
+import sys
+import json
+import shutil
+import tarfile
+import tempfile
 import subprocess
 import logging
 import threading
 import time
 import hashlib
+import platform
+import concurrent.futures
 import requests
 from config import Config
+from releases import releases
+from pool import pools
 
 logger = logging.getLogger(__name__)
 
 
+def venv_filter(member: tarfile.TarInfo, dest_path: str) -> tarfile.TarInfo:
+    """
+    tarfile's "data" extraction filter, except that symlinks may point outside
+    the archive: a venv's bin/python links to the base interpreter by absolute
+    path. The link itself must still be inside the venv, and "data" keeps any
+    later member from being written through it.
+    """
+    try:
+        return tarfile.data_filter(member, dest_path)
+    except (tarfile.AbsoluteLinkError, tarfile.LinkOutsideDestinationError):
+        if not member.issym():
+            raise
+    return member.replace(uid=None, gid=None, uname=None, gname=None, deep=False)
+
+
 class GitHubSync:
     def __init__(self):
         self.repo_url = Config.GITHUB_REPO_URL
-        self._req_hashes = {}
+        self.ready_integrations = []
+        self.revisions = {}
 
         os.makedirs(Config.INTEGRATIONS_DIR, exist_ok=True)
         os.makedirs(Config.VENVS_DIR, exist_ok=True)
+        os.makedirs(Config.WHEELHOUSE_DIR, exist_ok=True)
+        if Config.VENV_ARCHIVE_DIR:
+            os.makedirs(Config.VENV_ARCHIVE_DIR, exist_ok=True)
+
+        self._state_lock = threading.Lock()
+        self._venv_locks = {}
+        self._wheels_lock = threading.Lock()
+        self._sizes = {}
+        self.state = self._load_state()
 
     def sync(self):
-        """Pull latest code from GitHub and set up venvs for enabled integrations."""
+        """
+        Pull latest code from GitHub, build code and venv directories for changed
+        integrations next to the live ones, then atomically publish them as the
+        current release. Running jobs keep the release they started with.
+        """
         logger.info("Starting sync with GitHub...")
         try:
-            self._pull_repo()
             enabled = self._fetch_enabled_integrations()
-            self._setup_integrations(enabled)
-            logger.info("Sync complete.")
+            self._pull_repo(enabled)
+            revision = self._head_revision()
+            trees = self._tree_hashes()
+            changed = self._changed_integrations(revision)
+            shared = self._export(releases.shared_dir(self._shared_key(trees)), "HEAD", *self._shared_paths(trees))
+            self._setup_integrations(enabled, trees, changed, shared)
+            self.revisions = self._integration_revisions(self.ready_integrations, trees)
+            self._publish(revision, shared, trees)
+            with self._state_lock:
+                self.state["revision"] = revision
+                self._save_state()
+            logger.info(f"Sync complete at revision {revision}.")
         except Exception as e:
             logger.error(f"Sync failed: {e}")
             raise
 
-    def _pull_repo(self):
-        """Clone repo if it doesn't exist, otherwise pull latest."""
+    def _pull_repo(self, enabled: list):
+        """
+        Clone the repo if it doesn't exist, otherwise fetch and reset to the latest
+        commit of GITHUB_BRANCH. With GIT_SHALLOW only that commit is fetched. With
+        GIT_SPARSE only the shared files and the given integrations are checked out,
+        and blobs are fetched on demand for just those paths.
+        """
         git_dir = os.path.join(Config.BASE_DIR, ".git")
 
         if os.path.isdir(git_dir):
             logger.info("Repo exists, pulling latest...")
-            result = subprocess.run(
-                ["git", "pull", "origin", "main"],
-                cwd=Config.BASE_DIR,
-                capture_output=True,
-                text=True
-            )
-            if result.returncode != 0:
-                raise RuntimeError(f"git pull failed: {result.stderr}")
-            logger.info(result.stdout.strip())
         else:
             logger.info(f"Cloning repo from {self.repo_url}...")
-            for cmd in [
-                ["git", "init"],
-                ["git", "remote", "add", "origin", self.repo_url],
-                ["git", "fetch", "origin"],
-                ["git", "reset", "--hard", "origin/main"],
-            ]:
-                result = subprocess.run(
-                    cmd,
-                    cwd=Config.BASE_DIR,
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode != 0:
-                    raise RuntimeError(f"{' '.join(cmd)} failed: {result.stderr}")
-            logger.info("Clone complete.")
+            self._git("init")
+            self._git("remote", "add", "origin", self.repo_url)
+
+        fetch = ["fetch", "origin", Config.GITHUB_BRANCH]
+        if Config.GIT_SHALLOW:
+            fetch += ["--depth", "1"]
+        if Config.GIT_SPARSE:
+            fetch += ["--filter=blob:none"]
+        self._git(*fetch)
+
+        if Config.GIT_SPARSE:
+            self._git("sparse-checkout", "init", "--cone")
+            self._git("sparse-checkout", "set", "utils", *[f"integrations/{name}" for name in enabled])
+        elif self._git_config("core.sparseCheckout") == "true":
+            self._git("sparse-checkout", "disable")
+
+        self._git("reset", "--hard", "FETCH_HEAD")
+        logger.info(f"Checked out {Config.GITHUB_BRANCH} at {self._head_revision()}.")
+
+    def _git_config(self, key: str):
+        result = subprocess.run(
+            ["git", "config", "--get", key],
+            cwd=Config.BASE_DIR,
+            capture_output=True,
+            text=True
+        )
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def _load_state(self) -> dict:
+        """
+        Load the persisted sync state: the last synced git revision and, per
+        integration, the tree hash and requirement hashes its venv was built from.
+        """
+        try:
+            with open(Config.SYNC_STATE_PATH, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable sync state at {Config.SYNC_STATE_PATH}: {e}")
+            state = {}
+        state.setdefault("revision", None)
+        state.setdefault("integrations", {})
+        return state
+
+    def _save_state(self):
+        """Write the sync state atomically. Caller must hold _state_lock."""
+        tmp_path = f"{Config.SYNC_STATE_PATH}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, Config.SYNC_STATE_PATH)
+
+    def _update_state(self, name: str, entry: dict):
+        with self._state_lock:
+            self.state["integrations"][name] = entry
+            self._save_state()
+
+    def _git(self, *args) -> str:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=Config.BASE_DIR,
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"git {' '.join(args)} failed: {result.stderr}")
+        return result.stdout
+
+    def _head_revision(self) -> str:
+        return self._git("rev-parse", "HEAD").strip()
+
+    def _tree_hashes(self) -> dict:
+        """Return {path: git object hash} for each repo root entry and each integration folder."""
+        trees = {}
+        for treeish in ["HEAD", "HEAD:integrations"]:
+            prefix = "" if treeish == "HEAD" else "integrations/"
+            for line in self._git("ls-tree", treeish).splitlines():
+                meta, _, path = line.partition("\t")
+                trees[prefix + path] = meta.split()[2]
+        return trees
+
+    def _shared_paths(self, trees: dict) -> list:
+        """Repo root files and folders other than integrations/, e.g. utils and requirements.txt."""
+        return sorted(path for path in trees if "/" not in path and path != "integrations")
+
+    def _shared_key(self, trees: dict) -> str:
+        shared = "".join(f"{path}:{trees[path]}" for path in self._shared_paths(trees))
+        return hashlib.md5(shared.encode()).hexdigest()[:12]
+
+    def _export(self, dest: str, treeish: str, *paths) -> str:
+        """
+        Extract a git tree (optionally limited to paths) into dest. Directories are
+        immutable once written: an existing dest is reused, and a new one is built
+        in a staging directory and renamed into place.
+        """
+        if os.path.isdir(dest):
+            return dest
+
+        staging = f"{dest}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        proc = subprocess.Popen(
+            ["git", "archive", "--format=tar", treeish, *paths],
+            cwd=Config.BASE_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            tar.extractall(staging, filter="data")
+        stderr = proc.stderr.read().decode()
+        if proc.wait() != 0:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise RuntimeError(f"git archive {treeish} failed: {stderr}")
+        os.rename(staging, dest)
+        return dest
+
+    def _publish(self, revision: str, shared: str, trees: dict):
+        """Point the current release at the ready integrations, then drop what is no longer used."""
+        manifest = {
+            name: {
+                "path": releases.integration_dir(name, trees[f"integrations/{name}"]),
+                "venv": self.state["integrations"][name]["venv"],
+                "revision": self.revisions[name],
+            }
+            for name in self.ready_integrations
+        }
+        current = releases.current()
+        if not current or current["shared"] != shared or current["integrations"] != manifest:
+            releases.publish(revision, shared, manifest)
+        pools.retire_stale(self.revisions)
+        releases.collect_garbage()
+        self.evict_venvs()
+
+    def _changed_integrations(self, revision: str):
+        """
+        Return the names of integrations touched between the last synced revision
+        and this one, using git diff. A base requirements change touches every
+        integration. Returns None when the previous revision is unknown or no
+        longer in the clone, in which case integrations are compared by tree hash.
+        """
+        previous = self.state.get("revision")
+        if not previous:
+            return None
+        if previous == revision:
+            return set()
+
+        try:
+            # --no-renames: rename detection would need blobs a partial clone doesn't have
+            paths = self._git("diff", "--no-renames", "--name-only", previous, revision).splitlines()
+        except RuntimeError as e:
+            logger.warning(f"Can't diff against last synced revision {previous}: {e}")
+            return None
+
+        touched = {p.split("/")[1] for p in paths if p.startswith("integrations/") and p.count("/") >= 2}
+        if "requirements.txt" in paths:
+            # Base requirements are installed into every venv
+            touched |= set(self.state["integrations"])
+        return touched
+
+    def _needs_setup(self, name: str, tree: str, changed) -> bool:
+        entry = self.state["integrations"].get(name)
+        if (
+            not entry
+            or not entry.get("venv")
+            or not os.path.isdir(releases.integration_dir(name, tree))
+        ):
+            return True
+        if not Config.LAZY_PROVISION and not os.path.isfile(os.path.join(entry["venv"], ".complete")):
+            return True
+        if changed is None:
+            base_req = os.path.join(Config.BASE_DIR, "requirements.txt")
+            base_hash = self._hash_file(base_req) if os.path.isfile(base_req) else None
+            return entry.get("tree") != tree or entry.get("base_req") != base_hash
+        # The tree check catches integrations whose setup failed on an earlier
+        # sync: the saved revision moved on, but their entry didn't
+        return name in changed or entry.get("tree") != tree
+
+    def _integration_revisions(self, names: list, trees: dict) -> dict:
+        """
+        Return {name: revision} for the given integrations. The revision is the git
+        tree hash of the integration folder combined with the shared root files
+        (utils, base requirements), so it only changes when a sync touches files
+        that integration loads.
+        """
+        shared = self._shared_key(trees)
+        return {
+            name: hashlib.md5(
+                (trees.get(f"integrations/{name}", "") + shared).encode()
+            ).hexdigest()[:12]
+            for name in names
+        }
 
     def _fetch_enabled_integrations(self):
         """
-        Fetch integrations.json from GitHub and return only enabled integration names.
+        Fetch integrations.json from GitHub and return only enabled integration names,
+        limited to SYNC_INTEGRATIONS when set.
         """
         try:
             resp = requests.get(Config.GITHUB_RAW_URL, timeout=10)
@@ -73,12 +293,22 @@ class GitHubSync:
             integrations = resp.json()
             enabled = [i["name"] for i in integrations if i.get("enabled")]
             logger.info(f"Found {len(enabled)} enabled integrations: {enabled}")
-            return enabled
         except Exception as e:
             raise RuntimeError(f"Failed to fetch integrations.json from GitHub: {e}")
 
-    def _setup_integrations(self, enabled: list):
-        """For each enabled integration, create venv and install deps if needed."""
+        if Config.SYNC_INTEGRATIONS:
+            enabled = [name for name in enabled if name in Config.SYNC_INTEGRATIONS]
+            logger.info(f"Limited to {len(enabled)} integrations by SYNC_INTEGRATIONS: {enabled}")
+        return enabled
+
+    def _setup_integrations(self, enabled: list, trees: dict, changed=None, shared: str = None):
+        """
+        Export code and build venvs for every enabled integration that changed
+        since the last sync, SYNC_WORKERS at a time. An integration that fails to
+        build is logged and left out of ready_integrations instead of failing the
+        whole sync.
+        """
+        candidates = []
         for name in enabled:
             integration_path = os.path.join(Config.INTEGRATIONS_DIR, name)
 
@@ -90,65 +320,301 @@ class GitHubSync:
                 logger.warning(f"[{name}] No entry.py found, skipping.")
                 continue
 
-            logger.info(f"[{name}] Setting up integration...")
-            self._ensure_venv(name, integration_path)
+            candidates.append((name, integration_path, trees.get(f"integrations/{name}")))
 
-    def _ensure_venv(self, name: str, integration_path: str):
-        """Create venv and install base + integration requirements if they've changed."""
-        venv_path = os.path.join(Config.VENVS_DIR, name)
-        pip_path = os.path.join(venv_path, "bin", "pip")
+        ready = []
+        pending = []
+        for name, integration_path, tree in candidates:
+            if self._needs_setup(name, tree, changed):
+                pending.append((name, integration_path, tree))
+            else:
+                ready.append(name)
+        logger.info(f"{len(pending)} integration(s) changed, {len(ready)} unchanged since last sync.")
+
+        if pending and not Config.LAZY_PROVISION:
+            # Every venv installs the base requirements, so build their wheels once up front
+            self._build_base_wheels()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Config.SYNC_WORKERS) as executor:
+            futures = {
+                executor.submit(self._prepare_integration, name, tree, shared): name
+                for name, _, tree in pending
+            }
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                    ready.append(name)
+                except Exception as e:
+                    logger.error(f"[{name}] Setup failed: {e}")
+
+        self.ready_integrations = [name for name, _, _ in candidates if name in ready]
+
+    def _build_base_wheels(self):
+        """Build wheels for the base requirements into the shared wheelhouse."""
         base_req = os.path.join(Config.BASE_DIR, "requirements.txt")
-        integration_req = os.path.join(integration_path, "requirements.txt")
+        if not Config.USE_WHEELHOUSE or not os.path.isfile(base_req):
+            return
+
+        with self._wheels_lock:
+            current_hash = self._hash_file(base_req)
+            if self.state.get("wheelhouse_base") == current_hash:
+                return
 
-        # Create venv if it doesn't exist
-        if not os.path.isdir(venv_path):
-            logger.info(f"[{name}] Creating venv...")
+            logger.info("Building base requirement wheels into wheelhouse...")
+            result = self._build_wheels([sys.executable, "-m", "pip"], base_req)
+            if result.returncode != 0:
+                # Not fatal, each venv falls back to building what it's missing
+                logger.warning(f"Building base wheels failed: {result.stderr}")
+                return
+            with self._state_lock:
+                self.state["wheelhouse_base"] = current_hash
+                self._save_state()
+
+    def _build_wheels(self, pip: list, req_file: str) -> subprocess.CompletedProcess:
+        """
+        Build wheels for a requirements file and move them into the wheelhouse.
+        Other threads install from the wheelhouse meanwhile, so wheels are built in
+        a private directory and each one appears there in a single rename.
+        """
+        staging = tempfile.mkdtemp(prefix=".build-", dir=Config.WHEELHOUSE_DIR)
+        try:
             result = subprocess.run(
-                ["python3", "-m", "venv", venv_path],
+                [*pip, "wheel", "--find-links", Config.WHEELHOUSE_DIR, "-w", staging, "-r", req_file],
+                capture_output=True,
+                text=True
+            )
+            if result.returncode == 0:
+                for wheel in os.listdir(staging):
+                    dest = os.path.join(Config.WHEELHOUSE_DIR, wheel)
+                    if not os.path.exists(dest):
+                        os.replace(os.path.join(staging, wheel), dest)
+            return result
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _pip_install(self, name: str, pip_path: str, req_file: str, label: str):
+        """
+        Install a requirements file. With USE_WHEELHOUSE, install offline from the
+        shared wheelhouse first and only build/download wheels that are missing,
+        so dependencies shared between integrations are built once.
+        """
+        if not Config.USE_WHEELHOUSE:
+            result = subprocess.run(
+                [pip_path, "install", "-r", req_file],
                 capture_output=True,
                 text=True
             )
             if result.returncode != 0:
-                raise RuntimeError(f"[{name}] venv creation failed: {result.stderr}")
+                raise RuntimeError(f"[{name}] {label} pip install failed: {result.stderr}")
+            return
+
+        offline = [pip_path, "install", "--no-index", "--find-links", Config.WHEELHOUSE_DIR, "-r", req_file]
+        result = subprocess.run(offline, capture_output=True, text=True)
+        if result.returncode == 0:
+            return
+
+        logger.info(f"[{name}] Building missing {label} wheels into wheelhouse...")
+        result = self._build_wheels([pip_path], req_file)
+        if result.returncode != 0:
+            raise RuntimeError(f"[{name}] {label} pip wheel failed: {result.stderr}")
+
+        result = subprocess.run(offline, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"[{name}] {label} pip install failed: {result.stderr}")
+
+    def _prepare_integration(self, name: str, tree: str, shared: str):
+        """
+        Export the integration's code at this tree and make sure its venv exists.
+        With LAZY_PROVISION the venv is only resolved here and built by the first job.
+        """
+        integration_path = self._export(releases.integration_dir(name, tree), tree)
+        entry = self._ensure_venv(name, integration_path, shared, build=not Config.LAZY_PROVISION)
+        entry["tree"] = tree
+        self._update_state(name, entry)
+
+    def provision(self, name: str, entry: dict, shared: str):
+        """
+        Build the venv of a release entry on demand, for the first job that needs
+        it. Concurrent jobs for the same venv wait for one shared build. Evicts
+        least recently used venvs afterwards if VENV_DISK_BUDGET_MB is exceeded.
+        """
+        logger.info(f"[{name}] Provisioning venv on demand...")
+        self._build_base_wheels()
+        self._ensure_venv(name, entry["path"], shared)
+        self.evict_venvs()
+
+    def evict_venvs(self):
+        """
+        Delete least recently used venvs until VENVS_DIR fits in VENV_DISK_BUDGET_MB.
+        Venvs a running job uses are skipped. Without LAZY_PROVISION the current
+        release's venvs are kept too, since the next sync would only rebuild them.
+        """
+        if not Config.VENV_DISK_BUDGET_MB:
+            return
+        budget = Config.VENV_DISK_BUDGET_MB * 1024 * 1024
+
+        keep = set()
+        manifest = releases.current()
+        if manifest and not Config.LAZY_PROVISION:
+            keep = {entry["venv"] for entry in manifest["integrations"].values()}
+
+        venvs = []
+        for item in os.scandir(Config.VENVS_DIR):
+            marker = os.path.join(item.path, ".complete")
+            if item.is_dir() and os.path.isfile(marker):
+                venvs.append((os.path.getmtime(marker), item.path, self._dir_size(item.path)))
+
+        total = sum(size for _, _, size in venvs)
+        for _, path, size in sorted(venvs):
+            if total <= budget:
+                break
+            if path in keep:
+                continue
+            # Pins beyond the pools' own are running jobs, so leave the pools be
+            if releases.pins(path) > pools.count_venv(path):
+                continue
+            # Idle warm children would otherwise keep the venv pinned forever
+            pools.retire_venv(path)
+            with self._venv_lock(os.path.basename(path)):
+                if releases.remove(path):
+                    logger.info(f"Evicted least recently used venv {os.path.basename(path)}")
+                    self._sizes.pop(path, None)
+                    total -= size
+
+    def _dir_size(self, path: str) -> int:
+        if path not in self._sizes:
+            self._sizes[path] = sum(
+                os.lstat(os.path.join(root, f)).st_size
+                for root, _, files in os.walk(path)
+                for f in files
+            )
+        return self._sizes[path]
+
+    def _ensure_venv(self, name: str, integration_path: str, shared: str, build: bool = True) -> dict:
+        """
+        Return a venv with the base + integration requirements installed, or only
+        resolve where it lives when build is False.
+
+        Venvs are content-addressed by the Python version and the requirement
+        hashes, so integrations with identical requirements share one venv and a
+        requirements change builds a new venv next to the one running jobs use.
+        With VENV_ARCHIVE_DIR set, a venv is restored from an archive another
+        replica exported instead of being rebuilt, and new builds are exported.
+        """
+        base_req = os.path.join(shared, "requirements.txt")
+        integration_req = os.path.join(integration_path, "requirements.txt")
+        entry = {
+            "base_req": self._hash_file(base_req) if os.path.isfile(base_req) else None,
+            "req": self._hash_file(integration_req) if os.path.isfile(integration_req) else None,
+        }
+        key = self._venv_key(entry["base_req"], entry["req"])
+        venv_path = os.path.join(Config.VENVS_DIR, key)
+        entry["venv"] = venv_path
+        if not build:
+            return entry
+
+        # Integrations with the same requirements build the same venv, only once
+        with self._venv_lock(key):
+            if os.path.isfile(os.path.join(venv_path, ".complete")):
+                logger.info(f"[{name}] Reusing venv {key}.")
+            elif self._restore_venv(key, venv_path):
+                logger.info(f"[{name}] Restored venv {key} from archive.")
+            else:
+                self._build_venv(name, venv_path, base_req, integration_req)
+                self._archive_venv(key, venv_path)
+        return entry
+
+    def _venv_key(self, base_hash: str, req_hash: str) -> str:
+        python = f"{platform.python_implementation()}-{platform.python_version()}-{platform.machine()}"
+        return hashlib.sha256(f"{python}:{base_hash}:{req_hash}".encode()).hexdigest()[:16]
+
+    def _venv_lock(self, key: str) -> threading.Lock:
+        with self._state_lock:
+            return self._venv_locks.setdefault(key, threading.Lock())
+
+    def _build_venv(self, name: str, venv_path: str, base_req: str, integration_req: str):
+        pip_path = os.path.join(venv_path, "bin", "pip")
+
+        # Start from scratch if an earlier build of this venv was interrupted
+        shutil.rmtree(venv_path, ignore_errors=True)
+        logger.info(f"[{name}] Creating venv...")
+        result = subprocess.run(
+            ["python3", "-m", "venv", venv_path],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"[{name}] venv creation failed: {result.stderr}")
 
         # Install base requirements (shared utils dependencies)
         if os.path.isfile(base_req):
-            current_hash = self._hash_file(base_req)
-            if self._req_hashes.get(f"{name}__base") != current_hash:
-                logger.info(f"[{name}] Installing base requirements...")
-                result = subprocess.run(
-                    [pip_path, "install", "-r", base_req],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode != 0:
-                    raise RuntimeError(f"[{name}] base pip install failed: {result.stderr}")
-                self._req_hashes[f"{name}__base"] = current_hash
-                logger.info(f"[{name}] Base requirements installed.")
-            else:
-                logger.info(f"[{name}] Base requirements unchanged, skipping.")
+            logger.info(f"[{name}] Installing base requirements...")
+            self._pip_install(name, pip_path, base_req, "base")
+            logger.info(f"[{name}] Base requirements installed.")
         else:
             logger.warning(f"[{name}] No base requirements.txt found at {base_req}")
 
         # Install integration-specific requirements
         if os.path.isfile(integration_req):
-            current_hash = self._hash_file(integration_req)
-            if self._req_hashes.get(name) != current_hash:
-                logger.info(f"[{name}] Installing integration requirements...")
-                result = subprocess.run(
-                    [pip_path, "install", "-r", integration_req],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode != 0:
-                    raise RuntimeError(f"[{name}] pip install failed: {result.stderr}")
-                self._req_hashes[name] = current_hash
-                logger.info(f"[{name}] Integration requirements installed.")
-            else:
-                logger.info(f"[{name}] Integration requirements unchanged, skipping.")
+            logger.info(f"[{name}] Installing integration requirements...")
+            self._pip_install(name, pip_path, integration_req, "integration")
+            logger.info(f"[{name}] Integration requirements installed.")
         else:
             logger.info(f"[{name}] No integration requirements.txt found, skipping.")
 
+        open(os.path.join(venv_path, ".complete"), "w").close()
+
+    def _restore_venv(self, key: str, venv_path: str) -> bool:
+        """
+        Extract <key>.tar.gz from VENV_ARCHIVE_DIR. Venvs hold absolute paths, so
+        replicas sharing archives must use the same VENVS_DIR.
+        """
+        if not Config.VENV_ARCHIVE_DIR:
+            return False
+        archive = os.path.join(Config.VENV_ARCHIVE_DIR, f"{key}.tar.gz")
+        if not os.path.isfile(archive):
+            return False
+
+        staging = f"{venv_path}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            # Archives come from a shared, writable volume, don't trust member paths
+            with tarfile.open(archive, "r:gz") as tar:
+                tar.extractall(staging, filter=venv_filter)
+        except Exception as e:
+            logger.warning(f"Failed to restore venv {key} from {archive}: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+
+        if not os.path.isfile(os.path.join(staging, ".complete")):
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        shutil.rmtree(venv_path, ignore_errors=True)
+        os.rename(staging, venv_path)
+        return True
+
+    def _archive_venv(self, key: str, venv_path: str):
+        """Export a built venv to VENV_ARCHIVE_DIR so other replicas can restore it."""
+        if not Config.VENV_ARCHIVE_DIR:
+            return
+        archive = os.path.join(Config.VENV_ARCHIVE_DIR, f"{key}.tar.gz")
+        if os.path.isfile(archive):
+            return
+
+        # Unique per writer: replicas share the directory, and in containers they all run as PID 1
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{key}.", suffix=".tmp", dir=Config.VENV_ARCHIVE_DIR)
+        os.close(fd)
+        try:
+            with tarfile.open(tmp_path, "w:gz", compresslevel=1) as tar:
+                tar.add(venv_path, arcname=".")
+            os.replace(tmp_path, archive)
+            logger.info(f"Exported venv {key} to {archive}")
+        except Exception as e:
+            logger.warning(f"Failed to export venv {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     def _hash_file(self, path: str) -> str:
         with open(path, "rb") as f:
             return hashlib.md5(f.read()).hexdigest()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def worker_dirs(tmp_path, monkeypatch):
+    """Point the worker's directories at a temp dir and reset the release store's pins."""
+    from releases import releases
+
+    paths = {
+        "BASE_DIR": tmp_path / "base",
+        "INTEGRATIONS_DIR": tmp_path / "base" / "integrations",
+        "VENVS_DIR": tmp_path / "venvs",
+        "WHEELHOUSE_DIR": tmp_path / "wheelhouse",
+        "RELEASES_DIR": tmp_path / "releases",
+    }
+    for name, path in paths.items():
+        path.mkdir(parents=True, exist_ok=True)
+        monkeypatch.setattr(Config, name, str(path))
+    for folder in ["integrations", "shared", "revisions"]:
+        (paths["RELEASES_DIR"] / folder).mkdir()
+    monkeypatch.setattr(Config, "SYNC_STATE_PATH", str(tmp_path / "venvs" / "sync_state.json"))
+    monkeypatch.setattr(Config, "VENV_ARCHIVE_DIR", None)
+
+    releases._refs.clear()
+    releases._cached = (None, None)
+    yield tmp_path
+    releases._refs.clear()
+    releases._cached = (None, None)
+
+
+def make_venv(path, size: int = 0):
+    """A fake built venv: a directory with the .complete marker and size bytes of content."""
+    os.makedirs(path, exist_ok=True)
+    open(os.path.join(path, ".complete"), "w").close()
+    with open(os.path.join(path, "blob"), "wb") as f:
+        f.write(b"x" * size)
+    return str(path)
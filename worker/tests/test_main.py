@@ -0,0 +1,76 @@
+import threading
+import time
+from datetime import datetime
+
+from config import Config
+from main import JobWorker, create_session, job_spans, parse_queues
+
+
+def test_parse_queues_weights():
+    assert parse_queues("default:3,aws:1") == {"default": 3.0, "aws": 1.0}
+
+
+def test_parse_queues_defaults():
+    assert parse_queues("default, aws") == {"default": 1.0, "aws": 1.0}
+    assert parse_queues("") == {"default": 1.0}
+    assert parse_queues("slow:0")["slow"] == 0.01
+
+
+def test_session_only_retries_connect_errors():
+    session = create_session(4)
+    adapter = session.get_adapter("http://api")
+    retry = adapter.max_retries
+
+    assert retry.connect == Config.HTTP_RETRIES
+    assert retry.read == 0
+    assert retry.status == 0
+    assert retry.other == 0
+    assert "POST" in retry.allowed_methods
+
+
+def test_session_pool_fits_slots_and_heartbeats():
+    adapter = create_session(4).get_adapter("https://api")
+    assert adapter._pool_maxsize == 8
+
+
+def test_job_spans_are_laid_out_back_to_back():
+    started = datetime(2024, 1, 1)
+    spans = job_spans(started, {"wall_seconds": 3.0, "import_seconds": 0.5, "run_seconds": 2.0, "post_seconds": 0.25})
+
+    assert [span["name"] for span in spans] == ["job", "import", "run", "post"]
+    assert spans[0]["duration_ms"] == 3000.0
+    assert spans[2]["start"] == "2024-01-01T00:00:00.500000"
+    assert spans[3]["start"] == "2024-01-01T00:00:02.500000"
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+
+    def json(self):
+        return {"cancel": True}
+
+
+class FakeSession:
+    def __init__(self):
+        self.heartbeats = 0
+
+    def post(self, url, **kwargs):
+        self.heartbeats += 1
+        return FakeResponse()
+
+
+def test_heartbeat_continues_after_cancel_until_stopped(monkeypatch):
+    monkeypatch.setattr(Config, "HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(Config, "CANCEL_CHECK_INTERVAL", 0.05)
+    worker = JobWorker()
+    worker.session = FakeSession()
+    cancelled = threading.Event()
+
+    stop = worker.start_heartbeat(1, cancelled=cancelled)
+    assert cancelled.wait(5)
+    time.sleep(0.3)
+    stop.set()
+
+    # The lease is still renewed while the slot winds the job down
+    assert worker.session.heartbeats >= 3
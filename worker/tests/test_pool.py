@@ -0,0 +1,218 @@
+import os
+import signal
+import sys
+import threading
+
+import pytest
+
+from releases import releases
+from config import Config
+from pool import IdleBudget, IntegrationPool, JobCancelled, PoolManager, TransientError
+
+ENTRY = '''
+import os
+import time
+
+
+class Runner:
+    def __init__(self, config):
+        self.config = config
+
+    def run(self):
+        action = self.config.get("action")
+        if action == "connect":
+            raise ConnectionError("connection refused")
+        if action == "permanent":
+            error = ConnectionError("account disabled")
+            error.transient = False
+            raise error
+        if action == "fail":
+            raise ValueError("bad config")
+        if action == "sleep":
+            time.sleep(self.config["seconds"])
+        if action == "exit":
+            os._exit(3)
+        return {"name": self.name, "tasks": [1, 2, 3], "pid": os.getpid()}
+'''
+
+
+@pytest.fixture
+def pool(worker_dirs):
+    """A pool for a test integration, with the test's own python standing in for the venv."""
+    integration = worker_dirs / "code" / "hello"
+    integration.mkdir(parents=True)
+    (integration / "entry.py").write_text(ENTRY)
+    venv = worker_dirs / "venv"
+    (venv / "bin").mkdir(parents=True)
+    os.symlink(sys.executable, venv / "bin" / "python")
+    repo_root = worker_dirs / "shared"
+    repo_root.mkdir()
+
+    pool = IntegrationPool("hello", str(integration), str(venv), str(repo_root))
+    yield pool
+    pool.shutdown()
+
+
+def test_run_returns_result(pool):
+    result = pool.run({}, timeout=30)
+    assert result["name"] == "hello"
+    assert result["tasks"] == [1, 2, 3]
+
+
+def test_run_reports_metrics(pool):
+    metrics = {}
+    pool.run({}, timeout=30, metrics=metrics)
+    assert metrics["tasks"] == 3
+    assert metrics["import_seconds"] >= 0
+    assert metrics["peak_rss_kb"] > 0
+    assert {"run_seconds", "cpu_seconds", "post_seconds"} <= set(metrics)
+
+    # Only the child's first job pays for the import
+    pool.run({}, timeout=30, metrics=metrics)
+    assert metrics["import_seconds"] == 0.0
+
+
+def test_run_with_profile_writes_stats(pool, tmp_path):
+    profile = tmp_path / "job.prof"
+    pool.run({}, timeout=30, profile=str(profile))
+    assert profile.stat().st_size > 0
+
+
+def test_child_is_reused(pool):
+    first = pool.run({}, timeout=30)
+    second = pool.run({}, timeout=30)
+
+    assert first["pid"] == second["pid"]
+    assert pool.stats.as_dict()["hits"] == 1
+    assert pool.stats.as_dict()["misses"] == 1
+
+
+def test_dead_idle_child_is_reaped(pool):
+    child = pool.acquire()
+    pool.release(child)
+    os.kill(child.pid, signal.SIGKILL)
+    child.proc.wait()
+
+    assert pool.run({}, timeout=30)["pid"] != child.pid
+    assert child.proc.stdout.closed
+
+
+def test_idle_budget_stops_longest_idle_child(pool, worker_dirs, monkeypatch):
+    monkeypatch.setattr(Config, "POOL_MAX_IDLE", 2)
+    other = IntegrationPool("other", pool.integration_path, pool.venv_path, pool.repo_root)
+    pool.budget = other.budget = IdleBudget(2)
+    try:
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        other.release(other.acquire())
+
+        assert len(pool.budget) == 2
+        assert not first.alive()
+        child = pool.acquire()
+        assert child is second
+        pool.release(child)
+    finally:
+        other.shutdown()
+
+
+def test_pools_are_retired_when_revision_changes(worker_dirs):
+    pools = PoolManager()
+    old = pools.get("hello", "/code/hello-1", "/venvs/v1", "/shared", revision="r1")
+    other = pools.get("other", "/code/other-1", "/venvs/v2", "/shared", revision="r1")
+    assert pools.get("hello", "/code/hello-1", "/venvs/v1", "/shared", revision="r1") is old
+
+    pools.retire_stale({"hello": "r2", "other": "r1"})
+
+    assert old.retired
+    assert not other.retired
+    assert pools.stats.as_dict()["invalidations"] == 1
+    assert pools.get("hello", "/code/hello-2", "/venvs/v1", "/shared", revision="r2") is not old
+    pools.shutdown()
+
+
+def test_superseded_revision_gets_a_retired_pool(worker_dirs):
+    pools = PoolManager()
+    pools.retire_stale({"hello": "r2"})
+
+    # A job still running on the old release doesn't bring back a warm pool for it
+    stale = pools.get("hello", "/code/hello-1", "/venvs/v1", "/shared", revision="r1")
+    assert stale.retired
+    assert pools.get("hello", "/code/hello-1", "/venvs/v1", "/shared", revision="r1") is not stale
+
+    current = pools.get("hello", "/code/hello-2", "/venvs/v1", "/shared", revision="r2")
+    assert not current.retired
+    pools.shutdown()
+
+
+def test_new_revision_retires_older_pools(worker_dirs):
+    pools = PoolManager()
+    old = pools.get("hello", "/code/hello-1", "/venvs/v1", "/shared", revision="r1")
+    new = pools.get("hello", "/code/hello-2", "/venvs/v1", "/shared", revision="r2")
+
+    assert old.retired
+    assert not new.retired
+    pools.shutdown()
+
+
+def test_failed_job_keeps_child(pool):
+    with pytest.raises(RuntimeError, match="bad config") as info:
+        pool.run({"action": "fail"}, timeout=30)
+    assert not isinstance(info.value, TransientError)
+    assert pool.run({}, timeout=30)["name"] == "hello"
+
+
+def test_network_error_is_transient(pool):
+    with pytest.raises(TransientError, match="connection refused"):
+        pool.run({"action": "connect"}, timeout=30)
+
+
+def test_integration_can_mark_error_permanent(pool):
+    with pytest.raises(RuntimeError) as info:
+        pool.run({"action": "permanent"}, timeout=30)
+    assert not isinstance(info.value, TransientError)
+
+
+def test_timeout_replaces_child(pool):
+    first = pool.run({}, timeout=30)["pid"]
+    with pytest.raises(TransientError, match="timed out"):
+        pool.run({"action": "sleep", "seconds": 10}, timeout=1)
+    assert pool.run({}, timeout=30)["pid"] != first
+
+
+def test_child_exit_is_reported(pool):
+    with pytest.raises(TransientError, match="exited unexpectedly"):
+        pool.run({"action": "exit"}, timeout=30)
+    assert pool.run({}, timeout=30)["name"] == "hello"
+
+
+def test_cancel_kills_running_job(pool):
+    first = pool.run({}, timeout=30)["pid"]
+    cancel = threading.Event()
+    threading.Timer(0.5, cancel.set).start()
+    with pytest.raises(JobCancelled):
+        pool.run({"action": "sleep", "seconds": 10}, timeout=30, cancel=cancel)
+    assert pool.run({}, timeout=30)["pid"] != first
+
+
+def test_cancel_before_run_keeps_child(pool):
+    first = pool.run({}, timeout=30)["pid"]
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(JobCancelled):
+        pool.run({}, timeout=30, cancel=cancel)
+    assert pool.run({}, timeout=30)["pid"] == first
+
+
+def test_failed_import(pool):
+    with open(os.path.join(pool.integration_path, "entry.py"), "w") as f:
+        f.write("raise ImportError('missing dependency')\n")
+    with pytest.raises(RuntimeError, match="failed to load") as info:
+        pool.run({}, timeout=30)
+    assert not isinstance(info.value, TransientError)
+
+
+def test_pool_pins_its_directories_until_shutdown(pool):
+    assert releases.pins(pool.venv_path) == 1
+    pool.shutdown()
+    assert releases.pins(pool.venv_path) == 0
@@ -0,0 +1,85 @@
+import os
+
+from config import Config
+from releases import releases
+
+
+def publish(shared, integrations):
+    releases.publish("abc123", shared, integrations)
+    return releases.current()
+
+
+def test_publish_points_current_at_manifest(worker_dirs):
+    shared = releases.shared_dir("s1")
+    os.makedirs(shared)
+    manifest = publish(shared, {"hello": {"path": "/code", "venv": "/venv", "revision": "abc123"}})
+
+    assert manifest["revision"] == "abc123"
+    assert manifest["shared"] == shared
+    assert manifest["integrations"]["hello"]["venv"] == "/venv"
+    assert os.path.islink(os.path.join(Config.RELEASES_DIR, "current"))
+
+
+def test_checkout_pins_until_released(worker_dirs):
+    shared = releases.shared_dir("s1")
+    code = releases.integration_dir("hello", "a" * 40)
+    venv = os.path.join(Config.VENVS_DIR, "v1")
+    publish(shared, {"hello": {"path": code, "venv": venv, "revision": "abc123"}})
+
+    with releases.checkout("hello") as (manifest, entry):
+        assert entry["path"] == code
+        assert releases.pins(venv) == 1
+        assert releases.pins(shared) == 1
+    assert releases.pins(venv) == 0
+
+    with releases.checkout("missing") as (manifest, entry):
+        assert entry is None
+
+
+def test_remove_refuses_pinned_directory(worker_dirs):
+    venv = os.path.join(Config.VENVS_DIR, "v1")
+    os.makedirs(venv)
+
+    releases.acquire(venv)
+    assert not releases.remove(venv)
+    assert os.path.isdir(venv)
+
+    releases.release(venv)
+    assert releases.remove(venv)
+    assert not os.path.exists(venv)
+
+
+def test_collect_garbage_keeps_current_pinned_and_staging(worker_dirs):
+    shared = releases.shared_dir("s1")
+    code = releases.integration_dir("hello", "a" * 40)
+    venv = os.path.join(Config.VENVS_DIR, "v1")
+    old_code = releases.integration_dir("hello", "b" * 40)
+    old_venv = os.path.join(Config.VENVS_DIR, "v0")
+    pinned_venv = os.path.join(Config.VENVS_DIR, "v2")
+    staging_venv = os.path.join(Config.VENVS_DIR, "v3.tmp")
+    for path in [shared, code, venv, old_code, old_venv, pinned_venv, staging_venv]:
+        os.makedirs(path)
+
+    publish(shared, {"hello": {"path": code, "venv": venv, "revision": "abc123"}})
+    releases.acquire(pinned_venv)
+    releases.collect_garbage()
+
+    for path in [shared, code, venv, pinned_venv, staging_venv]:
+        assert os.path.isdir(path), path
+    for path in [old_code, old_venv]:
+        assert not os.path.exists(path), path
+        assert not os.path.exists(f"{path}.deleting"), path
+
+    revisions = os.listdir(os.path.join(Config.RELEASES_DIR, "revisions"))
+    assert len(revisions) == 1
+
+
+def test_collect_garbage_drops_old_manifests(worker_dirs):
+    shared = releases.shared_dir("s1")
+    os.makedirs(shared)
+    publish(shared, {})
+    publish(shared, {})
+    releases.collect_garbage()
+
+    current = os.path.basename(os.path.realpath(os.path.join(Config.RELEASES_DIR, "current")))
+    assert os.listdir(os.path.join(Config.RELEASES_DIR, "revisions")) == [current]
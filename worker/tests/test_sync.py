@@ -0,0 +1,447 @@
+import os
+import io
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+import pytest
+
+from config import Config
+from releases import releases
+from pool import JobCancelled, pools
+from sync import GitHubSync
+from conftest import make_venv
+
+TREE_A = "a" * 40
+TREE_B = "b" * 40
+MB = 1024 * 1024
+
+# Stands in for "pip wheel": writes a wheel for every line of the requirements file
+FAKE_PIP = '''
+import os
+import sys
+
+args = sys.argv[1:]
+staging = args[args.index("-w") + 1]
+for name in open(args[args.index("-r") + 1]).read().split():
+    with open(os.path.join(staging, f"{name}-1.0-py3-none-any.whl"), "w") as f:
+        f.write("built")
+'''
+
+
+@pytest.fixture
+def syncer(worker_dirs):
+    yield GitHubSync()
+    pools.shutdown()
+
+
+def git(cwd, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def commit(path, message="update"):
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """An integrations repo with two integrations and shared utils."""
+    path = tmp_path / "remote"
+    for name in ["hello", "other"]:
+        (path / "integrations" / name).mkdir(parents=True)
+        (path / "integrations" / name / "entry.py").write_text("class Runner:\n    pass\n")
+    (path / "utils").mkdir()
+    (path / "utils" / "helpers.py").write_text("")
+    git(path, "init", "-q", "-b", "main")
+    git(path, "config", "uploadpack.allowFilter", "true")
+    commit(path, "initial")
+    return path
+
+
+def use_remote(syncer, remote, monkeypatch, enabled=("hello", "other")):
+    """Sync from the local repo, without venv builds (they are built by the first job)."""
+    monkeypatch.setattr(Config, "LAZY_PROVISION", True)
+    monkeypatch.setattr(Config, "GITHUB_BRANCH", "main")
+    monkeypatch.setattr(syncer, "repo_url", f"file://{remote}")
+    monkeypatch.setattr(syncer, "_fetch_enabled_integrations", lambda: list(enabled))
+    setups = []
+    prepare = syncer._prepare_integration
+
+    def count(name, tree, shared):
+        setups.append(name)
+        return prepare(name, tree, shared)
+
+    monkeypatch.setattr(syncer, "_prepare_integration", count)
+    return setups
+
+
+@pytest.fixture
+def fake_pip(tmp_path):
+    script = tmp_path / "pip.py"
+    script.write_text(FAKE_PIP)
+    return [sys.executable, str(script)]
+
+
+def test_build_wheels_moves_wheels_into_wheelhouse(syncer, fake_pip, tmp_path):
+    req = tmp_path / "requirements.txt"
+    req.write_text("requests\nboto3\n")
+    existing = os.path.join(Config.WHEELHOUSE_DIR, "boto3-1.0-py3-none-any.whl")
+    with open(existing, "w") as f:
+        f.write("cached")
+
+    assert syncer._build_wheels(fake_pip, str(req)).returncode == 0
+
+    # No staging directory is left behind, and a wheel already there isn't replaced
+    assert sorted(os.listdir(Config.WHEELHOUSE_DIR)) == [
+        "boto3-1.0-py3-none-any.whl",
+        "requests-1.0-py3-none-any.whl",
+    ]
+    with open(existing) as f:
+        assert f.read() == "cached"
+
+
+def test_base_wheels_are_built_once_per_requirements(syncer, monkeypatch):
+    base_req = os.path.join(Config.BASE_DIR, "requirements.txt")
+    with open(base_req, "w") as f:
+        f.write("requests\n")
+    calls = []
+
+    def build(pip, req_file):
+        calls.append(req_file)
+        return subprocess.CompletedProcess(pip, 0)
+
+    monkeypatch.setattr(syncer, "_build_wheels", build)
+    syncer._build_base_wheels()
+    syncer._build_base_wheels()
+    assert calls == [base_req]
+
+    with open(base_req, "w") as f:
+        f.write("requests\nboto3\n")
+    syncer._build_base_wheels()
+    assert len(calls) == 2
+
+
+def test_needs_setup_for_new_integration(syncer):
+    assert syncer._needs_setup("hello", TREE_A, changed=set())
+
+
+def test_needs_setup_skips_unchanged_integration(syncer):
+    venv = make_venv(os.path.join(Config.VENVS_DIR, "v1"))
+    os.makedirs(releases.integration_dir("hello", TREE_A))
+    syncer.state["integrations"]["hello"] = {"tree": TREE_A, "venv": venv}
+
+    assert not syncer._needs_setup("hello", TREE_A, changed=set())
+    assert syncer._needs_setup("hello", TREE_A, changed={"hello"})
+
+
+def test_needs_setup_retries_failed_setup(syncer):
+    # The setup at TREE_B failed, so the state still has TREE_A while the synced
+    # revision moved on and the diff against it doesn't list the integration
+    venv = make_venv(os.path.join(Config.VENVS_DIR, "v1"))
+    os.makedirs(releases.integration_dir("hello", TREE_A))
+    os.makedirs(releases.integration_dir("hello", TREE_B))
+    syncer.state["integrations"]["hello"] = {"tree": TREE_A, "venv": venv}
+
+    assert syncer._needs_setup("hello", TREE_B, changed=set())
+
+
+def test_sync_sets_up_only_changed_integrations(syncer, remote, monkeypatch):
+    setups = use_remote(syncer, remote, monkeypatch)
+    syncer.sync()
+    assert sorted(setups) == ["hello", "other"]
+    assert syncer.ready_integrations == ["hello", "other"]
+
+    setups.clear()
+    syncer.sync()
+    assert setups == []
+
+    (remote / "integrations" / "hello" / "entry.py").write_text("class Runner:\n    version = 2\n")
+    commit(remote)
+    syncer.sync()
+    assert setups == ["hello"]
+
+
+def test_sync_state_survives_restart(syncer, remote, monkeypatch):
+    use_remote(syncer, remote, monkeypatch)
+    syncer.sync()
+
+    restarted = GitHubSync()
+    setups = use_remote(restarted, remote, monkeypatch)
+    restarted.sync()
+    assert setups == []
+    assert restarted.ready_integrations == ["hello", "other"]
+
+
+def test_shallow_fetch_gets_only_latest_commit(syncer, remote, monkeypatch):
+    (remote / "utils" / "helpers.py").write_text("VERSION = 2\n")
+    commit(remote)
+    use_remote(syncer, remote, monkeypatch)
+    monkeypatch.setattr(Config, "GIT_SHALLOW", True)
+
+    syncer.sync()
+    assert syncer._git("rev-list", "--count", "HEAD").strip() == "1"
+
+
+def test_sparse_checkout_of_enabled_integrations(syncer, remote, monkeypatch):
+    use_remote(syncer, remote, monkeypatch, enabled=("hello",))
+    monkeypatch.setattr(Config, "GIT_SPARSE", True)
+    syncer.sync()
+
+    assert os.path.isfile(os.path.join(Config.INTEGRATIONS_DIR, "hello", "entry.py"))
+    assert os.path.isfile(os.path.join(Config.BASE_DIR, "utils", "helpers.py"))
+    assert not os.path.exists(os.path.join(Config.INTEGRATIONS_DIR, "other"))
+    assert syncer.ready_integrations == ["hello"]
+
+    # Turning it off checks out the whole repo again
+    use_remote(syncer, remote, monkeypatch)
+    monkeypatch.setattr(Config, "GIT_SPARSE", False)
+    syncer.sync()
+    assert os.path.isfile(os.path.join(Config.INTEGRATIONS_DIR, "other", "entry.py"))
+
+
+def test_running_job_keeps_its_release(syncer, remote, monkeypatch):
+    use_remote(syncer, remote, monkeypatch)
+    syncer.sync()
+
+    with releases.checkout("hello") as (manifest, entry):
+        (remote / "integrations" / "hello" / "entry.py").write_text("class Runner:\n    version = 2\n")
+        commit(remote)
+        syncer.sync()
+
+        # The job still sees the code it started with, new jobs get the new code
+        with open(os.path.join(entry["path"], "entry.py")) as f:
+            assert "version" not in f.read()
+        with releases.checkout("hello") as (_, latest):
+            assert latest["path"] != entry["path"]
+        assert releases.current()["integrations"]["other"] == manifest["integrations"]["other"]
+
+    releases.collect_garbage()
+    assert not os.path.exists(entry["path"])
+
+
+def test_identical_requirements_share_a_venv(syncer, tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    (shared / "requirements.txt").write_text("requests\n")
+    for name, req in [("a", "boto3\n"), ("b", "boto3\n"), ("c", "azure\n"), ("d", None)]:
+        (tmp_path / name).mkdir()
+        if req:
+            (tmp_path / name / "requirements.txt").write_text(req)
+    venv = {
+        name: syncer._ensure_venv(name, str(tmp_path / name), str(shared), build=False)["venv"]
+        for name in "abcd"
+    }
+
+    assert venv["a"] == venv["b"]
+    assert len({venv["a"], venv["c"], venv["d"]}) == 3
+    assert os.path.dirname(venv["a"]) == Config.VENVS_DIR
+
+
+def test_archive_and_restore_venv(syncer, tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "VENV_ARCHIVE_DIR", str(tmp_path / "archive"))
+    os.makedirs(Config.VENV_ARCHIVE_DIR)
+    venv = make_venv(os.path.join(Config.VENVS_DIR, "k1"), 10)
+
+    syncer._archive_venv("k1", venv)
+    archives = os.listdir(Config.VENV_ARCHIVE_DIR)
+    assert archives == ["k1.tar.gz"]
+
+    restored = os.path.join(Config.VENVS_DIR, "k1-restored")
+    assert syncer._restore_venv("k1", restored)
+    assert os.path.isfile(os.path.join(restored, ".complete"))
+    assert os.path.getsize(os.path.join(restored, "blob")) == 10
+    assert not os.path.exists(f"{restored}.tmp")
+
+
+def test_restore_venv_keeps_absolute_interpreter_link(syncer, tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "VENV_ARCHIVE_DIR", str(tmp_path / "archive"))
+    os.makedirs(Config.VENV_ARCHIVE_DIR)
+    venv = make_venv(os.path.join(Config.VENVS_DIR, "k1"))
+    os.makedirs(os.path.join(venv, "bin"))
+    os.symlink(sys.executable, os.path.join(venv, "bin", "python"))
+
+    syncer._archive_venv("k1", venv)
+    restored = os.path.join(Config.VENVS_DIR, "k1-restored")
+    assert syncer._restore_venv("k1", restored)
+    assert os.readlink(os.path.join(restored, "bin", "python")) == sys.executable
+
+
+@pytest.mark.parametrize("members", [
+    [("../escaped", False)],
+    # A symlink out of the venv, then a file written through it
+    [("lib", True), ("lib/escaped", False)],
+])
+def test_restore_venv_rejects_paths_outside_the_venv(syncer, tmp_path, monkeypatch, members):
+    monkeypatch.setattr(Config, "VENV_ARCHIVE_DIR", str(tmp_path / "archive"))
+    os.makedirs(Config.VENV_ARCHIVE_DIR)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    with tarfile.open(os.path.join(Config.VENV_ARCHIVE_DIR, "k1.tar.gz"), "w:gz") as tar:
+        for name, link in [(".complete", False)] + members:
+            info = tarfile.TarInfo(name)
+            if link:
+                info.type, info.linkname = tarfile.SYMTYPE, str(outside)
+                tar.addfile(info)
+            else:
+                tar.addfile(info, io.BytesIO(b""))
+
+    restored = os.path.join(Config.VENVS_DIR, "k1-restored")
+    assert not syncer._restore_venv("k1", restored)
+    assert not os.path.exists(restored)
+    assert os.listdir(outside) == []
+
+
+def test_restore_venv_ignores_incomplete_archive(syncer, tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "VENV_ARCHIVE_DIR", str(tmp_path / "archive"))
+    os.makedirs(Config.VENV_ARCHIVE_DIR)
+    venv = os.path.join(Config.VENVS_DIR, "k1")
+    os.makedirs(venv)
+
+    syncer._archive_venv("k1", venv)
+    assert not syncer._restore_venv("k1", os.path.join(Config.VENVS_DIR, "k1-restored"))
+    assert not syncer._restore_venv("missing", os.path.join(Config.VENVS_DIR, "missing"))
+
+
+def test_needs_setup_rebuilds_incomplete_venv_when_eager(syncer, monkeypatch):
+    venv = os.path.join(Config.VENVS_DIR, "v1")
+    os.makedirs(venv)
+    os.makedirs(releases.integration_dir("hello", TREE_A))
+    syncer.state["integrations"]["hello"] = {"tree": TREE_A, "venv": venv}
+
+    monkeypatch.setattr(Config, "LAZY_PROVISION", False)
+    assert syncer._needs_setup("hello", TREE_A, changed=set())
+    monkeypatch.setattr(Config, "LAZY_PROVISION", True)
+    assert not syncer._needs_setup("hello", TREE_A, changed=set())
+
+
+def test_lazy_sync_leaves_venvs_to_the_first_job(syncer, remote, monkeypatch):
+    use_remote(syncer, remote, monkeypatch)
+    syncer.sync()
+    manifest = releases.current()
+    entry = manifest["integrations"]["hello"]
+    assert not os.path.exists(entry["venv"])
+
+    builds = []
+    monkeypatch.setattr(syncer, "_build_base_wheels", lambda: None)
+    monkeypatch.setattr(syncer, "_build_venv", lambda name, path, *reqs: builds.append(name) or make_venv(path))
+    syncer.provision("hello", entry, manifest["shared"])
+    syncer.provision("hello", entry, manifest["shared"])
+
+    assert builds == ["hello"]
+    assert os.path.isfile(os.path.join(entry["venv"], ".complete"))
+
+
+def test_job_cancelled_while_provisioning_does_not_run(syncer, remote, monkeypatch):
+    import runner
+
+    use_remote(syncer, remote, monkeypatch)
+    syncer.sync()
+    monkeypatch.setattr(runner, "syncer", syncer)
+    cancel = threading.Event()
+
+    def build(name, path, *reqs):
+        cancel.set()  # cancelled while the venv is being built
+        make_venv(path)
+
+    monkeypatch.setattr(syncer, "_build_base_wheels", lambda: None)
+    monkeypatch.setattr(syncer, "_build_venv", build)
+    monkeypatch.setattr(pools, "get", lambda *args, **kwargs: pytest.fail("no process should be started"))
+    with pytest.raises(JobCancelled):
+        runner.run_integration("hello", {}, cancel=cancel)
+
+
+def touch(path, age: int):
+    """Backdate a venv's .complete marker, which is what eviction orders by."""
+    marker = os.path.join(path, ".complete")
+    then = time.time() - age
+    os.utime(marker, (then, then))
+
+
+def publish_venvs(*venvs):
+    shared = releases.shared_dir("s1")
+    os.makedirs(shared, exist_ok=True)
+    releases.publish(
+        "abc123",
+        shared,
+        {f"i{n}": {"path": f"/code/i{n}", "venv": venv, "revision": "abc123"} for n, venv in enumerate(venvs)},
+    )
+    return shared
+
+
+def test_evict_venvs_removes_least_recently_used(syncer, monkeypatch):
+    monkeypatch.setattr(Config, "LAZY_PROVISION", True)
+    monkeypatch.setattr(Config, "VENV_DISK_BUDGET_MB", 2)
+    old = make_venv(os.path.join(Config.VENVS_DIR, "old"), MB)
+    new = make_venv(os.path.join(Config.VENVS_DIR, "new"), MB)
+    newest = make_venv(os.path.join(Config.VENVS_DIR, "newest"), MB)
+    touch(old, 300)
+    touch(new, 200)
+    touch(newest, 100)
+    publish_venvs(old, new, newest)
+
+    syncer.evict_venvs()
+
+    assert not os.path.exists(old)
+    assert os.path.isdir(new)
+    assert os.path.isdir(newest)
+
+
+def test_evict_venvs_keeps_current_release_when_eager(syncer, monkeypatch):
+    monkeypatch.setattr(Config, "LAZY_PROVISION", False)
+    monkeypatch.setattr(Config, "VENV_DISK_BUDGET_MB", 1)
+    stale = make_venv(os.path.join(Config.VENVS_DIR, "stale"), MB)
+    live = make_venv(os.path.join(Config.VENVS_DIR, "live"), MB)
+    touch(live, 300)
+    touch(stale, 100)
+    publish_venvs(live)
+
+    syncer.evict_venvs()
+
+    assert os.path.isdir(live)
+    assert not os.path.exists(stale)
+
+
+def test_evict_venvs_skips_venv_a_job_is_using(syncer, monkeypatch):
+    monkeypatch.setattr(Config, "LAZY_PROVISION", True)
+    monkeypatch.setattr(Config, "VENV_DISK_BUDGET_MB", 1)
+    busy = make_venv(os.path.join(Config.VENVS_DIR, "busy"), MB)
+    idle = make_venv(os.path.join(Config.VENVS_DIR, "idle"), MB)
+    touch(busy, 300)
+    touch(idle, 100)
+    shared = publish_venvs(busy, idle)
+
+    # A pool pins its venv once, the running job a second time
+    pool = pools.get("i0", "/code/i0", busy, shared, revision="abc123")
+    releases.acquire(busy)
+
+    syncer.evict_venvs()
+
+    assert os.path.isdir(busy)
+    assert not pool.retired
+    assert not os.path.exists(idle)
+    releases.release(busy)
+
+
+def test_evict_venvs_retires_idle_pools(syncer, monkeypatch):
+    monkeypatch.setattr(Config, "LAZY_PROVISION", True)
+    monkeypatch.setattr(Config, "VENV_DISK_BUDGET_MB", 1)
+    old = make_venv(os.path.join(Config.VENVS_DIR, "old"), MB)
+    new = make_venv(os.path.join(Config.VENVS_DIR, "new"), MB)
+    touch(old, 300)
+    touch(new, 100)
+    shared = publish_venvs(old, new)
+    pool = pools.get("i0", "/code/i0", old, shared, revision="abc123")
+
+    syncer.evict_venvs()
+
+    assert pool.retired
+    assert pools.count_venv(old) == 0
+    assert not os.path.exists(old)